@@ -0,0 +1,31 @@
+from argparse import ArgumentParser
+from .server import serve, DEFAULT_PORT, SHM_TTL
+
+def main(argv=None):
+
+    """
+    Command line interface:
+        distgen serve [--socket FILE | --host HOST --port PORT [--token-file FILE]] [--output-dir DIR] [--shm-ttl S] [--workers N] [-v]
+    """
+
+    parser = ArgumentParser(prog='distgen')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help='Run the persistent local generation service (see distgen.server)')
+    serve_parser.add_argument('--socket', dest='socket_file', default=None, help='Listen on this Unix socket file instead of HTTP')
+    serve_parser.add_argument('--host', default='localhost', help='HTTP host (default localhost)')
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'HTTP port (default {DEFAULT_PORT})')
+    serve_parser.add_argument('--token-file', default=None, help='HTTP: write the access token to this file (default in the distgen cache directory)')
+    serve_parser.add_argument('--output-dir', default=None, help='Only write output files inside this directory (default: the current directory)')
+    serve_parser.add_argument('--shm-ttl', type=float, default=SHM_TTL, help=f'Seconds to keep unread shared memory outputs (default {SHM_TTL})')
+    serve_parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: one per cpu)')
+    serve_parser.add_argument('-v', dest='verbose', action='count', default=0, help='Print status messages to stdout')
+
+    args = parser.parse_args(argv)
+
+    if(args.command=='serve'):
+        serve(socket_file=args.socket_file, host=args.host, port=args.port, workers=args.workers, verbose=args.verbose,
+              output_dir=args.output_dir, token_file=args.token_file, shm_ttl=args.shm_ttl)
+
+if __name__ == '__main__':
+    main()
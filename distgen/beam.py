@@ -2,7 +2,8 @@ import numpy as np
 from .physical_constants import unit_registry, pi, MC2
 import functools
 
-from .tools import vprint, mean, std
+from .tools import vprint, mean, std, storage_zeros
+from .hammersley import create_van_der_corput_samples
 
 """
 This class defines the container for an initial particle distribution 
@@ -46,8 +47,18 @@ class Beam():
         for req in self.required_inputs:
             assert req in inputs, f'Required input parameter {req} to {self.__class__.__name__}.__init__(**kwargs) was not found.'
 
+    def __getstate__(self):
+        # Quantities are pickled as (magnitude, units) and restored in distgen's unit registry,
+        # as pint unpickles them in its application registry, which can not be mixed with distgen's
+        return {key:(('quantity', value.magnitude, str(value.units)) if isinstance(value, unit_registry.Quantity) else value)
+                for key, value in self.__dict__.items()}
+
+    def __setstate__(self, state):
+        self.__dict__.update({key:(unit_registry.Quantity(value[1], value[2]) if isinstance(value, tuple) and value[:1]==('quantity',) else value)
+                              for key, value in state.items()})
+
     def __getitem__(self, key):
-        return getattr(self, key) 
+        return getattr(self, key)
 
     @property
     def n_particle(self):
@@ -272,6 +283,180 @@ class Beam():
         See function Sbeam_data
         """
         return beam_data(self)
+
+    def downsample(self, M, method='stratified', reweight=False, seed=None):
+
+        """
+        Returns a new Beam with M of the particles, selected by method:
+            'stratified': one random particle from each of M equal ranges of the particle index,
+            'halton': the particles at the base 2 van der Corput fractions of the particle index 
+                      (selections repeat a particle only if M > N/2).
+        The weights are set equal, or with reweight, to the weights of the selected particles renormalized to one.
+        The coordinates are then transformed, as in set_avg_and_std but with the full covariance matrix, 
+        so that the weighted means and covariance of x, px, y, py, z, pz, t match the parent beam.
+        Runs in O(N) time, without sorting.
+        """
+
+        variables = ['x', 'px', 'y', 'py', 'z', 'pz', 't']
+
+        N = len(self.w)
+        assert M>0 and M<=N, f'Beam: downsample size must be > 0 and <= {N}.'
+
+        if(method=='stratified'):
+            rng = np.random.default_rng(seed)
+            indices = ((np.arange(M) + rng.random(M))*(N/M)).astype(np.intp)
+        elif(method=='halton'):
+            indices = (create_van_der_corput_samples(np.arange(M), number_base=2)*N).astype(np.intp)
+        else:
+            raise ValueError(f'Beam: unknown downsample method "{method}".')
+
+        np.minimum(indices, N-1, out=indices)
+
+        if(reweight):
+            w = self.w.magnitude[indices].astype(np.float64)
+            w = w/np.sum(w)
+        else:
+            w = np.full((M,), 1/M)
+
+        beam = Beam(total_charge=self.q, n_particle=M)
+        beam['w'] = unit_registry.Quantity(w, 'dimensionless')
+
+        # Moments of the parent, in the units of each coordinate
+        avg, cov = weighted_moments([getattr(self, var).magnitude for var in variables], self.w.magnitude)
+
+        # The covariance of M particles has rank at most M-1
+        n_spread = int(np.sum(np.diag(cov)>0))
+        assert M>n_spread, f'Beam: downsample size must be > {n_spread}, the number of coordinates with spread, to match their covariance.'
+
+        # Coordinates without spread in the parent are constant, and are set to the parent value
+        for ii, var in enumerate(variables):
+            x = getattr(self, var)
+            if(cov[ii,ii]>0):
+                beam[var] = unit_registry.Quantity(x.magnitude[indices].astype(np.float64), x.units)
+            else:
+                beam[var] = unit_registry.Quantity(np.full((M,), avg[ii]), x.units)
+
+        beam.set_covariance(variables, avg, cov)
+
+        for var in variables:
+            x = getattr(self, var)
+            beam[var] = unit_registry.Quantity(beam[var].magnitude.astype(x.magnitude.dtype), x.units)
+
+        return beam
+
+    def split(self, n):
+
+        """
+        Splits the beam into a list of n beams over contiguous ranges of the particles (e.g. for sharded output), 
+        whose coordinates are views of this beam's.  Each carries the charge of its particles, with its weights 
+        renormalized to one.
+        """
+
+        variables = ['x', 'px', 'y', 'py', 'z', 'pz', 't']
+
+        N = len(self.w)
+        assert n>0 and n<=N, f'Beam: number of splits must be > 0 and <= {N}.'
+
+        bounds = [(ii*N)//n for ii in range(n+1)]
+        total = np.sum(self.w.magnitude, dtype=np.float64)
+
+        beams = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+
+            w = self.w.magnitude[start:stop]
+            weight = np.sum(w, dtype=np.float64)
+
+            beam = Beam(total_charge=self.q*(weight/total), n_particle=stop-start)
+            beam['w'] = unit_registry.Quantity(w/weight, 'dimensionless')
+
+            for var in variables:
+                x = getattr(self, var)
+                beam[var] = unit_registry.Quantity(x.magnitude[start:stop], x.units)
+
+            beams.append(beam)
+
+        return beams
+
+    def replicate(self, charges, offsets={}, directory=None):
+
+        """
+        Returns a new Beam of len(charges) copies of the beam (e.g. a bunch train), with copy k
+        carrying the charge charges[k] and shifted by offsets[var][k] in each coordinate var in offsets.
+        The coordinates of all copies are written into a single preallocated block, one vectorized
+        broadcast add per coordinate.  With directory, the block is an np.memmap file in that directory.
+        """
+
+        variables = ['x', 'px', 'y', 'py', 'z', 'pz', 't']
+
+        n_copy = len(charges)
+        N = len(self.w)
+
+        total_charge = np.sum(charges)
+        beam = Beam(total_charge=total_charge, n_particle=n_copy*N)
+
+        # Copy k of the weights is rescaled by its fraction of the total charge 
+        fractions = (charges/total_charge).to('dimensionless').magnitude
+        beam['w'] = unit_registry.Quantity(np.multiply.outer(fractions, self.w.magnitude).reshape(-1), 'dimensionless')
+
+        xs = [getattr(self, var) for var in variables]
+        block = storage_zeros((len(variables), n_copy, N), dtype=np.result_type(*[x.magnitude for x in xs]), directory=directory)
+
+        for ii, (var, x) in enumerate(zip(variables, xs)):
+            if(var in offsets):
+                np.add(x.magnitude, offsets[var].to(x.units).magnitude[:, np.newaxis], out=block[ii])
+            else:
+                block[ii] = x.magnitude
+            beam[var] = unit_registry.Quantity(block[ii].reshape(-1), x.units)
+
+        return beam
+
+    def set_covariance(self, variables, avg, cov, moments=None, chunk_size=1048576):
+
+        """
+        Transforms the coordinates in variables, as in set_avg_and_std but with the full covariance matrix, 
+        so that their weighted means and covariance are avg and cov (in the units of each coordinate): 
+        x -> Lc Ls^-1 (x - <x>) + avg, with Lc and Ls the Cholesky factors of cov and the beam covariance.  
+        If either is singular (e.g. a chirp with no uncorrelated spread), the square root of cov and the 
+        pseudo inverse square root of the beam covariance are used instead (see covariance_roots), 
+        which requires their null spaces to agree.  The beam moments can be passed in as moments=(<x>, covariance).  
+        Coordinates without spread are only shifted.  The transform is applied in chunks, with a single matrix 
+        multiply per chunk, in place where the coordinate arrays allow it.
+        """
+
+        xs = [getattr(self, var) for var in variables]
+
+        if(moments is None):
+            moments = weighted_moments([x.magnitude for x in xs], self.w.magnitude)
+
+        x_avg, x_cov = moments
+
+        spread = np.diag(x_cov)>0
+        A = np.zeros((len(xs), len(xs)))
+
+        if(np.any(spread)):
+            C, S = cov[np.ix_(spread,spread)], x_cov[np.ix_(spread,spread)]
+            if(is_positive_definite(C) and is_positive_definite(S)):
+                A[np.ix_(spread,spread)] = np.linalg.cholesky(C) @ np.linalg.inv(np.linalg.cholesky(S))
+            else:
+                root_C, _, rank_C = covariance_roots(C)
+                _, inverse_root_S, rank_S = covariance_roots(S)
+                if(rank_C!=rank_S):
+                    raise ValueError(f'Beam: can not transform a covariance of rank {rank_S} to one of rank {rank_C}.')
+                A[np.ix_(spread,spread)] = root_C @ inverse_root_S
+
+        for ii, var in enumerate(variables):
+            if(not xs[ii].magnitude.flags.writeable):
+                xs[ii] = unit_registry.Quantity(np.array(xs[ii].magnitude), xs[ii].units)
+                self[var] = xs[ii]
+
+        for start in range(0, len(self.w), chunk_size):
+            X = np.stack([x.magnitude[start:start+chunk_size] for x in xs]).astype(np.float64) - x_avg[:,np.newaxis]
+            Y = A @ X + avg[:,np.newaxis]
+            for ii, x in enumerate(xs):
+                if(spread[ii]):
+                    x.magnitude[start:start+chunk_size] = Y[ii]
+                else:
+                    x.magnitude[start:start+chunk_size] += avg[ii] - x_avg[ii]
    
 '''
 class Beam_old():
@@ -578,8 +763,9 @@ def beam_data(beam):
         x, y, z are positions in units of [m]
         px, py, pz are momenta in units of [eV/c]
         t is time in [s]
-        status = 1 
+        status = 1, a read only broadcast of a single value
         weight is the macro-charge weight in [C]
+    Coordinates already in these units are not copied.
         
 
     """
@@ -594,7 +780,7 @@ def beam_data(beam):
     weight = np.abs((beam['w'].magnitude) * total_charge) # Weight should be macrocharge in C
     
     # Status
-    status = np.full(n_particle, 1) # Status == 1 means live
+    status = np.broadcast_to(1, (n_particle,)) # Status == 1 means live
     
     # standard units and types
     names = ['x', 'y', 'z', 'px',   'py',   'pz',   't']
@@ -611,7 +797,79 @@ def beam_data(beam):
     
     return data            
 
+def particle_group(beam):
+    """
+    Returns an openPMD-beamphysics ParticleGroup sharing the coordinate buffers of beam, instead of 
+    copying them as ParticleGroup(data=beam.data()) does.  The beam coordinates are converted in place 
+    to the standard units of beam_data (and float64, which copies lower precision coordinates).
+    """
+    from pmd_beamphysics import ParticleGroup
+
+    units = {'x':'m', 'y':'m', 'z':'m', 'px':'eV/c', 'py':'eV/c', 'pz':'eV/c', 't':'s'}
+    for var, unit in units.items():
+        beam[var].ito(unit)
+        beam[var] = unit_registry.Quantity(beam[var].magnitude.astype(np.float64, copy=False), unit)
+
+    data = beam_data(beam)
+
+    # ParticleGroup(data=...) copies every array, so the group is made from the first particle, 
+    # and then given the full arrays
+    particles = ParticleGroup(data={key:value[:1] if isinstance(value, np.ndarray) else value for key, value in data.items()})
+    particles.data.update({key:value for key, value in data.items() if isinstance(value, np.ndarray)})
+
+    return particles
+
+
+def is_positive_definite(cov, tol=1e-10):
+    """ Checks that the correlation matrix of the covariance cov has no eigenvalue below tol """
+    d = np.sqrt(np.diag(cov))
+    return bool(np.min(np.linalg.eigvalsh(cov/np.outer(d, d)))>tol)
+
+def covariance_roots(cov, tol=1e-10):
+
+    """
+    Returns a square root D R^1/2 of the covariance cov = D R D, with D the standard deviations and R^1/2 
+    the symmetric square root of the correlation matrix, the pseudo inverse R^+1/2 D^-1 and the rank of cov.  
+    Working with the correlation matrix treats coordinates in different units alike.  Directions with an 
+    eigenvalue below tol (relative to the largest) are treated as without spread.  
+    For a beam with covariance S, x -> root_C @ inverse_root_S @ x gives it the covariance C if the null spaces
+    of C and S agree.
+    """
+
+    d = np.sqrt(np.diag(cov))
+    eigenvalues, vectors = np.linalg.eigh(cov/np.outer(d, d))
+
+    kept = eigenvalues>tol*np.max(eigenvalues)
+    roots = np.sqrt(np.where(kept, eigenvalues, 0))
+    inverse_roots = np.divide(1, roots, out=np.zeros_like(roots), where=kept)
+
+    root = d[:,np.newaxis] * (vectors*roots) @ vectors.T
+    inverse_root = (vectors*inverse_roots) @ vectors.T / d[np.newaxis,:]
+
+    return root, inverse_root, int(np.sum(kept))
+
+def weighted_moments(columns, weights, chunk_size=1048576):
+
+    """
+    Computes the weighted means and covariance matrix of the arrays in columns in a single pass, 
+    processing the particles in chunks in float64.  The sums are taken relative to the first 
+    particle, which avoids cancellation for coordinates with large offsets.
+    """
+
+    weights = np.asarray(weights)
+    N = len(weights)
+    total = np.sum(weights, dtype=np.float64)
 
+    shift = np.array([column[0] for column in columns], dtype=np.float64)
 
+    S1 = np.zeros(len(columns))
+    S2 = np.zeros((len(columns), len(columns)))
 
+    for start in range(0, N, chunk_size):
+        w = weights[start:start+chunk_size].astype(np.float64)
+        X = np.stack([column[start:start+chunk_size] for column in columns]).astype(np.float64) - shift[:,np.newaxis]
+        S1 += X @ w
+        S2 += (X*w) @ X.T
 
+    S1 /= total
+    return (shift + S1, S2/total - np.outer(S1, S1))
@@ -7,8 +7,11 @@ from .physical_constants import unit_registry
 from .physical_constants import pi
 
 from .tools import vprint
+from .tools import pyplot
 
 from .tools import interp
+from .tools import guide_table
+from .tools import guide_interp
 from .tools import linspace
 from .tools import centers
 
@@ -16,6 +19,8 @@ from .tools import trapz
 from .tools import cumtrapz
 from .tools import radint
 from .tools import radcumint
+from .tools import simpson
+from .tools import tabulate_pdf
 
 from .tools import histogram
 from .tools import radial_histogram
@@ -29,19 +34,39 @@ from .tools import gamma
 from .tools import get_vars
 from .tools import read_2d_file
 from .tools import read_image_file
+from .tools import read_histogram_h5
+from .tools import threshold_image
+from .tools import load_cached_array
 
 from pint import Quantity
 
 import numpy as np
-import numpy.matlib as mlib
 import os
 
-from matplotlib import pyplot as plt
 
-def random_generator(shape,sequence=None,params=None):
-    """ Returns a set of 'random' (either numpy.random.random or from a Hammersley sequence) numbers """
+def random_generator(shape,sequence=None,params=None,dtype=np.float64,out=None):
+    """ 
+    Returns a set of 'random' (either numpy.random.random or from a Hammersley sequence) numbers.
+    If out is given (shape[0] rows of length shape[1]), the numbers are written into it and it is returned.
+    """
     if(sequence is None or sequence=='pseudo'):
-        return np.random.random(shape)
+
+        if(out is None and np.dtype(dtype)==np.float64):
+            return np.random.random(shape)
+
+        # Fill one row at a time, in chunks, so only a single chunk is ever held in float64.
+        # The rows are drawn in the same order as np.random.random(shape).
+        if(out is None):
+            out = np.empty(shape, dtype=dtype)
+            rows = out.reshape((-1, out.shape[-1]))
+        else:
+            rows = out
+
+        chunk_size = 1048576
+        for row in rows:
+            for start in range(0, len(row), chunk_size):
+                row[start:start+chunk_size] = np.random.random(row[start:start+chunk_size].shape)
+        return out
 
     elif(sequence=="hammersley"):
 
@@ -49,9 +74,11 @@ def random_generator(shape,sequence=None,params=None):
         N = shape[1] 
 
         if(params is None):
-            return np.squeeze(create_hammersley_samples(N, dim=dim, burnin=-1, primes=()))
+            rns = create_hammersley_samples(N, dim=dim, burnin=-1, primes=(), dtype=dtype, out=out)
         else:
-            return np.squeeze(create_hammersley_samples(N, dim=dim, burnin=params["burnin"], primes=params["primes"]))
+            rns = create_hammersley_samples(N, dim=dim, burnin=params["burnin"], primes=params["primes"], dtype=dtype, out=out)
+
+        return rns if out is not None else np.squeeze(rns)
     else:
         raise ValueError("Sequence: "+str(sequence)+" is not supported")
 
@@ -102,6 +129,10 @@ def get_dist(var,params,verbose=0):
         dist =  UniformTheta(verbose=verbose, **params)
     elif(dtype=='image2d'):
         dist = Image2d(var, verbose=verbose, **params)
+    elif(dtype=='histnd'):
+        dist = HistNd(var, verbose=verbose, **params)
+    elif(dtype=='particles'):
+        dist = Particles(var, verbose=verbose, **params)
     else:
         raise ValueError(f'Distribution type "{dtype}" is not supported.')
             
@@ -112,6 +143,10 @@ class Dist():
     """
     Defines a base class for all distributions, and includes functionality for strict input checking
     """
+
+    cdf_tolerance = 5e-8    # Accuracy of adaptively tabulated CDFs, relative to the total probability (see tabulate_pdf)
+    use_guide_table = False # Invert tabulated CDFs with a precomputed guide table (see guide_interp)
+
     def __init__(self):
         self._n_indent=2
 
@@ -133,6 +168,17 @@ class Dist():
         if('indent' in params):
             self._n_indent = params['indent']
 
+        if('cdf_tolerance' in params):
+            self.cdf_tolerance = float(params['cdf_tolerance'])
+            assert self.cdf_tolerance>0, f'{self.__class__.__name__} cdf_tolerance must be > 0.'
+
+        if('guide_table' in params):
+            self.use_guide_table = bool(params['guide_table'])
+
+        if('cdf_dtype' in params):
+            self.cdf_dtype = params['cdf_dtype']
+            assert self.cdf_dtype in ['float32', 'float64'], f'{self.__class__.__name__} cdf_dtype must be float32 or float64.'
+
 
 class Dist1d(Dist):
 
@@ -141,24 +187,46 @@ class Dist1d(Dist):
     Assumes user will pass in [x,f(x)] as the pdf. 
     Numerically intergates to find the cdf and to sample the distribution.  
     Methods should be overloaded for specific derived classes, particularly if
-    the distribution allows analytic treatment.
+    the distribution allows analytic treatment.  Numerically defined distributions
+    should pass in a table from tabulate_pdf, including the cdf Cx, which is then
+    integrated with Simpson's rule.  With use_guide_table, the cdf is inverted using a guide table.
     """
+
+    adaptive = False
+    guide = None
     
-    def __init__(self, xs=None, Px=None, xstr="x"):
+    def __init__(self, xs=None, Px=None, xstr="x", Cx=None):
 
         super().__init__()
 
         self.xs = xs
         self.Px = Px
         self.xstr = xstr
+        self.adaptive = Cx is not None
           
         if(Px is not None):
-            norm = np.trapz(self.Px, self.xs)
+            norm = self.integrate(self.Px, self.xs)
             if(norm<=0):
                 raise ValueError('Normalization of PDF was <= 0')
 
             self.Px = self.Px/norm
-            self.Cx = cumtrapz(self.Px, self.xs)
+
+            if(self.adaptive):
+                self.Cx = Cx
+            else:
+                self.Cx = cumtrapz(self.Px, self.xs)
+
+            if(self.use_guide_table):
+                self.guide = guide_table(self.Cx)
+
+    def integrate(self, f, x):
+        """
+        Integrates f over the tabulated points x, using Simpson's rule for tables from tabulate_pdf
+        """
+        if(self.adaptive):
+            return simpson(f, x)
+        else:
+            return trapz(f, x)
     
     def get_x_pts(self, n):
         """
@@ -182,6 +250,8 @@ class Dist1d(Dist):
         """
         Evaluates the inverse of the cdf at probabilities rns
         """
+        if(self.guide is not None):
+            return guide_interp(rns, self.Cx, self.xs, self.guide)
         return interp(rns, self.Cx, self.xs)
 
     def sample(self, N, sequence=None, params=None):
@@ -194,6 +264,7 @@ class Dist1d(Dist):
         """
         Plots the associated pdf function sampled with n points
         """
+        plt = pyplot()
         x=self.get_x_pts(n)
         p=self.pdf(x)
         plt.figure()
@@ -205,6 +276,7 @@ class Dist1d(Dist):
         """ 
         Plots the associtated cdf function sampled with n points
         """
+        plt = pyplot()
         x=self.get_x_pts(n)
         P=self.cdf(x)
         plt.figure()
@@ -214,15 +286,15 @@ class Dist1d(Dist):
         
     def avg(self):
         """
-        Defines the 1st moment of the pdf, defaults to using trapz integration
+        Defines the 1st moment of the pdf, defaults to using numerical integration
         """
-        return trapz(self.xs*self.Px,self.xs)
+        return self.integrate(self.xs*self.Px,self.xs)
   
     def rms(self):
         """
-        Defines the rms of the pdf, defaults to using trapz integration
+        Defines the rms of the pdf, defaults to using numerical integration
         """
-        return np.sqrt(trapz(self.xs*self.xs*self.Px,self.xs))
+        return np.sqrt(self.integrate(self.xs*self.xs*self.Px,self.xs))
 
     def std(self):
         """
@@ -239,6 +311,7 @@ class Dist1d(Dist):
 
         Plots the pdf, cdf, and histogram of 10000 samples from the PDF.
         """
+        plt = pyplot()
         xs=self.sample(100000,sequence="hammersley")
         x = self.get_x_pts(1000)
         pdf = self.pdf(x)
@@ -267,11 +340,17 @@ class Dist1d(Dist):
 
 class Superposition(Dist1d):
 
-    """Dist object that allows user to superimpose multiple 1d distributions together to form a new PDF for sampling"""
+    """
+    Dist object that allows user to superimpose multiple 1d distributions together to form a new PDF for sampling.
+    Each component PDF is normalized to a peak value of 1 and scaled by its weight.  The result is sampled
+    exactly as a mixture: each particle is assigned a component according to its probability mass, 
+    and the component's own cdfinv is used to sample it.  Moments follow from the component moments.
+    """
 
     def __init__(self, var, verbose, **kwargs):
 
-        self.xstr = var
+        super().__init__(xstr=var)
+
         assert 'dists' in kwargs, 'SuperPositionDist1d must be supplied the key word argument "dists"'
 
         dist_defs = kwargs['dists']
@@ -303,23 +382,89 @@ class Superposition(Dist1d):
             if(xi[0] <min_var): min_var = xi[0]
             if(xi[-1]>max_var): max_var = xi[-1]
 
-        xs = linspace(min_var, max_var, 10000)
-
-        for ii, name in enumerate(dists.keys()):
+        self.dists = dists
+        self.xL = min_var
+        self.xR = max_var
 
-            pi = dists[name].pdf(xs)
+        # The mass of each peak normalized component is weight/peak, as the component PDFs are normalized to 1
+        masses = []
+        for name, dist in dists.items():
 
             assert weights[name]>=0, 'Weights for superpostiion dist must be >= 0.'
 
-            if(ii==0):
-                ps = weights[name]*pi/np.max(pi.magnitude)
-            else:
-                ps = ps + weights[name]*pi/np.max(pi.magnitude)
+            peak = np.max(dist.pdf(dist.get_x_pts(10000)).magnitude)
+            masses.append(weights[name]/peak)
 
-        super().__init__(xs, ps, var)
+        masses = np.array(masses, dtype=float)
+        if(np.sum(masses)<=0):
+            raise ValueError('Normalization of PDF was <= 0')
 
-        
-        #vprint(f'min_{var} = {self.xL:G~P}, max_{var} = {self.xR:G~P}', verbose>0, 2, True)
+        self.probabilities = masses/np.sum(masses)
+        self.cumulative_probabilities = np.concatenate(([0], np.cumsum(self.probabilities)))
+        self.cumulative_probabilities[-1] = 1
+
+    def get_x_pts(self, n):
+        """
+        Returns a vector of x pts spanning all of the component distributions
+        """
+        return linspace(self.xL, self.xR, n)
+
+    def pdf(self, x):
+        """
+        Evaluates the pdf as the probability weighted sum of the component pdfs
+        """
+        return sum(p*dist.pdf(x) for p, dist in zip(self.probabilities, self.dists.values()))
+
+    def cdf(self, x):
+        """
+        Evaluates the cdf as the probability weighted sum of the component cdfs
+        """
+        return sum(p*dist.cdf(x) for p, dist in zip(self.probabilities, self.dists.values()))
+
+    def cdfinv(self, rns):
+        """
+        Samples the mixture: each probability in rns selects a component from the cumulative 
+        component probabilities, and is rescaled to [0,1] and passed to that component's cdfinv.
+        The rescaling preserves the stratification of quasi-random sequences.
+        """
+        ps = np.asarray(rns.magnitude)
+        components = np.searchsorted(self.cumulative_probabilities[1:-1], ps, side='right')
+
+        units = self.avg().units
+        xs = np.empty(ps.shape)
+
+        for ii, dist in enumerate(self.dists.values()):
+
+            in_component = np.flatnonzero(components==ii)
+            if(len(in_component)==0):
+                continue
+
+            # Rescale in double precision, the probabilities may be single precision
+            us = (ps[in_component].astype(np.float64) - self.cumulative_probabilities[ii])/self.probabilities[ii]
+            np.clip(us, 0, 1, out=us)
+
+            xs[in_component] = dist.cdfinv(unit_registry.Quantity(us, 'dimensionless')).to(units).magnitude
+
+        return unit_registry.Quantity(xs, units)
+
+    def avg(self):
+        """
+        Computes the mean as the probability weighted component means
+        """
+        return sum(p*dist.avg() for p, dist in zip(self.probabilities, self.dists.values()))
+
+    def std(self):
+        """
+        Computes the standard deviation from the component means and variances (law of total variance)
+        """
+        avg = self.avg()
+        return np.sqrt(sum(p*(dist.std()**2 + (dist.avg()-avg)**2) for p, dist in zip(self.probabilities, self.dists.values())))
+
+    def rms(self):
+        """
+        Computes the rms from the component means and variances
+        """
+        return np.sqrt(self.std()**2 + self.avg()**2)
 
 class Product(Dist1d):
     
@@ -331,6 +476,12 @@ class Product(Dist1d):
         assert 'dists' in kwargs, 'ProductDist 1d must be supplied the key word argument "dists"'
         dist_defs = kwargs['dists']
 
+        if('cdf_tolerance' in kwargs):
+            self.cdf_tolerance = float(kwargs['cdf_tolerance'])
+
+        if('guide_table' in kwargs):
+            self.use_guide_table = bool(kwargs['guide_table'])
+
         dists={}
 
         min_var=0
@@ -346,18 +497,19 @@ class Product(Dist1d):
             if(xi[0] <min_var): min_var = xi[0]
             if(xi[-1]>max_var): max_var = xi[-1]
 
-        xs = linspace(min_var, max_var, 10000)
-
-        for ii, name in enumerate(dists.keys()):
+        def product_pdf(x):
+            ps = 1
+            for dist in dists.values():
+                ps = ps*dist.pdf(x)
+            return ps
 
-            pi = dists[name].pdf(xs)
+        # The range starts from 0, which may not have picked up units
+        min_var = unit_registry.Quantity(min_var, xi.units)
+        max_var = unit_registry.Quantity(max_var, xi.units)
 
-            if(ii==0):
-                ps = pi/np.max(pi.magnitude)
-            else:
-                ps = ps*pi/np.max(pi.magnitude)
+        xs, ps, cs = tabulate_pdf(product_pdf, min_var, max_var, self.cdf_tolerance)
 
-        super().__init__(xs, ps, var)
+        super().__init__(xs, ps, var, cs)
 
 
 class Uniform(Dist1d):
@@ -431,6 +583,7 @@ class Uniform(Dist1d):
         nonzero = (x >= self.xL) & (x <= self.xR)
         res = np.zeros(len(x))*unit_registry('dimensionless')
         res[nonzero]=(x[nonzero]-self.xL)/(self.xR-self.xL)
+        res[x > self.xR] = 1
        
         return res
 
@@ -761,7 +914,7 @@ class SuperGaussian(Dist1d):
         avg_str = f'avg_{var}'
 
         self.required_params=[]
-        self.optional_params=[avg_str, power_str, alpha_str, 'lambda', sigma_str, 'n_sigma_cutoff']
+        self.optional_params=[avg_str, power_str, alpha_str, 'lambda', sigma_str, 'n_sigma_cutoff', 'cdf_tolerance', 'guide_table']
         self.check_inputs(kwargs)
 
         assert not (alpha_str in kwargs and power_str in kwargs), 'SuperGaussian power parameter must be set using "p" or "alpha", not both.' 
@@ -800,6 +953,10 @@ class SuperGaussian(Dist1d):
         vprint('Super Gaussian', verbose>0, 0, True)
         vprint(f'sigma_{var} = {self.std():G~P}, power = {self.p:G~P}', verbose, 2, True)
         vprint(f'n_sigma_cutoff = {self.n_sigma_cutoff}', int(verbose>=1 and self.n_sigma_cutoff!=3), 2, True)
+
+        # The cdf and its inverse are tabulated numerically
+        xs, Px, Cx = tabulate_pdf(self.pdf, *self.get_x_pts(2), self.cdf_tolerance)
+        super().__init__(xs, Px, var, Cx)
  
     def pdf(self,x=None):  
 
@@ -824,25 +981,6 @@ class SuperGaussian(Dist1d):
             n=10000
         return self.mu + linspace(-self.n_sigma_cutoff*self.std(), +self.n_sigma_cutoff*self.std(),n)
 
-    def cdf(self,x):
-        """ Defines the CDF for the super Gaussian function """
-        xpts = self.get_x_pts(10000)
-        pdfs = self.pdf(xpts)
-        cdfs = cumtrapz(self.pdf(xpts), xpts)
-
-        cdfs = cdfs/cdfs[-1]
-
-        cdfs = interp(x, xpts, cdfs)
-        cdfs = cdfs/cdfs[-1]
-        #print(x[0],cdfs[0])
-        return cdfs
-
-    def cdfinv(self,p):
-        """ Definess the inverse of the CDF for the super Gaussian function """
-        xpts = self.get_x_pts(10000)
-        cdfs = self.cdf(xpts)
-        return interp(p,cdfs,xpts)
-    
     def avg(self):
         """ Returns the average value of x for super Gaussian """
         return self.mu
@@ -874,7 +1012,7 @@ class File1d(Dist1d):
         
 
         self.required_params = ['file','units']
-        self.optional_params = []
+        self.optional_params = ['guide_table']
         self.check_inputs(kwargs)
 
         self.xstr=var
@@ -894,7 +1032,7 @@ class File1d(Dist1d):
         #if(headers[1]!="P"+self.xstr):
         #    raise ValueError("Input distribution file pdf name must be = P"+var)    
             
-        data = np.loadtxt(self.distfile,skiprows=1)
+        data = load_cached_array(self.distfile, lambda f: np.loadtxt(f,skiprows=1))
 
         xs = data[:,0]*unit_registry(self.units)
         Px = data[:,1]*unit_registry.parse_expression("1/"+self.units)
@@ -931,7 +1069,13 @@ class TemporalLaserPulseStacking(Dist1d):
                     angles.append(params[key])
 
         for param in params:
-            assert 'crystal_angle_' in param or 'crystal_length' in param or param=='type', 'Unknown keyword parameter sent to '+self.__class__.__name__+': '+param
+            assert 'crystal_angle_' in param or 'crystal_length' in param or param in ['type', 'cdf_tolerance', 'guide_table'], 'Unknown keyword parameter sent to '+self.__class__.__name__+': '+param
+
+        if('cdf_tolerance' in params):
+            self.cdf_tolerance = float(params['cdf_tolerance'])
+
+        if('guide_table' in params):
+            self.use_guide_table = bool(params['guide_table'])
                     
         if(dv is None and "dv" not in params):
             dv=1.05319*unit_registry("ps/mm")
@@ -958,9 +1102,7 @@ class TemporalLaserPulseStacking(Dist1d):
         self.set_crystals(lengths,angles);
         self.propagate_pulses();
 
-        self.ts = self.get_t_pts(10000)
         self.set_pdf()
-        self.set_cdf()
 
     def set_crystals(self, lengths, angles):
 
@@ -1054,24 +1196,39 @@ class TemporalLaserPulseStacking(Dist1d):
     def get_x_pts(self, n):
         return self.get_t_pts(n)
 
-    def set_pdf(self):
+    def intensity(self, t):
 
         """ Evaluates the sech fields and computes the square of the 
-        fields for intenstity in order to set the distribution """
+        fields for the (unnormalized) intensity at times t.  The real and imaginary
+        parts of the fields (see evaluate_sech_fields) are summed as complex phasors """
+
+        t = t.to('ps').magnitude
+        w0 = self.w0.to('1/ps').magnitude
+        w = (2*np.arccosh(np.sqrt(2))/self.laser_pulse_FWHM).to('1/ps').magnitude
+
+        intensity = np.zeros(len(t))
+
+        for axis_angle in [0.5*pi, 0.0]:
 
-        ex=np.zeros((2,len(self.ts)))*unit_registry("")
-        ey=np.zeros((2,len(self.ts)))*unit_registry("")
+            field = np.zeros(len(t), dtype=complex)
 
-        for pulse in self.pulses: 
-            self.evaluate_sech_fields(0.5*pi,pulse,self.ts,ex);
-            self.evaluate_sech_fields(0.0,   pulse,self.ts,ey);
+            for pulse in self.pulses:
+                normalization = float(pulse["intensity"]*np.cos(pulse["polarization_angle"] - axis_angle))
+                dt = t - unit_registry.Quantity(pulse["relative_delay"], 'ps').magnitude
+                field += normalization*np.exp(1j*w0*dt)/np.cosh(w*dt)
 
-        self.Pt = ( (ex[0,:]**2 + ex[1,:]**2) + (ey[0,:]**2 + ey[1,:]**2) ).magnitude * unit_registry("THz")
-        self.Pt = self.Pt/trapz(self.Pt,self.ts)
+            intensity += field.real**2 + field.imag**2
 
-    def set_cdf(self):
-        """ Computes the CDF of the distribution """
-        self.Ct = cumtrapz(self.Pt, self.ts)
+        return intensity*unit_registry("THz")
+
+    def set_pdf(self):
+
+        """ Adaptively tabulates the intensity to set the distribution and its CDF """
+
+        self.ts, self.Pt, self.Ct = tabulate_pdf(self.intensity, self.t_min, self.t_max, self.cdf_tolerance)
+
+        if(self.use_guide_table):
+            self.guide = guide_table(self.Ct)
 
     def pdf(self, t):
         """ Returns the PDF at the values in t """
@@ -1083,15 +1240,17 @@ class TemporalLaserPulseStacking(Dist1d):
 
     def cdfinv(self, rns):
         """ Computes the inverse of the CDF at probabilities rns """
+        if(self.guide is not None):
+            return guide_interp(rns*unit_registry(''),self.Ct,self.ts,self.guide)
         return interp(rns*unit_registry(''),self.Ct,self.ts)
 
     def avg(self):
         """ Computes the expectation value of t of the distribution """
-        return trapz(self.ts*self.Pt,self.ts)
+        return simpson(self.ts*self.Pt,self.ts)
 
     def std(self):
         """ Computes the sigma of the PDF """
-        return np.sqrt(trapz(self.ts*self.ts*self.Pt,self.ts))
+        return np.sqrt(simpson(self.ts*self.ts*self.Pt,self.ts))
 
     #def get_params_list(self,var):
      #   """ Returns the crystal parameter list"""
@@ -1106,7 +1265,7 @@ class Tukey(Dist1d):
         self.xstr = var
          
         self.required_params = ['ratio','length']
-        self.optional_params = []
+        self.optional_params = ['cdf_tolerance', 'guide_table']
         self.check_inputs(kwargs)
             
         self.r = kwargs['ratio']
@@ -1114,6 +1273,10 @@ class Tukey(Dist1d):
 
         vprint('Tukey',verbose>0,0,True)
         vprint(f'length = {self.L:G~P}, ratio = {self.r:G~P}',verbose>0,2,True)
+
+        # The cdf, its inverse, and the moments are computed from the adaptively tabulated pdf
+        xs, Px, Cx = tabulate_pdf(self.pdf, -self.L/2.0, self.L/2.0, self.cdf_tolerance)
+        super().__init__(xs, Px, var, Cx)
             
     def get_x_pts(self,n):
         return 1.1*linspace(-self.L/2.0,self.L/2.0,n)
@@ -1139,35 +1302,8 @@ class Tukey(Dist1d):
 
             res[x<-self.L]=0*unit_registry('1/'+str(self.L.units))
         
-        return res/trapz(res,x)
-
-    def cdf(self, x):
-        xpts = self.get_x_pts(10000)
-        pdfs = self.pdf(xpts)
-        cdfs = cumtrapz(self.pdf(xpts), xpts)
-        cdfs = cdfs/cdfs[-1]
-        cdfs = interp(x,xpts,cdfs)
-        cdfs = cdfs/cdfs[-1]
-        return cdfs
-
-    def cdfinv(self, p):
-        xpts = self.get_x_pts(10000)
-        cdfs = self.cdf(xpts)
-        return interp(p,cdfs,xpts)
-    
-    def avg(self):
-        xpts = self.get_x_pts(10000)
-        return trapz(self.pdf(xpts)*xpts,xpts)
-
-    def std(self):
-        xpts = self.get_x_pts(10000)
-        avgx=self.avg()
-        return np.sqrt(trapz(self.pdf(xpts)*(xpts-avgx)*(xpts-avgx),xpts))
-
-    def rms(self):
-        avg=self.avg()
-        std=self.std()
-        return np.sqrt(std*std + avg*avg)
+        # The flat top integrates to 1-r, and the two cosine tapers to r/2
+        return res/(1-self.r/2.0)
 
 
 class Deformable(Dist1d):
@@ -1180,7 +1316,7 @@ class Deformable(Dist1d):
         avgstr = f'avg_{var}'
          
         self.required_params = ['slope_fraction', 'alpha', sigstr, avgstr]
-        self.optional_params = ['n_sigma_cutoff']
+        self.optional_params = ['n_sigma_cutoff', 'cdf_tolerance', 'guide_table']
 
         self.check_inputs(kwargs)
 
@@ -1200,29 +1336,23 @@ class Deformable(Dist1d):
         self.dist['super_gaussian'] = SuperGaussian(var, verbose=verbose, **sg_params)
 
         # SG
-        xs = self.dist['super_gaussian'].get_x_pts(10000)
-        Px = self.dist['super_gaussian'].pdf(xs)
+        xL, xR = self.dist['super_gaussian'].get_x_pts(2)
 
         # Linear
 
-        lin_params={'slope_fraction':kwargs['slope_fraction'], f'min_{var}':xs[0], f'max_{var}':xs[-1]}
+        lin_params={'slope_fraction':kwargs['slope_fraction'], f'min_{var}':xL, f'max_{var}':xR}
         self.dist['linear'] = Linear(var, verbose=verbose, **lin_params)
 
-        Px = Px*self.dist['linear'].pdf(xs)
-
+        xs, Px, Cx = tabulate_pdf(lambda x: self.dist['super_gaussian'].pdf(x)*self.dist['linear'].pdf(x), xL, xR, self.cdf_tolerance)
 
-        norm = np.trapz(Px, xs)
-        assert norm > 0, 'Error: derformable distribution can not be normalized.'
-        Px = Px/norm
-
-        avgx = np.trapz(xs*Px, xs)
-        stdx = np.sqrt(np.trapz( Px*(xs-avgx)**2, xs))
+        avgx = simpson(xs*Px, xs)
+        stdx = np.sqrt(simpson( Px*(xs-avgx)**2, xs))
 
         #print(avgx, stdx)
 
         xs = self.mean + (self.sigma/stdx)*(xs-avgx)
 
-        super().__init__(xs=xs, Px=Px, xstr=var)
+        super().__init__(xs=xs, Px=Px, xstr=var, Cx=Cx)
 
     def std(self):
         return self.sigma
@@ -1247,6 +1377,7 @@ class DistTheta(Dist):
 
     def plot_pdf(self, n=1000):
 
+        plt = pyplot()
         theta =self.get_theta_pts(n)
         
         p=self.pdf(theta)
@@ -1314,18 +1445,39 @@ class UniformTheta(DistTheta):
 
 class DistRad(Dist):
 
-    def __init__(self, rs, Pr):
+    adaptive = False
+    guide = None
+
+    def __init__(self, rs, Pr, Cr=None):
+
+        """
+        Sets the radial distribution from rho(r) = Pr tabulated at rs.  If the cdf Cr is given, 
+        the table is from tabulate_pdf (of r*rho(r)) and the cdf is known at the points rs themselves.
+        With use_guide_table, the cdf is inverted using a guide table.
+        """
 
         self.rs = rs
         self.Pr = Pr
+        self.adaptive = Cr is not None
         #self.rb =  centers(rs)
 
-        norm = radint(self.Pr, self.rs)
+        if(self.adaptive):
+            norm = simpson(self.rs*self.Pr, self.rs)
+        else:
+            norm = radint(self.Pr, self.rs)
+
         if(norm<=0):
             raise ValueError('Normalization of PDF was <= 0')
        
         self.Pr = self.Pr/norm
-        self.Cr, self.rb = radcumint(self.Pr, self.rs)
+
+        if(self.adaptive):
+            self.Cr, self.rb = Cr, self.rs
+        else:
+            self.Cr, self.rb = radcumint(self.Pr, self.rs)
+
+        if(self.use_guide_table):
+            self.guide = guide_table(self.Cr)
         
     def get_r_pts(self, n):
         return linspace(self.rs[0], self.rs[-1], n)
@@ -1337,11 +1489,24 @@ class DistRad(Dist):
         return interp(r, self.rs, self.rs*self.Pr)
 
     def cdf(self, r):
+        if(self.adaptive):
+            return interp(r, self.rs, self.Cr)
         return interp(r**2, self.rb**2, self.Cr)
 
     def cdfinv(self, rns):
 
+        if(self.adaptive):
+            # The adaptive table is accurate for linear interpolation of the cdf in r
+            if(self.guide is not None):
+                return guide_interp(np.squeeze(rns), self.Cr, self.rs, self.guide)
+            return interp(np.squeeze(rns), self.Cr, self.rs)
+
         rns=np.squeeze(rns)
+
+        if(self.guide is not None):
+            # The cdf is linear in r^2 on each bin
+            return np.sqrt(guide_interp(rns, self.Cr, self.rb**2, self.guide))
+
         indsL = np.searchsorted(self.Cr,rns)-1
         indsH = indsL+1
 
@@ -1366,6 +1531,7 @@ class DistRad(Dist):
 
     def plot_pdf(self,n=1000):
 
+        plt = pyplot()
         r=self.get_r_pts(n)
         p = self.rho(r)
         P = self.pdf(r)
@@ -1383,6 +1549,7 @@ class DistRad(Dist):
 
     def plot_cdf(self, n=1000, ax=None):
  
+        plt = pyplot()
         if(ax is None):
             plt.figure()
             ax = plt.gca() 
@@ -1394,9 +1561,13 @@ class DistRad(Dist):
         ax.set_ylabel('CDF$(r)$')
 
     def avg(self):
+        if(self.adaptive):
+            return simpson(self.rs**2*self.Pr, self.rs)
         return np.sum( ((self.rb[1:]**3 - self.rb[:-1]**3)/3.0)*self.Pr ) 
 
     def rms(self):
+        if(self.adaptive):
+            return np.sqrt( simpson(self.rs**3*self.Pr, self.rs) )
         return np.sqrt( np.sum( ((self.rb[1:]**4 - self.rb[:-1]**4)/4.0)*self.Pr ) )
 
     def std(self):
@@ -1406,6 +1577,7 @@ class DistRad(Dist):
 
     def test_sampling(self,ax=None):
      
+        plt = pyplot()
         if(ax is None):
             plt.figure()
             ax = plt.gca()
@@ -1521,7 +1693,7 @@ class LinearRad(DistRad):
         rb_str = f'max_r'
 
         self.required_params = ['slope_fraction', ra_str, rb_str]
-        self.optional_params = []
+        self.optional_params = ['cdf_tolerance', 'guide_table']
 
         self.check_inputs(kwargs)
 
@@ -1551,6 +1723,10 @@ class LinearRad(DistRad):
 
         vprint('LinearRad',verbose>0,0,True)
 
+        # The inverse cdf and moments are computed from the adaptively tabulated pdf
+        rs, _, Cr = tabulate_pdf(self.pdf, self.a, self.b, self.cdf_tolerance)
+        super().__init__(rs, self.rho(rs), Cr)
+
     def get_r_pts(self, n, f=0.2):
         return np.linspace(self.a*(1-f), self.b*(1+f), n) 
 
@@ -1580,21 +1756,6 @@ class LinearRad(DistRad):
         res[nonzero] = self.norm()*(  self.m*dr3 - self.m*self.a*dr2 + self.pa*dr2 )
         return res
 
-    def cdfinv(self, p):
-        rpts = self.get_r_pts(10000, f=0)
-        cdfs = self.cdf(rpts)
-        return interp(p, cdfs, rpts)
-
-    def avg(self):
-        rpts = self.get_r_pts(10000, f=0)
-        pdfs = self.rho(rpts)
-        return radint(pdfs*rpts,rpts)
-
-    def rms(self):
-        rpts = self.get_r_pts(10000, f=0)
-        pdfs = self.rho(rpts)
-        return np.sqrt(radint(pdfs*rpts*rpts,rpts))
-
 
 
 class NormRad(DistRad):
@@ -1738,7 +1899,7 @@ class RadFile(DistRad):
     def __init__(self, verbose=0, **params):
 
         self.required_params=['file','units']
-        self.optional_params=[]
+        self.optional_params=['guide_table']
         self.check_inputs(params)
         
         distfile = params["file"]
@@ -1751,7 +1912,7 @@ class RadFile(DistRad):
 
         if(len(headers)!=2):
             raise ValueError("radial distribution file must have two columns")
-        data = np.loadtxt(distfile,skiprows=1)
+        data = load_cached_array(distfile, lambda f: np.loadtxt(f,skiprows=1))
 
         rs = data[:,0]*unit_registry(units)
         Pr = data[:,1]*unit_registry.parse_expression("1/"+units+"/"+units)
@@ -1769,7 +1930,7 @@ class TukeyRad(DistRad):
     def __init__(self, verbose=0, **kwargs):
 
         self.required_params=['ratio','length']
-        self.optional_params=[]
+        self.optional_params=['cdf_tolerance', 'guide_table']
         self.check_inputs(kwargs)
          
         self.r = kwargs['ratio']
@@ -1778,6 +1939,10 @@ class TukeyRad(DistRad):
         vprint("TukeyRad",verbose>0,0,True)
         vprint("legnth = {:0.3f~P}".format(self.L)+", ratio = {:0.3f~P}".format(self.r),verbose>0,2,True)
 
+        # The cdf, its inverse, and the moments are computed from the adaptively tabulated pdf
+        rs, _, Cr = tabulate_pdf(self.pdf, 0*self.L, self.L, self.cdf_tolerance)
+        super().__init__(rs, self.rho(rs), Cr)
+
     def get_r_pts(self, n=1000, f=0.2):
         return np.linspace(0, (1+f)*self.L.magnitude, n)*unit_registry(str(self.L.units))
 
@@ -1786,54 +1951,25 @@ class TukeyRad(DistRad):
 
     def rho(self, r):
 
-        ustr = '1/'+str(self.L.units)+"/"+str(self.L.units)
+        res = np.zeros(r.shape)*unit_registry('dimensionless')
 
-        res = np.zeros(r.shape)*unit_registry(ustr)
+        Lflat = self.L*(1-self.r)
+        Lcos = self.r*self.L
 
         if(self.r==0):
-           flat_region = np.logical_and(r <= self.L, x >= 0.0)
-           res[flat_region]=1.0*unit_registry(ustr)
+           flat_region = np.logical_and(r <= self.L, r >= 0.0)
+           res[flat_region]=1.0*unit_registry('dimensionless')
        
         else:
             
-            Lflat = self.L*(1-self.r)
-            Lcos = self.r*self.L
             cos_region = np.logical_and(r >= +Lflat, r <=+self.L)
             flat_region = np.logical_and(r < Lflat, r >= 0)
-            res[cos_region]=0.5*(1+np.cos( (pi/Lcos)*(r[cos_region]-Lflat) ))*unit_registry(ustr)
-            res[flat_region]=1.0*unit_registry(ustr)
+            res[cos_region]=0.5*(1+np.cos( (pi/Lcos)*(r[cos_region]-Lflat) ))
+            res[flat_region]=1.0*unit_registry('dimensionless')
         
-        res = res
-        res = res/radint(res, r)
-        return res
-   
-
-    def cdf(self, r):
-        rpts = self.get_r_pts(10000)
-        pdfs = self.rho(rpts)
-        
-        cdfs,rbins = radcumint(pdfs, rpts)
-        cdfs = cdfs/cdfs[-1]
-        cdfs = interp(r,rbins,cdfs)
-        cdfs = cdfs/cdfs[-1]
-        cdfs*unit_registry('dimensionless')
-
-        return cdfs
-
-    def cdfinv(self, p):
-        rpts = self.get_r_pts(10000)
-        cdfs = self.cdf(rpts)
-        return interp(p, cdfs, rpts)
-
-    def avg(self):
-        rpts = self.get_r_pts(10000)
-        pdfs = self.rho(rpts)
-        return radint(pdfs*rpts, rpts)
-
-    def rms(self):
-        rpts = self.get_r_pts(10000)
-        pdfs = self.rho(rpts)
-        return np.sqrt(radint(pdfs*rpts*rpts, rpts))
+        # Normalize with integral[ rho(r) r dr ] [length^2], the flat top gives Lflat^2/2 and the cosine taper the rest
+        norm = (Lflat**2/2.0 + Lcos**2/4.0 + Lflat*Lcos/2.0 - Lcos**2/pi**2).to(self.L.units**2)
+        return res/norm
 
 
 class SuperGaussianRad(DistRad):
@@ -1841,7 +1977,7 @@ class SuperGaussianRad(DistRad):
     def __init__(self, verbose=0, **kwargs):
 
         self.required_params=[]
-        self.optional_params=['p', 'alpha', 'lambda', 'sigma_xy']
+        self.optional_params=['p', 'alpha', 'lambda', 'sigma_xy', 'cdf_tolerance', 'guide_table']
         self.check_inputs(kwargs)
 
         assert not ('alpha' in kwargs and 'p' in kwargs), 'Radial Super Gaussian power parameter must be set using "p" or "alpha", not both.' 
@@ -1870,6 +2006,10 @@ class SuperGaussianRad(DistRad):
         vprint('SuperGaussianRad',verbose>0,0,True)
         vprint(f'lambda = {self.Lambda:G~P}, power = {self.p:G~P}',verbose>0,2,True)
 
+        # The cdf and its inverse are tabulated numerically
+        rs, _, Cr = tabulate_pdf(self.pdf, *self.get_r_pts(2), self.cdf_tolerance)
+        super().__init__(rs, self.rho(rs), Cr)
+
     def get_r_pts(self, n=1000):
         
         if(self.p < float('Inf')):
@@ -1890,24 +2030,6 @@ class SuperGaussianRad(DistRad):
         N = (1.0/gamma(1+1.0/self.p)/self.Lambda**2)
         rho = N*np.exp(-np.float_power(nur.magnitude,self.p.magnitude))
         return rho
-   
-
-    def cdf(self, r):
-        rpts = self.get_r_pts(10000)
-        pdfs = self.rho(rpts)
-        
-        cdfs,rbins = radcumint(pdfs,rpts)
-        cdfs = cdfs/cdfs[-1]
-        cdfs = interp(r,rbins,cdfs)
-        cdfs = cdfs/cdfs[-1]
-        cdfs*unit_registry('dimensionless')
-
-        return cdfs
-
-    def cdfinv(self, p):
-        rpts = self.get_r_pts(10000)
-        cdfs = self.cdf(rpts)
-        return interp(p,cdfs,rpts)
 
     def avg(self):
         return (2.0*np.sqrt(2.0)/3.0)*(gamma(1+3.0/2.0/self.p)/gamma(1+1.0/self.p))*self.Lambda
@@ -1929,7 +2051,7 @@ class DeformableRad(DistRad):
         #avgstr = f'avg_{var}'
          
         self.required_params = ['slope_fraction', 'alpha', sigstr]
-        self.optional_params = []#['n_sigma_cutoff']
+        self.optional_params = ['cdf_tolerance', 'guide_table']#['n_sigma_cutoff']
 
         self.check_inputs(kwargs)
 
@@ -1948,24 +2070,26 @@ class DeformableRad(DistRad):
         self.dist['super_gaussian'] = SuperGaussianRad(verbose=verbose, **sg_params)
 
         # SG
-        rs = self.dist['super_gaussian'].get_r_pts(10000)
-        Pr = self.dist['super_gaussian'].rho(rs)
+        rL, rR = self.dist['super_gaussian'].get_r_pts(2)
 
         # Linear
-        lin_params={'slope_fraction':kwargs['slope_fraction'], f'min_r':rs[0], f'max_r':rs[-1]}
+        lin_params={'slope_fraction':kwargs['slope_fraction'], f'min_r':rL, f'max_r':rR}
         self.dist['linear'] = LinearRad(verbose=verbose, **lin_params)
 
-        Pr = Pr*self.dist['linear'].rho(rs)
+        rho = lambda r: self.dist['super_gaussian'].rho(r)*self.dist['linear'].rho(r)
+
+        rs, _, Cr = tabulate_pdf(lambda r: r*rho(r), rL, rR, self.cdf_tolerance)
+        Pr = rho(rs)
 
-        norm = radint(Pr, rs)
+        norm = simpson(rs*Pr, rs)
         assert norm > 0, 'Error: derformable distribution can not be normalized.'
         Pr = Pr/norm
 
         #avgx = np.trapz(xs*Px, xs)
-        stdx = np.sqrt( radint( Pr*rs**2, rs) )/np.sqrt(2)
+        stdx = np.sqrt( simpson( Pr*rs**3, rs) )/np.sqrt(2)
         rs = (self.sigma/stdx)*rs
 
-        super().__init__(rs=rs, Pr=Pr)
+        super().__init__(rs=rs, Pr=Pr, Cr=Cr)
 
     def rms(self):
         return np.sqrt(2)*self.sigma
@@ -1981,6 +2105,14 @@ class DeformableRad(DistRad):
 class Dist2d(Dist):
 
 
+    """
+    Defines the base class for 2d distributions from an image Pxy tabulated at [xs, ys].  Samples x from 
+    the marginal cdf, then y from the cdf of the sampled column.  Only the columns with nonzero probability 
+    are stored, with precision set by cdf_dtype.
+    """
+
+    cdf_dtype = 'float64'
+
     def __init__(self, xs=None, ys=None, Pxy=None, xstr='x', ystr='y', x_unit='', y_unit='', verbose=False):
 
         if(not isinstance(xs, Quantity)):
@@ -1990,7 +2122,7 @@ class Dist2d(Dist):
             ys = ys*unit_registry(y_unit)
 
         if(not isinstance(Pxy, Quantity)):
-            Pxy = Pxy*unit_registry(f'1/{x_unit}/{y_unit}')
+            Pxy = unit_registry.Quantity(Pxy, f'1/{x_unit}/{y_unit}')
 
         self.xs=xs
         self.ys=ys
@@ -2022,25 +2154,34 @@ class Dist2d(Dist):
         self.dx = self.xb[1:]-self.xb[:-1] 
         self.dy = self.yb[1:]-self.yb[:-1] 
 
-        self.Px = np.matmul(np.transpose(Pxy.magnitude),self.dy.magnitude)*unit_registry("1/"+str(self.ys.units))
+        norms = np.matmul(self.dy.magnitude, Pxy.magnitude)
+
+        self.Px = norms*unit_registry("1/"+str(self.ys.units))
         self.Px = self.Px/np.sum(self.Px*self.dx)
         
         self.Cx = np.zeros(len(self.xb))*unit_registry("dimensionless")
         self.Cx[1:] = np.cumsum(self.Px*self.dx)
 
-        # Get cumulative distributions along y as a function of x:
-        self.Cys=np.zeros((len(self.yb),len(self.xs)))
+        # Get cumulative distributions along y for the columns x with nonzero probability.
+        # Columns are integrated in blocks, so temporaries stay small for large images:
+        self.columns = np.flatnonzero(norms>0)
+        self.Cys = np.zeros((len(self.yb),len(self.columns)), dtype=self.cdf_dtype)
+
+        block_size = max(1, 1048576//len(self.yb))
 
-        norms = np.sum(np.multiply(self.Pxy.magnitude,np.transpose(mlib.repmat(self.dy.magnitude,len(self.xs),1))), axis=0)
-        norms[norms==0] = 1
+        for start in range(0, len(self.columns), block_size):
 
-        self.Cys[1:,:] = np.cumsum(np.multiply(self.Pxy.magnitude,np.transpose(mlib.repmat(self.dy.magnitude,len(self.xs),1))),axis=0)/norms
-        self.Cys=self.Cys*unit_registry("dimensionless")
+            Cy = np.multiply(Pxy.magnitude[:, self.columns[start:start+block_size]], self.dy.magnitude[:,np.newaxis])
+            np.cumsum(Cy, axis=0, out=Cy)
+            Cy /= Cy[-1]
+
+            self.Cys[1:, start:start+block_size] = Cy
 
     def pdf(self, x, sy):
         pass
    
     def plot_pdf(self):
+        plt = pyplot()
         plt.figure()
         extent = [(self.xs.min()).magnitude,(self.xs.max()).magnitude,(self.ys.min()).magnitude,(self.ys.max()).magnitude]
         plt.imshow(self.Pxy,extent=extent)
@@ -2051,6 +2192,7 @@ class Dist2d(Dist):
         return interp(x,self.xs,self.Px)
 
     def plot_pdfx(self):
+        plt = pyplot()
         plt.figure()
         plt.plot(self.xs,self.Px)
 
@@ -2058,6 +2200,7 @@ class Dist2d(Dist):
         return interp(x,self.xb,self.Cx)
 
     def plot_cdfx(self):
+        plt = pyplot()
         plt.figure()
         plt.plot(self.xb,self.Cx)    
 
@@ -2065,8 +2208,9 @@ class Dist2d(Dist):
         return interp(ps,self.Cx,self.xb)
 
     def plot_cdfys(self):
+        plt = pyplot()
         plt.figure()
-        for ii in range(len(self.xs)):
+        for ii in range(len(self.columns)):
             plt.plot(self.yb,self.Cys[:,ii])    
 
     def sample(self, N, sequence=None, params=None):
@@ -2078,16 +2222,24 @@ class Dist2d(Dist):
 
         x = self.cdfxinv(rnxs)
         indx = np.searchsorted(self.xb,x)-1
-        
-        y = np.zeros(x.shape)*unit_registry(str(x.units))
-        for ii in range(self.Cys.shape[1]):
-            in_column = (ii==indx)
-            if(np.count_nonzero(in_column)>0):
-                y[in_column] = interp(rnys[in_column],self.Cys[:,ii],self.yb)
 
-        return (x, y)
+        # Index of each sample's column in Cys, grouping the samples by column
+        cols = np.clip(np.searchsorted(self.columns, indx), 0, len(self.columns)-1)
+        order = np.argsort(cols, kind='stable')
+        bounds = np.searchsorted(cols, np.arange(len(self.columns)+1), sorter=order)
+
+        ps = np.asarray(rnys.magnitude)
+        yb = self.yb.magnitude
+        y = np.zeros(x.shape)
+
+        for ii in np.flatnonzero(bounds[1:]>bounds[:-1]):
+            in_column = order[bounds[ii]:bounds[ii+1]]
+            y[in_column] = np.interp(ps[in_column], self.Cys[:,ii], yb)
+
+        return (x, unit_registry.Quantity(y, self.yb.units))
 
     def test_sampling(self):
+        plt = pyplot()
         x,y = self.sample(100000,sequence="hammersley") 
         plt.figure()
         plt.plot(x, y, '*')
@@ -2105,7 +2257,7 @@ class Image2d(Dist2d):
         v2 = vstrs[1]
 
         self.required_params=['P']
-        self.optional_params=[f'min_{v1}',  f'max_{v1}', f'min_{v2}',  f'max_{v2}', v1, v2]
+        self.optional_params=[f'min_{v1}',  f'max_{v1}', f'min_{v2}',  f'max_{v2}', v1, v2, 'cdf_dtype']
     
         self.check_inputs(params)
 
@@ -2145,7 +2297,7 @@ class File2d(Dist2d):
     def __init__(self, var1, var2, verbose, **params):
 
         self.required_params=['file']
-        self.optional_params=[f'min_{var1}',  f'max_{var1}', f'min_{var2}',  f'max_{var2}', var1, var2, 'threshold', 'invert']
+        self.optional_params=[f'min_{var1}',  f'max_{var1}', f'min_{var2}',  f'max_{var2}', var1, var2, 'threshold', 'invert', 'cdf_dtype']
 
         self.check_inputs(params)
 
@@ -2153,9 +2305,23 @@ class File2d(Dist2d):
 
         ext = (os.path.splitext(filename)[1]).lower()
 
+        invert = 'invert' in params and params['invert']
+
+        if('threshold' in params):
+            threshold=params['threshold']
+        else:
+            threshold=0
+
+        assert threshold>=0 and threshold<1, 'Error: image threshold must be >=0 and < 1.'
+
         if(ext in ['.png', '.jpg', '.jpeg', '.tiff','.jfif']):
 
-            Pxy  = read_image_file(filename)
+            # Decoding, greyscale conversion and thresholding are cached together in a .npy sidecar, 
+            # in single precision (ample for 8 and 16 bit images), which halves its size
+            preprocess = {'flipud':True, 'invert':bool(invert), 'threshold':float(threshold), 'dtype':'float32'}
+            Pxy = load_cached_array(filename, 
+                lambda f: threshold_image(np.flipud(read_image_file(f)), threshold=threshold, invert=invert).astype(np.float32), 
+                options=preprocess)
 
             xstr = var1
             ystr = var2
@@ -2182,30 +2348,15 @@ class File2d(Dist2d):
 
             ys = linspace(min_var2, max_var2, Pxy.shape[0])
 
-            Pxy = np.flipud(Pxy)
-            Pxy = Pxy*unit_registry(f'1/{str(xs.units)}/{str(ys.units)}')
-
-            super().__init__(xs, ys, Pxy, xstr=xstr, ystr=ystr)
+            Pxy = unit_registry.Quantity(Pxy, f'1/{str(xs.units)}/{str(ys.units)}')
 
         elif(ext=='.txt'):
         
             xs, ys, Pxy, xstr, ystr = read_2d_file(filename)
+            Pxy = threshold_image(Pxy.magnitude, threshold=threshold, invert=invert)*Pxy.units
 
         else:
             raise ValueError(f'Error: unknown file extension: "{ext}" for filename = {filename}')
-    
-        if('invert' in params and params['invert']):
-            Pxy = Pxy.max() - Pxy
-
-        if('threshold' in params):
-            threshold=params['threshold']
-        else:
-            threshold=0
-
-        assert threshold>=0 and threshold<1, 'Error: image threshold must be >=0 and < 1.'
-
-        under_threshold = Pxy.magnitude < threshold*Pxy.magnitude.max()
-        Pxy.magnitude[under_threshold]=0
 
         super().__init__(xs, ys, Pxy, xstr=xstr, ystr=ystr)
 
@@ -2214,6 +2365,255 @@ class File2d(Dist2d):
         vprint(f'min_{var1} = {min(xs):G~P}, max_{var1} = {max(xs):G~P}', verbose>0, 2, True)
         vprint(f'min_{var2} = {min(ys):G~P}, max_{var2} = {max(ys):G~P}', verbose>0, 2, True)
 
+
+
+class HistNd(Dist):
+
+    """
+    Defines an N dimensional distribution of the coordinates in variables (e.g. 'xpxypy') from a histogram 
+    of counts, loaded from a .npy or HDF5 file.  Only the nonzero bins are stored, with their flattened cdf.  
+    The first probability of each particle selects a bin from the flattened cdf, and its remainder within 
+    the bin, together with the other probabilities, places the particle uniformly inside the bin.
+    """
+
+    def __init__(self, variables, verbose=0, **params):
+
+        self.variables = get_vars(variables)
+        assert self.variables is not None, f'Error in HistNd: could not determine the histogram variables from "{variables}".'
+        assert len(set(self.variables))==len(self.variables), f'Error in HistNd: repeated variable in "{variables}".'
+
+        self.required_params=['file']
+        self.optional_params=['dataset', 'guide_table'] + [f'min_{var}' for var in self.variables] + [f'max_{var}' for var in self.variables]
+        self.check_inputs(params)
+
+        super().__init__()
+
+        self.histfile = params['file']
+        ext = (os.path.splitext(self.histfile)[1]).lower()
+
+        if(ext=='.npy'):
+            hist, edges = np.load(self.histfile, mmap_mode='r'), {}
+        elif(ext in ['.h5', '.hdf5']):
+            hist, edges = read_histogram_h5(self.histfile, params.get('dataset', 'P'), self.variables)
+        else:
+            raise ValueError(f'Error: unknown file extension: "{ext}" for filename = {self.histfile}')
+
+        assert hist.ndim==len(self.variables), f'Error in HistNd: histogram has {hist.ndim} dimensions for {len(self.variables)} variables.'
+        self.shape = hist.shape
+
+        # Bin edges from the user, or from the file
+        self.edges = []
+        for ii, var in enumerate(self.variables):
+
+            if(f'min_{var}' in params or f'max_{var}' in params):
+
+                assert f'min_{var}' in params, f'Error in HistNd: user must specify min_{var}.'
+                assert f'max_{var}' in params, f'Error in HistNd: user must specify max_{var}.'
+
+                vmin = params[f'min_{var}']
+                vmax = params[f'max_{var}'].to(vmin.units)
+
+                assert vmin<vmax, f'Error in HistNd: min {var} must < max {var}.'
+                self.edges.append(linspace(vmin, vmax, self.shape[ii]+1))
+
+            else:
+                assert var in edges, f'Error in HistNd: user must specify min_{var} and max_{var}, or supply {var}_edges in an HDF5 file.'
+                assert len(edges[var])==self.shape[ii]+1, f'Error in HistNd: {var}_edges must have {self.shape[ii]+1} values.'
+                self.edges.append(edges[var])
+
+        # Store only the nonzero bins, by flat index, with their cumulative probabilities
+        self.bins = np.flatnonzero(hist)
+        assert len(self.bins)>0, 'Supplied histogram is zero everywhere.'
+
+        counts = np.asarray(hist).reshape(-1)[self.bins].astype(np.float64)
+        assert np.min(counts) > 0, 'Error in HistNd: histogram counts must be >= 0.'
+        del hist
+
+        Cb = np.zeros(len(self.bins)+1)
+        np.cumsum(counts, out=Cb[1:])
+        self.Cb = unit_registry.Quantity(Cb/Cb[-1], 'dimensionless')
+
+        self.guide = guide_table(self.Cb) if self.use_guide_table else None
+
+        vprint(f'{len(self.variables)}D histogram PDF', verbose>0, 0, True)
+        vprint(f'histogram file: {self.histfile}', verbose>0, 2, True)
+        vprint(f'{len(self.bins)} nonzero bins of {np.prod(self.shape)}', verbose>0, 2, True)
+
+    def cdfinv(self, *rns):
+
+        """
+        Evaluates the coordinates from the probabilities rns, one per variable.  
+        Returns the coordinates in the order of the variables.
+        """
+
+        assert len(rns)==len(self.variables), f'HistNd requires {len(self.variables)} sets of probabilities.'
+
+        # Fractional position of the first probability in the flattened cdf: the bin and the position inside it
+        positions = unit_registry.Quantity(np.arange(len(self.bins)+1, dtype=np.float64), 'dimensionless')
+
+        if(self.guide is not None):
+            position = guide_interp(rns[0], self.Cb, positions, self.guide).magnitude
+        else:
+            position = interp(rns[0], self.Cb, positions).magnitude
+
+        inds = np.minimum(position.astype(np.intp), len(self.bins)-1)
+        fractions = [position - inds] + [np.asarray(rn.magnitude) for rn in rns[1:]]
+        del position
+
+        # Unravel the flat bin index from the fastest varying variable
+        bins = self.bins[inds]
+        del inds
+
+        coordinates = [None]*len(self.variables)
+
+        for ii in reversed(range(len(self.variables))):
+
+            inds = bins % self.shape[ii]
+            bins //= self.shape[ii]
+
+            edges = self.edges[ii].magnitude
+            left = edges[inds]
+
+            coordinates[ii] = unit_registry.Quantity(left + fractions[ii]*(edges[inds+1]-left), self.edges[ii].units)
+
+        return tuple(coordinates)
+
+    def sample(self, N, sequence=None, params=None):
+        rns = random_generator((len(self.variables),N), sequence, params)*unit_registry("dimensionless")
+        return self.cdfinv(*rns)
+
+
+
+class Particles(Dist):
+
+    """
+    Defines the joint distribution of the coordinates in variables (e.g. 'xpxypy') by kernel density 
+    resampling of the particles in an openPMD-beamphysics file.  Each new particle copies a parent, selected 
+    with probability proportional to its weight, and adds a Gaussian jitter with the covariance of the 
+    parent's nearest neighbors (found in coordinates whitened by the beam covariance), times bandwidth**2.
+    """
+
+    units = {'x':'m', 'y':'m', 'z':'m', 'px':'eV/c', 'py':'eV/c', 'pz':'eV/c', 't':'s'}
+
+    def __init__(self, variables, verbose=0, **params):
+
+        from pmd_beamphysics import ParticleGroup
+        from scipy.spatial import cKDTree
+
+        self.variables = get_vars(variables)
+        assert self.variables is not None, f'Error in Particles: could not determine the coordinates from "{variables}".'
+        assert len(set(self.variables))==len(self.variables), f'Error in Particles: repeated coordinate in "{variables}".'
+
+        self.required_params=['file']
+        self.optional_params=['n_neighbors', 'bandwidth', 'guide_table']
+        self.check_inputs(params)
+
+        super().__init__()
+
+        n_dim = len(self.variables)
+
+        self.particle_file = params['file']
+        self.n_neighbors = int(params.get('n_neighbors', 4*n_dim))
+        self.bandwidth = float(params.get('bandwidth', 1.0))
+
+        assert self.bandwidth>=0, 'Error in Particles: bandwidth must be >= 0.'
+
+        P = ParticleGroup(self.particle_file)
+        alive = P.status==1
+
+        self.parents = np.stack([P[var][alive] for var in self.variables]).astype(np.float64)
+        weights = np.abs(P.weight[alive])
+
+        n_parent = self.parents.shape[1]
+        assert self.n_neighbors > n_dim and self.n_neighbors < n_parent, f'Error in Particles: n_neighbors must be > {n_dim} and < the number of particles ({n_parent}).'
+
+        Cw = np.zeros(n_parent+1)
+        np.cumsum(weights, out=Cw[1:])
+        self.Cw = unit_registry.Quantity(Cw/Cw[-1], 'dimensionless')
+        self.guide = guide_table(self.Cw) if self.use_guide_table else None
+
+        # Weighted moments of the parent beam
+        self.mean = np.average(self.parents, axis=1, weights=weights)
+        self.cov = np.atleast_2d(np.cov(self.parents, aweights=weights, bias=True))
+
+        for ii, var in enumerate(self.variables):
+            assert self.cov[ii,ii]>0, f'Error in Particles: {var} has zero spread in {self.particle_file}, it can not be resampled.'
+
+        # Neighbors are found in whitened coordinates, where the beam covariance is the identity
+        L = np.linalg.cholesky(self.cov)
+        whitened = np.linalg.solve(L, self.parents - self.mean[:,np.newaxis]).T
+
+        tree = cKDTree(whitened)
+
+        # Kernels, kernel@kernel.T = bandwidth**2 * the covariance of each parent's neighbors
+        self.kernels = np.empty((n_parent, n_dim, n_dim))
+        chunk_size = max(1, 1048576//(self.n_neighbors*n_dim))
+
+        for start in range(0, n_parent, chunk_size):
+
+            _, neighbors = tree.query(whitened[start:start+chunk_size], k=self.n_neighbors, workers=-1)
+
+            local = whitened[neighbors]
+            local -= local.mean(axis=1)[:,np.newaxis,:]
+
+            local_cov = np.einsum('nki,nkj->nij', local, local)/(self.n_neighbors-1) + 1e-12*np.eye(n_dim)
+            self.kernels[start:start+chunk_size] = self.bandwidth*np.matmul(L, np.linalg.cholesky(local_cov))
+
+        vprint(f'{n_dim}D particle resampling', verbose>0, 0, True)
+        vprint(f'particle file: {self.particle_file}', verbose>0, 2, True)
+        vprint(f'{n_parent} parent particles, kernels from {self.n_neighbors} nearest neighbors, bandwidth = {self.bandwidth}', verbose>0, 2, True)
+
+    def cdfinv(self, *rns):
+
+        """
+        Evaluates the coordinates from the probabilities rns, one per coordinate.  The first probability selects
+        the parent, its remainder and the other probabilities give the normal deviates of the kernel jitter.
+        Particles are generated in chunks, so that the kernel temporaries stay small.
+        Returns the coordinates in the order of the variables.
+        """
+
+        n_dim = len(self.variables)
+        assert len(rns)==n_dim, f'Particles requires {n_dim} sets of probabilities.'
+
+        positions = unit_registry.Quantity(np.arange(self.parents.shape[1]+1, dtype=np.float64), 'dimensionless')
+
+        N = len(rns[0])
+        coordinates = np.empty((n_dim, N))
+
+        chunk_size = 65536
+        for start in range(0, N, chunk_size):
+
+            ps = [rn[start:start+chunk_size] for rn in rns]
+
+            if(self.guide is not None):
+                position = guide_interp(ps[0], self.Cw, positions, self.guide).magnitude
+            else:
+                position = interp(ps[0], self.Cw, positions).magnitude
+
+            parents = np.minimum(position.astype(np.intp), self.parents.shape[1]-1)
+
+            # Normal deviates, with the probabilities kept off 0 and 1
+            us = np.stack([position - parents] + [np.asarray(p.magnitude, dtype=np.float64) for p in ps[1:]])
+            np.clip(us, 1e-12, 1-1e-12, out=us)
+            zs = np.sqrt(2)*erfinv(unit_registry.Quantity(2*us-1, 'dimensionless')).magnitude
+
+            coordinates[:, start:start+chunk_size] = self.parents[:,parents] + np.einsum('nij,jn->in', self.kernels[parents], zs)
+
+        return tuple(unit_registry.Quantity(coordinates[ii], self.units[var]) for ii, var in enumerate(self.variables))
+
+    def avg(self, var):
+        """ Returns the weighted mean of coordinate var in the parent beam """
+        return unit_registry.Quantity(self.mean[self.variables.index(var)], self.units[var])
+
+    def std(self, var):
+        """ Returns the weighted standard deviation of coordinate var in the parent beam """
+        ii = self.variables.index(var)
+        return unit_registry.Quantity(np.sqrt(self.cov[ii,ii]), self.units[var])
+
+    def sample(self, N, sequence=None, params=None):
+        rns = random_generator((len(self.variables),N), sequence, params)*unit_registry("dimensionless")
+        return self.cdfinv(*rns)
+
     
 # ---------------------------------------------------------------------------- 
 #   This allows the main function to be at the beginning of the file
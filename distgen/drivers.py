@@ -4,6 +4,7 @@ from distgen.tools import StopWatch, vprint, update_nested_dict
 from distgen.reader import Reader
 from distgen.writers import writer
 from distgen.generator import Generator
+from distgen import executors
 
 
 #def run_distgen(inputs=None,outputfile=None,output_type="gpt",verbose=0):
@@ -78,3 +79,37 @@ def run_distgen(
         beam.print_stats()
 
     return beam
+
+
+async def run_distgen_async(
+    settings={},
+    inputs='distgen.json',
+    verbose=0,
+    executor=None):
+    """
+    Asyncio version of run_distgen.  The input is read and the output written in the io executor, 
+    and the beam is sampled in executor (default: a process pool, see distgen.executors).
+
+    Example:
+        beams = await asyncio.gather(*[distgen.drivers.run_distgen_async(
+            settings = {'total_charge:value': q, 'output:file':f'gpt_{q}.txt'},
+            inputs = 'gunb_gaussian.json') for q in [10, 20, 50]])
+    """
+
+    io = executors.io_executor()
+
+    gen = await executors.run_in(io, Generator, inputs, verbose=verbose)
+
+    gen.input = update_nested_dict(gen.input, settings, verbose=verbose)
+
+    beam = await gen.abeam(executor)
+
+    params = gen.params
+
+    if 'file' in params['output']:
+        await executors.run_in(io, writer, params['output']['type'], beam, params['output']['file'], verbose, params)
+
+    if(verbose>0):
+        beam.print_stats()
+
+    return beam
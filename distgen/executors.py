@@ -0,0 +1,72 @@
+"""
+Shared executors for the asyncio interface (Generator.abeam/arun, drivers.run_distgen_async).
+
+Sampling runs in a process pool by default, so that it does not hold the GIL of the event loop,
+and the file writers run in a thread pool.  Both are created on first use and bound the number of
+generations running at once: further jobs queue until a worker is free.  Use set_executors to
+replace them, e.g. with a ThreadPoolExecutor(4) for sampling when the inputs can not be pickled.
+As the worker processes are not forked from the calling process, scripts using the process pool
+need the usual `if __name__ == '__main__':` guard.
+
+Cancelling an awaiting task drops its queued work.  A job already running in a worker finishes
+there, and its result is discarded.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import asyncio
+import functools
+import os
+
+_sampling_executor = None
+_io_executor = None
+
+def _context():
+    """
+    Workers are forked from a clean server process with distgen already imported where possible,
+    as forking the event loop process (with its threads) is unsafe, and spawning is slow
+    """
+    if('forkserver' in multiprocessing.get_all_start_methods()):
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['distgen.generator'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+def sampling_executor():
+    """ Returns the executor used for sampling (default: a process pool with one worker per cpu) """
+    global _sampling_executor
+    if(_sampling_executor is None):
+        _sampling_executor = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=_context())
+    return _sampling_executor
+
+def io_executor():
+    """ Returns the executor used for reading inputs and writing outputs (default: a thread pool) """
+    global _io_executor
+    if(_io_executor is None):
+        _io_executor = ThreadPoolExecutor(max_workers=min(32, 2*(os.cpu_count() or 1)), thread_name_prefix='distgen_io')
+    return _io_executor
+
+def set_executors(sampling=None, io=None):
+    """ Replaces the sampling and/or io executors.  The replaced executors are not shut down. """
+    global _sampling_executor, _io_executor
+    if(sampling is not None):
+        _sampling_executor = sampling
+    if(io is not None):
+        _io_executor = io
+
+def shutdown(wait=True):
+    """ Shuts down the shared executors, which are recreated on next use """
+    global _sampling_executor, _io_executor
+    for executor in [_sampling_executor, _io_executor]:
+        if(executor is not None):
+            executor.shutdown(wait=wait, cancel_futures=True)
+    _sampling_executor, _io_executor = None, None
+
+async def run_in(executor, func, *args, **kwargs):
+    """ Awaits func(*args, **kwargs) in executor """
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+def sample_beam(input, verbose=0):
+    """ Generates the beam of input in a worker process, which returns it pickled (see Beam.__getstate__) """
+    from .generator import Generator
+    return Generator(input, verbose=verbose).beam()
@@ -1,19 +1,44 @@
 from .physical_constants import *
-from .beam import Beam
-from .transforms import set_avg_and_std, transform, set_avg
+from .beam import Beam, weighted_moments, particle_group
+from .transforms import set_avg_and_std, transform, set_avg, TRANSFORMS, TRANSFORM_CHUNK_SIZE
 from .tools import *
 from .dist import *
-from pmd_beamphysics import ParticleGroup, pmd_init
 from . import archive
+from . import executors
 
 import warnings
+import asyncio
 
 import numpy as np
-import h5py
+import contextlib
 import yaml
 import copy
+import io
 import os
 
+# Number of particles sampled at a time by Generator.beam
+SAMPLE_CHUNK_SIZE = 1048576
+
+# Memory model of Generator.plan: the float64 temporaries per particle of a chunk of the random numbers, 
+# the sampling, the user transforms (plus the float64 copies of the coordinates, when they are stored in
+# lower precision) and the covariance matching, and the bytes per particle of the writer buffers, 
+# or of their 1M particle chunks.  Measured with tracemalloc.
+RAND_TEMPORARIES = 4
+SAMPLE_TEMPORARIES = 4
+TRANSFORM_TEMPORARIES = 6
+TRANSFORM_COPY_TEMPORARIES = 10
+COVARIANCE_TEMPORARIES = 28
+WRITER_BYTES = {'gpt':8, 'shm':64}
+WRITER_CHUNK_BYTES = {'gpt':96, 'astra':132, 'openPMD':10}
+
+# Number of particles of the calibration run timed by Generator.plan to estimate the runtime
+CALIBRATION_SIZE = 65536
+
+# Number of built distributions kept by get_cached_dists, shared by the generators of a process
+DIST_CACHE_SIZE = 16
+
+# Units of the storage memory_budget.  These are parsed explicitly, as GB is the gamma*beta momentum unit of the registry
+MEMORY_UNITS = {'B':1, 'byte':1, 'kB':1e3, 'KB':1e3, 'MB':1e6, 'GB':1e9, 'TB':1e12, 'KiB':2**10, 'MiB':2**20, 'GiB':2**30, 'TiB':2**40}
 
 class Generator:
 
@@ -32,6 +57,17 @@ class Generator:
         self.verbose = verbose 
     
         self.input = input
+
+        # Unit converted params from the last configure(), reused until the input changes
+        self._configured_params = None
+        self._configured_fingerprint = None
+        self._input_dirty = True
+        self._input_file_key = None
+
+        # Distributions built (or found in the cache) by validate() for the configured params, reused by beam()
+        self._dists = None
+        self._validated_params = None
+        self._build_time = None
         
         # This will be set with .beam()
         self.rands = None
@@ -53,19 +89,25 @@ class Generator:
         
         Relative paths for input 'file' keys will be expanded.
         """
+        self._input_dirty = True
+        self._input_file_key = None
+
         if isinstance(input, str):
             if os.path.exists(os.path.expandvars(input)):
                 # File
                 filename = full_path(input)
-                with open(filename) as fid:
-                    input = yaml.safe_load(fid)
-                # Fill any 'file' keys
-                expand_input_filepaths(input, root=os.path.split(filename)[0], ignore_keys=['output'])
-                    
+                self._input_file_key, cached = read_input_file(filename)
+                input = copy.deepcopy(cached['input'])
+
+                if(cached['params'] is not None):
+                    # This file has already been parsed and unit converted
+                    self._configured_params = cached['params']
+                    self._configured_fingerprint = cached['fingerprint']
+                    self._input_dirty = False
                     
             else:
                 #Try raw string
-                input = yaml.safe_load(input)
+                input = load_yaml(input)
                 assert isinstance(input, dict), f'ERROR: parsing unsuccessful, could not read {input}'
                 expand_input_filepaths(input)
                 
@@ -77,13 +119,38 @@ class Generator:
         1. Copies the input dictionary read in from a file or passed directly
         2. Converts physical quantities to PINT quantities in the params dictionary
         3. Runs consistency checks on the resulting params dict
+
+        4. Validates every stage of beam before any sampling (see validate)
+
+        Steps 1, 2 and 4 are skipped if the input has not changed since the last call.
         """
 
-        self.params = copy.deepcopy(self.input)         # Copy the input dictionary
+        input_fingerprint = self._input_fingerprint()
+
+        if(self._input_dirty or input_fingerprint is None or input_fingerprint != self._configured_fingerprint):
+
+            params = copy.deepcopy(self.input)          # Copy the input dictionary
+            convert_params(params)                      # Conversion of the input dictionary using tools.convert_params
+
+            self._configured_params = params
+            self._configured_fingerprint = input_fingerprint
+            self._input_dirty = False
+
+            # Share the converted params with other generators reading the same unmodified file
+            cached = _input_file_cache.get(self._input_file_key)
+            if(cached is not None and input_fingerprint is not None and cached['fingerprint'] == input_fingerprint):
+                cached['params'] = params
+
+        # Copy only the dict structure: the converted quantities are shared, not modified 
+        self.params = copy_nested(self._configured_params)
+
         if('start' not in self.params):
             self.params['start'] = {'type':'free'}
-        convert_params(self.params)                     # Conversion of the input dictionary using tools.convert_params
         self.check_input_consistency(self.params)       # Check that the result is logically sound 
+
+        if(self._validated_params is not self._configured_params):
+            self._dists = self.validate(self.params)
+            self._validated_params = self._configured_params
         
     def check_input_consistency(self, params):
 
@@ -95,14 +162,76 @@ class Generator:
             assert rp in params, 'Required generator parameter ' + rp + ' not found.'
 
         # Check that only allowed params present at top level
-        allowed_params = required_params + ['output', 'transforms', 'start']
+        allowed_params = required_params + ['output', 'transforms', 'start', 'dtype', 'match_covariance', 'quiet_start', 'train', 'storage']
         for p in params:
             #assert p in allowed_params or '_dist'==p[-5:], 'Unexpected distgen input parameter: ' + p[-5:]
             assert p in allowed_params or p.endswith('_dist'), 'Unexpected distgen input parameter: ' + p
         
         assert params['n_particle']>0, 'User must speficy n_particle must > 0.'
 
-        # Check consistency of transverse coordinate definitions
+        # Floating point precision of the random numbers and beam coordinates 
+        if('dtype' not in params):
+            params['dtype'] = 'float64'
+        assert params['dtype'] in ['float32', 'float64'], f'Unsupported dtype: {params["dtype"]}, must be float32 or float64.'
+
+        # Optionally remove the sampling correlations between independently sampled coordinates
+        params['match_covariance'] = bool(params.get('match_covariance', False))
+
+        # Quiet start: mirrored copies of the sampled particles, across pairs of coordinates
+        if('quiet_start' in params):
+
+            quiet_start = params['quiet_start']
+            if(isinstance(quiet_start, str)):
+                quiet_start = {'type':quiet_start}
+
+            assert quiet_start.get('type')=='mirror', f'Unsupported quiet_start type: {quiet_start.get("type")}, must be mirror.'
+
+            pairs = [pair if isinstance(pair, list) else pair.split(':') for pair in quiet_start.get('pairs', ['x:px', 'y:py'])]
+            for pair in pairs:
+                for var in pair:
+                    assert var in ['x', 'y', 'z', 'px', 'py', 'pz', 't'], f'Unknown quiet_start mirror coordinate: {var}'
+
+            assert params['n_particle'] % 2**len(pairs) == 0, f'quiet_start mirror requires n_particle to be a multiple of {2**len(pairs)}.'
+            params['quiet_start'] = {'type':'mirror', 'pairs':pairs}
+
+        # Coordinate storage: in memory, or out-of-core in np.memmap files in a scratch directory
+        storage = params.get('storage', 'memory')
+        if(isinstance(storage, str)):
+            storage = {'type':storage}
+        for p in storage:
+            assert p in ['type', 'dir', 'memory_budget'], f'Unexpected storage parameter specified: {p}'
+        storage['type'] = storage.get('type', 'memory')
+        assert storage['type'] in ['memory', 'memmap'], f'Unsupported storage type: {storage.get("type")}, must be memory or memmap.'
+        if(storage['type']=='memmap' and 'dir' not in storage):
+            import tempfile
+            storage['dir'] = tempfile.gettempdir()
+        params['storage'] = storage
+
+        # Bunch train: copies of the beam with their own charges, bunch k delayed by k*spacing (+ jitter)
+        if('train' in params):
+
+            train = params['train']
+            for p in train:
+                assert p in ['n_bunch', 'spacing', 'charge', 'jitter'], f'Unexpected train parameter specified: {p}'
+            assert 'n_bunch' in train and 'spacing' in train, 'User must specify n_bunch and spacing for a bunch train.'
+
+            train['n_bunch'] = int(train['n_bunch'])
+            assert train['n_bunch']>0, 'train: n_bunch must be > 0.'
+
+            # Time spacing delays the bunches in t, length spacing places them behind each other in z
+            spacing = train['spacing']
+            assert isinstance(spacing, unit_registry.Quantity) and (spacing.check('[time]') or spacing.check('[length]')), 'train: spacing must have units of time or length.'
+            if('jitter' in train):
+                assert isinstance(train['jitter'], unit_registry.Quantity) and train['jitter'].dimensionality==spacing.dimensionality, 'train: jitter must have the units of the spacing.'
+
+            # The bunch charge(s) default to total_charge
+            charge = train.get('charge', params['total_charge'])
+            assert isinstance(charge, unit_registry.Quantity) and charge.check('[charge]'), 'train: charge must have units of charge.'
+            if(np.ndim(charge.magnitude)==0):
+                charge = charge*np.ones(train['n_bunch'])
+            assert charge.shape==(train['n_bunch'],), 'train: charge must be a single value or one per bunch.'
+            train['charge'] = charge
+
         if( ("r_dist" in params) or ("x_dist" in params) or ("xy_dist" in params) ):
             assert ("r_dist" in params)^("x_dist" in params)^("xy_dist" in params),"User must specify only one transverse distribution."
         if( ("r_dist" in params) or ("y_dist" in params) or ("xy_dist" in params) ):
@@ -114,6 +243,9 @@ class Generator:
             vprint("Ignoring user specified px distribution for cathode start.", self.verbose>0 and "px_dist" in params,0,True )
             vprint("Ignoring user specified py distribution for cathode start.", self.verbose>0 and "py_dist" in params,0,True )
             vprint("Ignoring user specified pz distribution for cathode start.", self.verbose>0 and "pz_dist" in params,0,True )
+
+            if('quiet_start' in params):
+                assert all('pz' not in pair for pair in params['quiet_start']['pairs']), 'pz can not be mirrored for cathode start.'
             
             assert "MTE" in params['start'], "User must specify the MTE for cathode start." 
 
@@ -132,19 +264,55 @@ class Generator:
                 warnings.warn('Ignoring user specified t distribution for time start.')
                 self.params.pop('t_dist')
 
+        # Check that each coordinate is sampled from at most one distribution
+        sampled = {}
+        for p in self.params:
+            if(p.endswith('_dist') and p!='theta_dist'):
+                var = p.replace('_dist','')
+                for coordinate in {'r':['x','y']}.get(var, get_vars(var) or [var]):
+                    assert coordinate not in sampled, f'Coordinate {coordinate} is specified by both {sampled[coordinate]} and {p}.'
+                    sampled[coordinate] = p
+
         if('output' in self.params):
             out_params = self.params["output"]
             for op in out_params:
-                assert op in ['file','type'], f'Unexpected output parameter specified: {op}'
+                assert op in ['file','type','shards','pattern'], f'Unexpected output parameter specified: {op}'
+
+            # Sharded output: one file per contiguous particle range
+            if('shards' in out_params):
+                out_params['shards'] = int(out_params['shards'])
+                assert out_params['shards']>0, 'Output shards must be > 0.'
         else:
             self.params['output'] = {"type":None}
 
+        # With a memory budget [bytes], out-of-core storage is chosen when the beam would not fit in memory
+        if('memory_budget' in storage):
+            storage['memory_budget'] = memory_bytes(storage['memory_budget'])
+            assert storage['memory_budget']>0, 'storage: memory_budget must be > 0.'
+
+            if(storage['type']=='memory' and estimate_memory(params)['peak']>storage['memory_budget']):
+                import tempfile
+                storage['type'] = 'memmap'
+                storage['dir'] = storage.get('dir', tempfile.gettempdir())
+                vprint(f'Storage: the beam exceeds the memory budget, using memmap storage in {storage["dir"]}.', self.verbose>0, 0, True)
+
 
     def __getitem__(self, varstr):
          return get_nested_dict(self.input, varstr, sep=':', prefix='distgen')
 
     def __setitem__(self, varstr, val):
+        self._input_dirty = True
         return set_nested_dict(self.input, varstr, val, sep=':', prefix='distgen')
+
+    def _input_fingerprint(self):
+        """
+        Fingerprint of the input used to detect edits made directly to self.input.
+        Returns None if the input can not be fingerprinted, which forces reconfiguration.
+        """
+        try:
+            return fingerprint(self.input)
+        except (TypeError, ValueError, AttributeError):
+            return None
         
 
     def get_dist_params(self):
@@ -164,33 +332,116 @@ class Generator:
         return dist_params
 
 
-    def get_rands(self, variables):
+    def validate(self, params):
+
+        """
+        Fail-fast checks of every stage of beam, before any random numbers are drawn: builds the distribution
+        of each coordinate (checking its type, parameters and units), and checks the start type, the transforms 
+        (by applying them to a small test beam) and the output writer.  Returns the distributions, 
+        {var:entry} of get_cached_dists, which beam reuses.
+        """
+
+        from .writers import check_output
+
+        units = {'x':'m', 'y':'m', 'z':'m', 'px':'eV/c', 'py':'eV/c', 'pz':'eV/c', 't':'s', 'r':'m', 'theta':'rad'}
+
+        assert params['start']['type'] in ['cathode', 'time', 'free'], f'Beam start type "{params["start"]["type"]}" is not supported!'
+
+        dist_params = self.get_dist_params()
+        dists = {}
+        for var in dist_params:
+            try:
+                dists[var] = get_cached_dists(var, dist_params[var], verbose=self.verbose)
+            except Exception as ex:
+                raise ValueError(f'{var}_dist: {type(ex).__name__}: {ex}') from ex
+
+            # The units of 1d distributions are checked on a few samples
+            for dist in dists[var]['dists']:
+                if(dist is not None and var in units):
+                    sample = dist.cdfinv(unit_registry.Quantity(np.array([0.25, 0.5, 0.75]), 'dimensionless'))
+                    assert sample.check(unit_registry(units[var]).dimensionality), f'{var}_dist: has units of {sample.units:~P}, not of {var} [{units[var]}].'
+
+        # The time to build the distributions, when they were built
+        self._build_time = sum(entry['time'] for entry in dists.values())
+
+        # Transforms are applied in order to a small test beam, with the coordinate spreads of a typical beam
+        if('transforms' in params):
+
+            transforms = params['transforms']
+            order = transforms.get('order', [name for name in transforms])
+            assert isinstance(order, list), 'Transform "order" key must be associated a list of transform IDs'
+
+            n_test = 64
+            rng = np.random.default_rng(0)
+            scales = {'m':1e-3, 'eV/c':1e3, 's':1e-12}
+
+            beam = Beam(total_charge=params['total_charge'], n_particle=n_test)
+            for var in ['x', 'px', 'y', 'py', 'z', 'pz', 't']:
+                beam[var] = unit_registry.Quantity(rng.normal(scale=scales[units[var]], size=n_test), units[var])
+            beam['w'] = unit_registry.Quantity(np.full(n_test, 1/n_test), 'dimensionless')
+
+            for name in order:
+                assert name in transforms, f'Transform "{name}" in the transform order is not defined.'
+                T = {**transforms[name], 'verbose':False}
+                assert 'type' in T, f'Transform "{name}" has no type.'
+                transfunc = T['type'].split(' ')[0]
+                assert transfunc in TRANSFORMS, f'Transform "{name}": type "{transfunc}" is not supported, must be one of: {", ".join(TRANSFORMS)}.'
+                try:
+                    beam = transform(beam, T)
+                except Exception as ex:
+                    raise ValueError(f'Transform "{name}" ({T["type"]}): {type(ex).__name__}: {ex}') from ex
+
+        output = params['output']
+        assert output.get('type') is not None or 'file' not in output, 'Output must specify the type of the output file.'
+        if(output.get('type') is not None):
+            check_output(output)
+
+        return dists
+
+    def get_dists(self, var, params):
+        """
+        Returns the distribution of var and its proposal distribution (None if not given) built by validate, 
+        printing their description with verbose
+        """
+        entry = self._dists.get(var) if(self._dists) else None
+        if(entry is None or (self.verbose>0 and entry['text'] is None)):
+            entry = get_cached_dists(var, params, verbose=self.verbose)
+        vprint(entry['text'], self.verbose>0, 0, False)
+        return entry['dists']
+
+    def get_rands(self, variables, out=None, n_particle=None):
 
         """ Gets random numbers [0,1] for the coordinatess in variables 
-        using either the Hammersley sequence or rand """
+        using either the Hammersley sequence or rand. If out is given, 
+        the numbers for each coordinate var are written into the array out[var].
+        Defaults to n_particle numbers per coordinate """
  
-        specials = ['xy']
+        # Multidimensional distributions (e.g. xy) get one set of random numbers per coordinate
+        specials = [var for var in variables if get_vars(var) is not None]
         self.rands = {var:None for var in variables if var not in specials}
 
-        if('xy' in variables):
-            self.rands['x']=None
-            self.rands['y']=None
+        for special in specials:
+            for var in get_vars(special):
+                self.rands[var]=None
 
-        elif('r' in variables and 'theta' not in variables):
+        if('r' in variables and 'theta' not in variables):
             self.rands['theta']=None
 
         n_coordinate = len(self.rands.keys())
-        n_particle = int(self.params['n_particle'])
+        if(n_particle is None):
+            n_particle = int(self.params['n_particle'])
         shape = ( n_coordinate, n_particle )
         
         if(n_coordinate>0):
-            rns = random_generator(shape, sequence=self.params['random_type'])
+            rows = None if out is None else [out[key] for key in self.rands]
+            rns = random_generator(shape, sequence=self.params['random_type'], dtype=self.params['dtype'], out=rows)
         
+        # Wrap the rows without copying them (array*unit would copy)
         for ii, key in enumerate(self.rands.keys()):
-            if(len(rns.shape)>1):
-                self.rands[key] = rns[ii,:]*unit_registry('dimensionless')
+            if(out is not None or len(rns.shape)>1):
+                self.rands[key] = unit_registry.Quantity(rns[ii], 'dimensionless')
             else:
-                self.rands[key] = rns[:]*unit_registry('dimensionless')
+                self.rands[key] = unit_registry.Quantity(rns, 'dimensionless')
 
         var_list = list(self.rands.keys())
         for ii, vii in enumerate(var_list[:-1]):
@@ -244,17 +495,63 @@ class Generator:
 
         units = {'x':'m', 'y':'m', 'z':'m', 'px':'eV/c', 'py':'eV/c', 'pz':'eV/c', 't':'s'}
 
-        # Initialize coordinates to zero       
-        for var, unit in units.items():
-            bdist[var] = np.full(N, 0.0)*unit_registry(units[var])
-
-        bdist["w"] = np.full((N,), 1/N)*unit_registry("dimensionless")
-
-        avgs = {var:0*unit_registry(units[var]) for var in units}
-        stds = {var:0*unit_registry(units[var]) for var in units}
+        # Coordinates are stored in the user requested precision
+        dtype = np.dtype(self.params['dtype'])
+        vprint(f'Coordinate precision: {dtype}.', verbose>0 and dtype!=np.float64, 1, True)
+
+        # All coordinates live in the rows of a single block, which np.zeros allocates lazily, 
+        # or for out-of-core storage, an np.memmap file in the scratch directory. 
+        # The random numbers for each coordinate are drawn directly into its row, which is 
+        # then overwritten in place by the sampled coordinate, so each row is written once.
+        scratch = self.params['storage']['dir'] if(self.params['storage']['type']=='memmap') else None
+        vprint(f'Coordinate storage: memmap in {scratch}.', verbose>0 and scratch is not None, 1, True)
+
+        coordinates = storage_zeros((len(units), N), dtype=dtype, directory=scratch)
+        rows = {var:coordinates[ii] for ii, var in enumerate(units)}
+
+        # For a mirror quiet start only the first N/2^(number of pairs) particles are sampled
+        mirror = self.params['quiet_start']['pairs'] if('quiet_start' in self.params) else []
+        n_sampled = N//2**len(mirror)
+        vprint(f'Quiet start: sampling {n_sampled} particles, mirrored across {", ".join(":".join(pair) for pair in mirror)}.', verbose>0 and len(mirror)>0, 1, True)
+
+        sampled_rows = {var:row[:n_sampled] for var, row in rows.items()}
+
+        # Particles are sampled in chunks, bounding the float64 temporaries of the distributions
+        chunks = [slice(start, min(start+SAMPLE_CHUNK_SIZE, n_sampled)) for start in range(0, n_sampled, SAMPLE_CHUNK_SIZE)]
+
+        def set_coordinate(var, value, chunk=slice(None)):
+            sampled_rows[var][chunk] = value.magnitude
+            bdist[var] = unit_registry.Quantity(rows[var], value.units)
+
+        # Weights stay in float64 so they sum to one, keeping the weighted moments accurate
+        weights = storage_zeros((N,), dtype=np.float64, directory=scratch)
+        weights.fill(1/N)
+        bdist["w"] = unit_registry.Quantity(weights, "dimensionless")
+
+        # Importance sampling: coordinates with a proposal distribution are drawn from it, 
+        # and each particle is weighted by the ratio of the target to the proposal pdfs
+        importance = []
+
+        def importance_sample(var, dist, proposal, rns, chunk):
+            if(proposal is None):
+                return dist.cdfinv(rns)
+            sample = proposal.cdfinv(rns)
+            p = dist.pdf(sample)
+            q = proposal.pdf(sample).to(p.units).magnitude
+            np.multiply(weights[chunk], np.divide(p.magnitude, q, out=np.zeros_like(q), where=q>0), out=weights[chunk])
+            if(var not in importance):
+                importance.append(var)
+            return sample
+
+        avgs = {}
+        stds = {}
+        joint = {}      # Coordinates sampled jointly, from 2D and N-D distributions, keep their correlations
+        symmetric = {}  # Whether the distribution of each coordinate is symmetric about its average, for mirroring
 
         dist_params = self.get_dist_params()   # Get the relevant dist params, setting defaults as needed, and samples random number generator
-        self.get_rands(list(dist_params.keys()))
+        rand_rows = {'r':'x', 'theta':'y'}     # Radial random numbers are drawn into the x and y rows
+        self.get_rands(list(dist_params.keys()), out={**sampled_rows, **{key:sampled_rows[var] for key, var in rand_rows.items()}}, n_particle=n_sampled)
+        drawn = [rand_rows.get(key, key) for key in self.rands]
 
         # Do radial dist first if requested
         if('r' in dist_params and 'theta' in dist_params):
@@ -262,15 +559,10 @@ class Generator:
             vprint('r distribution: ',verbose>0, 1, False)  
                 
             # Get r distribution
-            rdist = get_dist('r', dist_params['r'], verbose=verbose)      
+            rdist, proposal = self.get_dists('r', dist_params['r'])      
 
-            if(rdist.rms()>0):
-                r = rdist.cdfinv(self.rands['r'])       # Sample to get beam coordinates
-                    
-            # Sample to get beam coordinates
             vprint('theta distribution: ', verbose>0, 1, False)
-            theta_dist = get_dist('theta', dist_params['theta'], verbose=verbose)  
-            theta = theta_dist.cdfinv(self.rands['theta'])
+            theta_dist, _ = self.get_dists('theta', dist_params['theta'])  
 
             rrms = rdist.rms()
             avgr = rdist.avg()
@@ -280,8 +572,13 @@ class Generator:
             avgCos2 = 0.5
             avgSin2 = 0.5
             
-            bdist['x']=r*np.cos(theta)
-            bdist['y']=r*np.sin(theta)
+            # Sample to get beam coordinates, each chunk of random numbers in the x and y rows is used before it is overwritten
+            for chunk in chunks:
+                r = importance_sample('r', rdist, proposal, self.rands['r'][chunk], chunk)
+                theta = theta_dist.cdfinv(self.rands['theta'][chunk])
+                set_coordinate('x', r*np.cos(theta), chunk)
+                set_coordinate('y', r*np.sin(theta), chunk)
+            del r, theta     # Release the samples before the remaining coordinates are generated
 
             avgs['x'] = avgr*avgCos
             avgs['y'] = avgr*avgSin
@@ -289,35 +586,48 @@ class Generator:
             stds['x'] = rrms*np.sqrt(avgCos2)
             stds['y'] = rrms*np.sqrt(avgSin2)   
 
+            symmetric['x'] = symmetric['y'] = bool(np.isclose(theta_dist.range.to('rad').magnitude, 2*np.pi))
+
             # remove r, theta from list of distributions to sample
             del dist_params['r']
             del dist_params['theta']
 
-        # Do 2D distributions
-        if("xy" in dist_params):
+        # Do 2D and N-D distributions
+        for key in [key for key in dist_params if get_vars(key) is not None]:
+
+            vprint(f'{key} distribution: ', verbose>0, 1, False) 
+            dist, _ = self.get_dists(key, dist_params[key])
 
-            vprint('xy distribution: ', verbose>0, 1, False) 
-            dist = get_dist('xy', dist_params['xy'], verbose=verbose)
-            bdist['x'], bdist['y'] = dist.cdfinv(self.rands['x'], self.rands['y'])
+            variables = get_vars(key)
+            for chunk in chunks:
+                samples = dist.cdfinv(*[self.rands[var][chunk] for var in variables])
+                for var, sample in zip(variables, samples):
+                    set_coordinate(var, sample, chunk)
+            del samples
 
-            dist_params.pop('xy')
+            for var in variables:
+                joint[var] = key
 
-            avgs['x']=bdist.avg('x')
-            avgs['y']=bdist.avg('y')
+            dist_params.pop(key)
 
-            stds['x']=bdist.std('x')
-            stds['y']=bdist.std('y')
+            # Distributions that define their moments (e.g. particles) are fixed to them, 
+            # others keep the sampled ones, which are computed once all particles exist
+            for var in variables:
+                avgs[var] = dist.avg(var) if hasattr(dist, 'avg') else None
+                stds[var] = dist.std(var) if hasattr(dist, 'std') else None
+                symmetric[var] = False
         
         # Do all other specified single coordinate dists   
         for x in dist_params.keys():
 
             vprint(x+" distribution: ",verbose>0,1,False)   
-            dist = get_dist(x, dist_params[x], verbose=verbose)      # Get distribution
+            dist, proposal = self.get_dists(x, dist_params[x])      # Get distribution
 
             if(dist.std()>0):
 
                 # Only reach here if the distribution has > 0 size
-                bdist[x]=dist.cdfinv(self.rands[x])                      # Sample to get beam coordinates
+                for chunk in chunks:
+                    set_coordinate(x, importance_sample(x, dist, proposal, self.rands[x][chunk], chunk), chunk)       # Sample to get beam coordinates
 
                 # Fix up the avg and std so they are exactly what user asked for
                 if("avg_"+x in dist_params[x]):
@@ -326,17 +636,49 @@ class Generator:
                     avgs[x] = dist.avg()
 
                 stds[x] = dist.std()
+                symmetric[x] = x in [var for pair in mirror for var in pair] and is_symmetric(dist) and (proposal is None or 
+                    (is_symmetric(proposal) and np.isclose(proposal.avg(), dist.avg(), atol=1e-6*dist.std())))
                 #if("sigma_"+x in dist_params[x]):
                 #    stds[x] = dist_params[x]["sigma_"+x]
                 #else:
                     #stds[x] = dist.std()
                     #print(x, stds[x])
 
-        # Shift and scale coordinates to undo sampling error
+        # Coordinates that were not sampled are zero, clearing any random numbers left in their rows
+        for var, unit in units.items():
+            if(var not in avgs):
+                if(var in drawn):
+                    rows[var][:] = 0
+                bdist[var] = unit_registry.Quantity(rows[var], unit)
+        
+        # Quiet start: copy the sampled particles, point reflected about the averages in each pair of coordinates
+        for level, pair in enumerate(mirror):
+
+            n = n_sampled*2**level
+            coordinates[:, n:2*n] = coordinates[:, :n]
+            weights[n:2*n] = weights[:n]
+
+            for var in pair:
+                if(var in avgs):
+                    assert symmetric[var], f'quiet_start: the distribution of {var} is not symmetric about its average, and can not be mirrored.'
+                    center = avgs[var].to(bdist[var].units).magnitude
+                    np.subtract(2*center, rows[var][n:2*n], out=rows[var][n:2*n])
+
+        if(importance):
+            weights /= weights.sum()
+            vprint(f'Importance sampling {", ".join(importance)}: effective number of particles = {1/np.sum(weights**2):.6G}.', verbose>0, 1, True)
+
+        for var in avgs:
+            if(avgs[var] is None):
+                avgs[var] = bdist.avg(var)
+                stds[var] = bdist.std(var)
+
+        # Shift and scale coordinates to undo sampling error, in place
         for x in avgs:
 
-            vprint(f'Shifting avg_{x} = {bdist.avg(x):G~P} -> {avgs[x]:G~P}', verbose>0 and bdist[x].mean()!=avgs[x],1,True)
-            vprint(f'Scaling sigma_{x} = {bdist.std(x):G~P} -> {stds[x]:G~P}',verbose>0 and bdist[x].std() !=stds[x],1,True)
+            if(verbose>0):
+                vprint(f'Shifting avg_{x} = {bdist.avg(x):G~P} -> {avgs[x]:G~P}', bdist[x].mean()!=avgs[x],1,True)
+                vprint(f'Scaling sigma_{x} = {bdist.std(x):G~P} -> {stds[x]:G~P}', bdist[x].std() !=stds[x],1,True)
 
             #bdist = transform(bdist, {'type':f'set_avg_and_std {x}', 'avg_'+x:avgs[x],'sigma_'+x:stds[x], 'verbose':0}) 
             bdist = set_avg_and_std(bdist, **{'variables':x, 'avg_'+x:avgs[x],'sigma_'+x:stds[x], 'verbose':0})
@@ -344,7 +686,7 @@ class Generator:
         # Handle any start type specific settings
         if(self.params['start']['type']=="cathode"):
 
-            bdist['pz']=np.abs(bdist['pz'])   # Only take forward hemisphere 
+            np.abs(bdist['pz'].magnitude, out=bdist['pz'].magnitude)   # Only take forward hemisphere 
             vprint('Cathode start: fixing pz momenta to forward hemisphere',verbose>0,1,True)
             vprint(f'avg_pz -> {bdist.avg("pz"):G~P}, sigma_pz -> {bdist.std("pz"):G~P}',verbose>0,2,True)
 
@@ -365,6 +707,19 @@ class Generator:
 
         else:
             raise ValueError(f'Beam start type "{self.params["start"]["type"]}" is not supported!')
+
+        # Whiten the sample covariance and recolor it to the target: the sample covariance with the 
+        # correlations between independently sampled coordinates removed
+        if(self.params['match_covariance']):
+
+            variables = list(units.keys())
+            moments = weighted_moments([bdist[var].magnitude for var in variables], bdist.w.magnitude)
+
+            groups = [joint.get(var, var) for var in variables]
+            target = moments[1]*np.equal.outer(groups, groups)
+
+            vprint('Matching the coordinate covariance matrix', verbose>0, 1, True)
+            bdist.set_covariance(variables, moments[0], target, moments=moments)
         
         # Apply any user desired coordinate transformations
         if(transforms):
@@ -386,6 +741,23 @@ class Generator:
                 vprint(f'Applying user supplied transform: "{name}" = {T["type"]}...', verbose>0, 1, True)
                 bdist = transform(bdist, T)
 
+        # Arithmetic with float64 quantities may have promoted coordinates, restore the requested precision
+        for var in units:
+            bdist[var] = astype(bdist[var], dtype)
+
+        # Replicate the beam into a bunch train
+        if('train' in self.params):
+
+            train = self.params['train']
+            delays = np.arange(train['n_bunch'])*train['spacing']
+            if('jitter' in train):
+                delays = delays + np.random.normal(size=train['n_bunch'])*train['jitter']
+
+            offsets = {'t':delays} if(delays.check('[time]')) else {'z':-delays}
+
+            vprint(f'Bunch train: {train["n_bunch"]} bunches, spaced by {train["spacing"]:G~P}, total charge {np.sum(train["charge"]):G~P}.', verbose>0, 1, True)
+            bdist = bdist.replicate(train['charge'], offsets, directory=scratch)
+
         watch.stop()
         vprint(f'...done. Time Ellapsed: {watch.print()}.\n',verbose>0,0,True)
         return bdist
@@ -395,10 +767,127 @@ class Generator:
         """ Runs the generator.beam function stores the partice in 
         an openPMD-beamphysics ParticleGroup in self.particles """
         beam = self.beam()
-        self.particles = ParticleGroup(data=beam.data())
+        self.particles = particle_group(beam)     # Shares the beam coordinates, without copies
+        vprint(f'Created particles in .particles: \n   {self.particles}', self.verbose>0,1,False) 
+
+    async def abeam(self, executor=None):
+        """
+        Asyncio version of beam, which samples in executor (default: executors.sampling_executor()).
+        With a process pool, the beam is generated from self.input in a worker, and self.rands is not set.
+        """
+        executor = executor or executors.sampling_executor()
+
+        if(isinstance(executor, executors.ProcessPoolExecutor)):
+            await executors.run_in(executors.io_executor(), self.configure)
+
+            # Submitting can start the worker processes, which would block the event loop
+            future = await executors.run_in(executors.io_executor(), executor.submit, executors.sample_beam, self.input, self.verbose)
+            return await asyncio.wrap_future(future)
+
+        return await executors.run_in(executor, self.beam)
+
+    async def arun(self, executor=None):
+        """ Asyncio version of run, see abeam """
+        beam = await self.abeam(executor)
+        self.particles = await executors.run_in(executors.io_executor(), particle_group, beam)
         vprint(f'Created particles in .particles: \n   {self.particles}', self.verbose>0,1,False) 
     
     
+    def plan(self, calibrate=True):
+        """
+        Dry run of beam: configures and validates the input (which builds every distribution), and returns a plan with the 
+        samplers of each coordinate, the storage (see estimate_memory for the choice with a memory budget) and the 
+        memory used per stage [bytes].  With calibrate, the runtime [s] of each stage is estimated by timing the 
+        samplers and a run of CALIBRATION_SIZE particles, scaled to n_particle.  The plan is printed with verbose.
+        """
+        from .writers import writer, read_shm
+
+        watch = StopWatch()
+
+        def timed(func, *args):
+            watch.start()
+            result = func(*args)
+            watch.stop()
+            return result, (watch.tstop-watch.tstart).to('s').magnitude
+
+        self.configure()
+        params = self.params
+        N = int(params['n_particle'])
+
+        # Time the sampler of each distribution (built and timed by configure, see validate) on the calibration random numbers.  
+        # The state of the random numbers is restored at the end, so that the plan does not change the next beam
+        dist_params = self.get_dist_params()
+        n_calibration = min(N, CALIBRATION_SIZE)
+        state = np.random.get_state()
+        rns = unit_registry.Quantity(np.random.random(n_calibration), 'dimensionless')
+
+        samplers = {}
+        t_build, t_sample = self._build_time, 0
+        for var in dist_params:
+
+            dist, proposal = self._dists[var]['dists']
+            samplers[var] = type(dist).__name__ + (f' (proposal {type(proposal).__name__})' if proposal is not None else '')
+
+            if(calibrate and proposal is None):
+                _, t = timed(dist.cdfinv, *[rns]*len(get_vars(var) or [var]))
+                t_sample = t_sample + t/n_calibration
+            elif(calibrate):
+                sample, t = timed(proposal.cdfinv, rns)
+                _, t_weights = timed(lambda x: dist.pdf(x)/proposal.pdf(x), sample)
+                t_sample = t_sample + (t + t_weights)/n_calibration
+
+        memory = estimate_memory(params)
+
+        plan = {'n_particle':N, 'dtype':params['dtype'], 'random_type':params['random_type'], 'samplers':samplers,
+                'transforms':[T['type'] for name, T in params.get('transforms', {}).items() if name!='order'],
+                'storage':params['storage'], 'memory':memory}
+
+        if('memory_budget' in params['storage']):
+            plan['fits'] = memory['peak']<=params['storage']['memory_budget']
+
+        if(calibrate):
+
+            # The remaining stages (moments, transforms, start, train) are timed on a calibration beam in memory
+            calibration = Generator({**copy.deepcopy(self.input), 'n_particle':n_calibration, 'storage':'memory'}, verbose=0)
+            beam, t_beam = timed(calibration.beam)
+
+            n_sampled = N//2**len(params['quiet_start']['pairs']) if('quiet_start' in params) else N
+            runtime = {'build':t_build, 'sampling':t_sample*n_sampled, 
+                       'processing':max(t_beam - t_sample*n_calibration, 0)*N/n_calibration}
+
+            output = params['output']
+            if('file' in output):
+                import tempfile
+                with tempfile.TemporaryDirectory() as tmp:
+                    if(output['type']=='shm'):
+                        outfile = f'distgen_plan_{os.getpid()}'
+                    else:
+                        outfile = os.path.join(tmp, os.path.basename(output['file']))
+                    _, t = timed(writer, output['type'], beam, outfile, 0, {k:v for k, v in params.items() if k!='output'})
+                    if(output['type']=='shm'):
+                        data, shm = read_shm(outfile, unlink=True)
+                        del data
+                        shm.close()
+                runtime['writer'] = t*N/n_calibration
+
+            runtime['total'] = sum(runtime.values())
+            plan['runtime'] = runtime
+
+        np.random.set_state(state)
+
+        if(self.verbose>0):
+            vprint(f'Plan for {N} particles ({params["dtype"]}, {params["random_type"]} sampling, {params["storage"]["type"]} storage):', True, 0, True)
+            for var, sampler in samplers.items():
+                vprint(f'{var}: {sampler}', True, 1, True)
+            for stage, size in memory.items():
+                vprint(f'memory {stage}: {size/2**20:.4G} MiB', True, 1, True)
+            if('fits' in plan):
+                vprint(f'fits in the memory budget: {plan["fits"]}', True, 1, True)
+            for stage, t in plan.get('runtime', {}).items():
+                vprint(f'runtime {stage}: {t:.4G} s', True, 1, True)
+
+        return plan
+
     def fingerprint(self):
         """
         Data fingerprint using the input. 
@@ -417,6 +906,9 @@ class Generator:
         
         
         """
+        import h5py
+        from pmd_beamphysics import ParticleGroup
+
         if isinstance(h5, str):
             g = h5py.File(h5, 'r')
             
@@ -453,6 +945,9 @@ class Generator:
         If no file is given, a file based on the fingerprint will be created.
         
         """
+        import h5py
+        from pmd_beamphysics import pmd_init
+
         if not h5:
             h5 = 'distgen_'+self.fingerprint()+'.h5'
             
@@ -497,7 +992,40 @@ class Generator:
             assert req in params, 'Required input parameter '+req+' to '+self.__class__.__name__+'.__init__(**kwargs) was not found.'
 
 
-            
+
+
+# Parsed input files keyed by (path, modification time), for the INPUT_FILE_CACHE_SIZE most recently read. 
+# Each entry holds the parsed 'input', its 'fingerprint', and the unit converted 'params' once a Generator has configured it.
+INPUT_FILE_CACHE_SIZE = 64
+_input_file_cache = LRUCache(INPUT_FILE_CACHE_SIZE)
+
+def read_input_file(filename):
+    """
+    Reads a YAML or JSON distgen input file and expands any relative 'file' paths. 
+
+    Parsed files are cached by path and modification time, so repeated reads are cheap.
+    Returns the cache key and cache entry. The entry must not be modified by the caller. 
+    """
+    key = (filename, os.stat(filename).st_mtime_ns)
+    entry = _input_file_cache.get(key)
+
+    if(entry is None):
+
+        with open(filename) as fid:
+            input = load_yaml(fid)
+
+        # Fill any 'file' keys
+        expand_input_filepaths(input, root=os.path.split(filename)[0], ignore_keys=['output'])
+
+        try:
+            input_fingerprint = fingerprint(input)
+        except TypeError:
+            input_fingerprint = None
+
+        entry = {'input':input, 'fingerprint':input_fingerprint, 'params':None}
+        _input_file_cache[key] = entry
+
+    return key, entry
             
             
 def expand_input_filepaths(input_dict, root=None, ignore_keys=[]):
@@ -533,7 +1061,134 @@ def expand_input_filepaths(input_dict, root=None, ignore_keys=[]):
             
 
 
+def get_importance_dists(var, params, verbose=0):
+    """
+    Gets the distribution of var and the proposal distribution its coordinates are drawn from
+    for importance sampling, defined by the params key proposal (None if not given)
+    """
+    if('proposal' not in params):
+        return get_dist(var, params, verbose=verbose), None
+
+    # Joint samples are not weighted, and theta is drawn with r, whose proposal weights the pair
+    if(var=='theta' or get_vars(var) is not None):
+        raise ValueError(f'A proposal distribution is only supported for r and single coordinate distributions, not for {var}.')
+
+    dist = get_dist(var, {p:v for p, v in params.items() if p!='proposal'}, verbose=verbose)
+
+    vprint(f'{var} proposal distribution: ', verbose>0, 1, False)
+    proposal = get_dist(var, params['proposal'], verbose=verbose)
 
+    return dist, proposal
 
+def dist_fingerprint(var, params):
+    """
+    Fingerprint of the distribution of var defined by the unit converted params, including the modification 
+    time and size of any input file.  Returns None if the params can not be fingerprinted.
+    """
+    def encode(key, value):
+        if(isinstance(value, unit_registry.Quantity)):
+            return ['quantity', np.asarray(value.magnitude).tolist(), str(value.units)]
+        elif(isinstance(value, dict)):
+            return {k:encode(k, v) for k, v in value.items()}
+        elif(isinstance(value, (list, tuple))):
+            return [encode(None, v) for v in value]
+        elif(key=='file' and isinstance(value, str) and os.path.exists(value)):
+            stat = os.stat(value)
+            return [os.path.abspath(value), stat.st_mtime_ns, stat.st_size]
+        return value
+
+    try:
+        return fingerprint({'var':var, 'params':encode(None, params)})
+    except (TypeError, ValueError):
+        return None
+
+_dist_cache = LRUCache(DIST_CACHE_SIZE)
+
+def get_cached_dists(var, params, verbose=0):
+    """
+    Returns the cache entry of the distribution of var: {'dists':(dist, proposal or None) of get_importance_dists, 
+    'text':the description printed while building them with verbose (None if built without), 'time':the build time [s]}.  
+    The distributions are not modified once built, so they are shared by the generators of the process through 
+    an LRU cache of DIST_CACHE_SIZE entries keyed by dist_fingerprint.
+    """
+    key = dist_fingerprint(var, params)
+    entry = _dist_cache.get(key) if(key is not None) else None
 
+    if(entry is None or (verbose>0 and entry['text'] is None)):
 
+        watch = StopWatch()
+        watch.start()
+
+        if(verbose>0):
+            text = io.StringIO()
+            with contextlib.redirect_stdout(text):
+                dists = get_importance_dists(var, params, verbose=verbose)
+            text = text.getvalue()
+        else:
+            dists, text = get_importance_dists(var, params), None
+
+        watch.stop()
+        entry = {'dists':dists, 'text':text, 'time':(watch.tstop-watch.tstart).to('s').magnitude}
+
+        if(key is not None):
+            _dist_cache[key] = entry
+
+    return entry
+
+def memory_bytes(size):
+    """
+    Converts the memory size, a number of bytes, a quantity or a string such as '1 GB', to bytes.  The units 
+    are parsed with MEMORY_UNITS, so that GB is a gigabyte.
+    """
+    if(isinstance(size, unit_registry.Quantity)):
+        value, units = float(size.magnitude), f'{size.units:~}'
+    elif(isinstance(size, str)):
+        value, _, units = size.strip().partition(' ')
+        value, units = float(value), units.strip()
+    else:
+        return float(size)
+
+    units = units or 'B'
+    if(units not in MEMORY_UNITS):
+        raise ValueError(f'storage: memory_budget units "{units}" are not a memory size, use one of: {", ".join(MEMORY_UNITS)}.')
+
+    return value*MEMORY_UNITS[units]
+
+def estimate_memory(params):
+    """
+    Estimates the memory [bytes] used by each stage of Generator.beam and the writer for the configured params, 
+    and the peak over the stages.  Coordinates, weights and bunch trains in memmap storage are not counted, 
+    as they are paged to disk.  Random numbers are drawn into the coordinate rows, and the sampling, transforms 
+    and covariance matching work on chunks of at most 1M particles, so their temporaries do not grow with N.
+    The transforms stage includes the shift of t to the time of a time start.
+    """
+    N = int(params['n_particle'])
+    itemsize = np.dtype(params['dtype']).itemsize
+    in_memory = params['storage']['type']=='memory'
+    n_bunch = params['train']['n_bunch'] if('train' in params) else 1
+    n_sampled = N//2**len(params['quiet_start']['pairs']) if('quiet_start' in params) else N
+    output_type = params.get('output', {}).get('type')
+
+    memory = {'rands':8*RAND_TEMPORARIES*min(n_sampled, 1048576)}
+    memory['coordinates'] = 7*N*itemsize if(in_memory) else 0
+    memory['weights'] = 8*N if(in_memory) else 0
+    memory['sampling'] = 8*SAMPLE_TEMPORARIES*min(n_sampled, SAMPLE_CHUNK_SIZE)
+    memory['transforms'] = 8*(TRANSFORM_TEMPORARIES + (TRANSFORM_COPY_TEMPORARIES if(itemsize<8) else 0))*min(N, TRANSFORM_CHUNK_SIZE) if(params.get('transforms') or params['start']['type']=='time') else 0
+    memory['covariance'] = 8*COVARIANCE_TEMPORARIES*min(N, 1048576) if(params.get('match_covariance')) else 0
+    memory['train'] = n_bunch*(7*itemsize+8)*N if(n_bunch>1 and in_memory) else 0
+    memory['writer'] = WRITER_BYTES.get(output_type, 0)*N*n_bunch + WRITER_CHUNK_BYTES.get(output_type, 0)*min(N*n_bunch, 1048576)
+
+    base = memory['coordinates'] + memory['weights']
+    memory['peak'] = max(base + memory['rands'], base + memory['sampling'], base + memory['transforms'], base + memory['covariance'], base + memory['train'], 
+                         (memory['train'] or base) + memory['writer'])
+
+    return memory
+
+def is_symmetric(dist, tol=1e-6):
+    """
+    Checks if the 1d distribution dist is symmetric about its average, by comparing its cdf on either side
+    """
+    avg = dist.avg()
+    ds = dist.std()*np.array([0.25, 0.5, 1.0, 2.0])
+    asymmetry = dist.cdf(avg-ds) + dist.cdf(avg+ds) - 1
+    return bool(np.max(np.abs(np.asarray(getattr(asymmetry, 'magnitude', asymmetry)))) < tol)
@@ -24,7 +24,7 @@ import numpy
 #from .halton import create_halton_samples
 
 
-def create_hammersley_samples(order, dim=1, burnin=-1, primes=()):
+def create_hammersley_samples(order, dim=1, burnin=-1, primes=(), dtype=float, out=None, chunk_size=1048576):
     """
     Create samples from the Hammersley set.
     For ``dim == 1`` the sequence falls back to Van Der Corput sequence.
@@ -39,17 +39,29 @@ def create_hammersley_samples(order, dim=1, burnin=-1, primes=()):
         primes (tuple):
             The (non-)prime base to calculate values along each axis. If
             empty, growing prime values starting from 2 will be used.
+        dtype (numpy.dtype):
+            Floating point type of the returned samples.
+        out (numpy.ndarray, list):
+            Optional ``dim`` rows of length ``order`` to write the samples
+            into, instead of allocating a new array.
+        chunk_size (int):
+            Number of samples computed at a time, bounding the temporaries.
     Returns:
         (numpy.ndarray):
             Hammersley set with ``shape == (dim, order)``.
     """
     if dim == 1:
         return create_halton_samples(
-            order=order, dim=1, burnin=burnin, primes=primes)
-    out = numpy.empty((dim, order), dtype=float)
-    out[:dim-1] = create_halton_samples(
-        order=order, dim=dim-1, burnin=burnin, primes=primes)
-    out[dim-1] = numpy.linspace(0, 1, order+2)[1:-1]
+            order=order, dim=1, burnin=burnin, primes=primes, dtype=dtype, out=out, chunk_size=chunk_size)
+    if out is None:
+        out = numpy.empty((dim, order), dtype=dtype)
+    create_halton_samples(
+        order=order, dim=dim-1, burnin=burnin, primes=primes, dtype=dtype, out=out[:dim-1], chunk_size=chunk_size)
+    # The regular grid numpy.linspace(0, 1, order+2)[1:-1], computed in chunks with the same rounding
+    step = 1.0/(order+1)
+    for start in range(0, order, chunk_size):
+        stop = min(start+chunk_size, order)
+        out[dim-1][start:stop] = numpy.arange(start+1, stop+1, dtype=numpy.float64)*step
     return out
 
 
@@ -84,7 +96,7 @@ Standard usage::
 
 
 
-def create_halton_samples(order, dim=1, burnin=-1, primes=()):
+def create_halton_samples(order, dim=1, burnin=-1, primes=(), dtype=float, out=None, chunk_size=1048576):
     """
     Create Halton sequence.
 
@@ -101,6 +113,13 @@ def create_halton_samples(order, dim=1, burnin=-1, primes=()):
         primes (tuple):
             The (non-)prime base to calculate values along each axis. If
             empty, growing prime values starting from 2 will be used.
+        dtype (numpy.dtype):
+            Floating point type of the returned samples.
+        out (numpy.ndarray, list):
+            Optional ``dim`` rows of length ``order`` to write the samples
+            into, instead of allocating a new array.
+        chunk_size (int):
+            Number of samples computed at a time, bounding the temporaries.
 
     Returns (numpy.ndarray):
         Halton sequence with ``shape == (dim, order)``.
@@ -117,11 +136,15 @@ def create_halton_samples(order, dim=1, burnin=-1, primes=()):
     if burnin < 0:
         burnin = max(primes)
 
-    out = numpy.empty((dim, order))
-    indices = [idx+burnin for idx in range(order)]
-    for dim_ in range(dim):
-        out[dim_] = create_van_der_corput_samples(
-            indices, number_base=primes[dim_])
+    if out is None:
+        out = numpy.empty((dim, order), dtype=dtype)
+    # Indices are int64, so orders above 2**31 are safe on every platform
+    for start in range(0, order, chunk_size):
+        stop = min(start+chunk_size, order)
+        indices = numpy.arange(start+burnin, stop+burnin, dtype=numpy.int64)
+        for dim_ in range(dim):
+            out[dim_][start:stop] = create_van_der_corput_samples(
+                indices, number_base=primes[dim_])
     return out
 
 
@@ -170,16 +193,19 @@ def create_van_der_corput_samples(idx, number_base=2):
     """
     assert number_base > 1
 
-    idx = numpy.asarray(idx).flatten() + 1
+    idx = numpy.asarray(idx, dtype=numpy.int64).flatten() + 1
     out = numpy.zeros(len(idx), dtype=float)
 
+    # Finished indices are zero and add nothing, so no masking is needed
+    # and the digits can be accumulated in place
     base = float(number_base)
-    active = numpy.ones(len(idx), dtype=bool)
-    while numpy.any(active):
-        out[active] += (idx[active] % number_base)/base
+    digit = numpy.empty(len(idx), dtype=float)
+    while numpy.any(idx):
+        numpy.remainder(idx, number_base, out=digit)
+        digit /= base
+        out += digit
         idx //= number_base
         base *= number_base
-        active = idx > 0
     return out
 
 
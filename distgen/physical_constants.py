@@ -11,7 +11,18 @@ with warnings.catch_warnings():
     Quantity([])
 
 unit_registry = UnitRegistry()
-unit_registry.setup_matplotlib()
+
+_matplotlib_is_setup = False
+
+def setup_matplotlib():
+    """
+    Enables pint unit support in matplotlib.  This is deferred until the first plot 
+    so that importing distgen does not import matplotlib.
+    """
+    global _matplotlib_is_setup
+    if(not _matplotlib_is_setup):
+        unit_registry.setup_matplotlib()
+        _matplotlib_is_setup = True
 
 import scipy.constants
 
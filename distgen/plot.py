@@ -1,7 +1,7 @@
 from matplotlib import pyplot as plt
 import numpy as np
 
-from .physical_constants import unit_registry, pi
+from .physical_constants import unit_registry, pi, setup_matplotlib
 from .tools import histogram
 from .tools import radial_histogram
 from .tools import trapz
@@ -12,6 +12,9 @@ from .tools import mean
 from .tools import centers
 from .tools import zeros
 
+# Importing this module means the user is plotting, so enable pint unit support now
+setup_matplotlib()
+
 LABELS = {'x':'x', 'y':'y', 'z':'z', 'px':'p_x', 'py':'p_y', 'pz':'p_z', 't':'t', 'r':'r', 'pr':'p_r', 'ptheta':'p_{\\theta}','thetax':'\\theta_x'}
 
 def get_scale(beam, scale):
@@ -1,4 +1,4 @@
-from .tools import vprint, StopWatch, is_floatable, is_unit_str
+from .tools import vprint, StopWatch, is_floatable, is_unit_str, load_yaml
 
 import time
 import os
@@ -6,7 +6,7 @@ from collections import OrderedDict as odict
 import json
         
 """
-This class handles input file reading and currently supports reading json files. 
+This class handles input file reading and currently supports reading json and yaml files. 
 Coming soon ascii files.
     
 """
@@ -48,11 +48,20 @@ class Reader():
                 params = json.load(file_handle) 
                 
             except:
-                # If not, read the file assuming ascii format
-                for line in file_handle:
-                    self.file_lines.append(line)
 
-                params="File type not supported"  # ASCII parsing isn't supported yet
+                try:
+                    # Then as yaml
+                    file_handle.seek(0)
+                    params = load_yaml(file_handle)
+                    assert isinstance(params, dict)
+
+                except:
+                    # If not, read the file assuming ascii format
+                    file_handle.seek(0)
+                    for line in file_handle:
+                        self.file_lines.append(line)
+
+                    params="File type not supported"  # ASCII parsing isn't supported yet
                     
         watch.stop()
         vprint("done. Time Ellapsed: "+watch.print(),self.verbose>0,0,True) 
@@ -0,0 +1,324 @@
+"""
+Persistent local generation service.  A server keeps worker processes with the unit registry,
+the parsed input file caches and the distgen imports warm, so that many small jobs do not each
+pay the start up cost of a new process:
+
+    distgen serve --port 8765
+    distgen serve --socket /tmp/distgen.sock
+
+Jobs are JSON dicts {"input": input dict, YAML string or file name, "settings": {...}} posted to /run,
+with settings as in run_distgen.  The beam is written to the output file of the input, which must be
+inside the output directory of the service (relative names are taken relative to it), and the reply
+gives the absolute path.  Jobs without an output file are written to shared memory (output type shm),
+and the reply gives the name of the block, to read with writers.read_shm.  The service unlinks blocks
+not read (and unlinked) by the client within shm_ttl seconds, and any left when it stops.
+
+The Unix socket is only accessible to the user running the service.  HTTP requests must send the
+token of the service as "Authorization: Bearer <token>".  The token is $DISTGEN_SERVE_TOKEN, or else
+generated, and written to a token file only readable by the user (see token_filename), where submit
+finds it.  See submit for the client.
+"""
+
+from .tools import StopWatch, vprint, update_nested_dict, NpEncoder, get_cache_dir
+from .writers import writer, write_shards, shard_files
+from .generator import Generator
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+import http.client
+import multiprocessing
+import itertools
+import threading
+import secrets
+import signal
+import socket
+import hmac
+import json
+import time
+import os
+
+DEFAULT_PORT = 8765
+
+# Seconds a shared memory block written for a job is kept for the client to read
+SHM_TTL = 600
+
+_job_ids = itertools.count()
+
+def token_filename(port=DEFAULT_PORT):
+    """ Returns the default token file of the HTTP service on port, in the distgen cache directory """
+    return os.path.join(get_cache_dir(), f'serve-{port}.token')
+
+def write_token(token, filename):
+    """ Writes the token to filename, only readable and writable by the user """
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    if(os.path.exists(filename)):
+        os.remove(filename)
+    with os.fdopen(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as fid:
+        fid.write(token)
+
+def output_path(filename, output_dir):
+    """
+    Returns the absolute path of the output filename, taken relative to output_dir, after resolving any 
+    symbolic links and '..'.  Raises a ValueError if the path is outside of output_dir.
+    """
+    root = os.path.realpath(output_dir)
+    path = os.path.realpath(os.path.join(root, filename))
+    if(os.path.commonpath([root, path])!=root):
+        raise ValueError(f'Output file {filename} is outside of the output directory {root}.')
+    return path
+
+def run_job(job, output_dir):
+    """
+    Runs a single job in a worker process, returning the reply dict.  Output files must be inside output_dir.
+    """
+    watch = StopWatch()
+    watch.start()
+
+    for key in job:
+        assert key in ['input', 'settings'], f'Unexpected job parameter: {key}'
+    assert 'input' in job, 'Job must specify the input.'
+
+    gen = Generator(job['input'], verbose=0)
+    if(job.get('settings')):
+        gen.input = update_nested_dict(gen.input, job['settings'], verbose=0)
+
+    # Every file the job writes, including shards named by the output pattern, is checked before the beam is generated
+    gen.configure()
+    output = gen.params['output']
+    if('file' in output):
+        output_type, outfile = output['type'], output_path(output['file'], output_dir)
+        files = [output_path(file, output_dir) for file in shard_files(outfile, output['shards'], output.get('pattern'))] if(output.get('shards', 1)>1) else [outfile]
+    else:
+        output_type, outfile = 'shm', f'distgen_{os.getpid()}_{next(_job_ids)}'
+        files = [outfile]
+
+    beam = gen.beam()
+
+    if(len(files)>1):
+        write_shards(output_type, beam, outfile, len(files), files=files)
+    else:
+        writer(output_type, beam, outfile, 0, gen.params)
+    watch.stop()
+
+    result = {'type':output_type, 'output':outfile, 'n_particle':beam['n_particle'],
+              'total_charge':beam.q.to('C').magnitude, 'time':watch.tstop.magnitude-watch.tstart.magnitude}
+
+    # Sharded text outputs only write the shards, openPMD also writes outfile, presenting them as one file
+    if(len(files)>1):
+        result['shards'] = files
+        if(output_type!='openPMD'):
+            result['output'] = files
+
+    return result
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    """ Serves POST /run (run a job) and GET /status """
+
+    def do_POST(self):
+
+        if(not self.authorized()):
+            return self.reply(401, {'error':'Missing or invalid token'})
+
+        if(self.path!='/run'):
+            return self.reply(404, {'error':f'Unknown path {self.path}'})
+
+        try:
+            job = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            result = self.server.pool.apply(run_job, (job, self.server.output_dir))
+            self.server.n_job += 1
+        except Exception as ex:
+            return self.reply(400, {'error':f'{type(ex).__name__}: {ex}'})
+
+        if(result['type']=='shm'):
+            _track_shm(self.server, result['output'])
+
+        self.reply(200, result)
+
+    def do_GET(self):
+
+        if(not self.authorized()):
+            return self.reply(401, {'error':'Missing or invalid token'})
+
+        if(self.path!='/status'):
+            return self.reply(404, {'error':f'Unknown path {self.path}'})
+
+        self.reply(200, {'workers':self.server.n_worker, 'jobs':self.server.n_job, 'pid':os.getpid(), 
+                         'output_dir':self.server.output_dir, 'shm_blocks':len(self.server.shm_blocks)})
+
+    def authorized(self):
+        if(self.server.token is None):
+            return True
+        return hmac.compare_digest(self.headers.get('Authorization', '').encode(), f'Bearer {self.server.token}'.encode())
+
+    def reply(self, code, result):
+        body = json.dumps(result, cls=NpEncoder).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Unix socket clients have no address
+        vprint(format % args, self.server.verbose>0, 1, True)
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def _track_shm(server, name):
+    """ Records the shared memory block name written for a job of server """
+    with server.shm_lock:
+        server.shm_blocks[name] = time.monotonic()
+
+def _release_shm(server, max_age=0):
+    """ Unlinks the shared memory blocks of server written more than max_age seconds ago, unless the client already has """
+    from multiprocessing.shared_memory import SharedMemory
+
+    now = time.monotonic()
+    with server.shm_lock:
+        expired = [name for name, created in server.shm_blocks.items() if(now-created>=max_age)]
+        for name in expired:
+            del server.shm_blocks[name]
+
+    for name in expired:
+        try:
+            shm = SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+
+def serve(socket_file=None, host='localhost', port=DEFAULT_PORT, workers=None, verbose=0, 
+          output_dir=None, token_file=None, shm_ttl=SHM_TTL):
+
+    """
+    Runs the generation service until interrupted, on the Unix socket socket_file if given,
+    otherwise with HTTP on host:port.  Jobs are run by a pool of workers processes (default: one per cpu),
+    and may only write output files inside output_dir (default: the current directory).  HTTP requests
+    must send the token, $DISTGEN_SERVE_TOKEN or a generated one, written to token_file (default: 
+    token_filename(port)).  Shared memory blocks of jobs are unlinked after shm_ttl seconds.
+    """
+
+    workers = workers or os.cpu_count() or 1
+    output_dir = os.path.realpath(output_dir or os.getcwd())
+    assert os.path.isdir(output_dir), f'Output directory {output_dir} does not exist.'
+
+    # Forked workers inherit the warm imports and unit registry of this process
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+
+    if(socket_file):
+        if(os.path.exists(socket_file)):
+            os.remove(socket_file)
+        # Create the socket only accessible to the user, instead of changing its mode after it is bound
+        umask = os.umask(0o177)
+        try:
+            server = _UnixHTTPServer(socket_file, _Handler)
+        finally:
+            os.umask(umask)
+        server.token, token_file = None, None
+        address = socket_file
+    else:
+        server = ThreadingHTTPServer((host, port), _Handler)
+        server.token = os.environ.get('DISTGEN_SERVE_TOKEN') or secrets.token_urlsafe(32)
+        token_file = token_file or token_filename(port)
+        write_token(server.token, token_file)
+        address = f'{host}:{port}'
+
+    server.verbose = verbose
+    server.n_worker = workers
+    server.n_job = 0
+    server.output_dir = output_dir
+    server.shm_blocks = {}
+    server.shm_lock = threading.Lock()
+
+    # Called by serve_forever between requests
+    server.service_actions = lambda: _release_shm(server, shm_ttl)
+
+    with context.Pool(workers) as pool:
+
+        server.pool = pool
+
+        # Stop on SIGTERM as on an interrupt, so the socket, token file and shared memory blocks are removed.
+        # Set after the workers are forked, which keep the default handler.
+        if(threading.current_thread() is threading.main_thread()):
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        vprint(f'distgen serving on {address} with {workers} workers, writing to {output_dir}.', verbose>0, 0, True)
+        vprint(f'Token file: {token_file}', verbose>0 and server.token is not None, 1, True)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            _release_shm(server)
+            if(socket_file and os.path.exists(socket_file)):
+                os.remove(socket_file)
+            if(token_file and os.path.exists(token_file)):
+                os.remove(token_file)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    """ HTTP connection over a Unix socket """
+
+    def __init__(self, socket_file, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_file = socket_file
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_file)
+
+def _connect(address, timeout=None):
+    """ Connects to the service at address: a Unix socket file, or host:port """
+    if(os.sep in address or address.endswith('.sock')):
+        return _UnixHTTPConnection(address, timeout=timeout)
+    host, _, port = address.rpartition(':')
+    return http.client.HTTPConnection(host or 'localhost', int(port), timeout=timeout)
+
+def _token(address):
+    """ Returns the token for the service at address: $DISTGEN_SERVE_TOKEN, or else read from its default token file """
+    if('DISTGEN_SERVE_TOKEN' in os.environ):
+        return os.environ['DISTGEN_SERVE_TOKEN']
+    if(os.sep in address or address.endswith('.sock')):
+        return None
+    filename = token_filename(int(address.rpartition(':')[2]))
+    if(os.path.exists(filename)):
+        with open(filename) as fid:
+            return fid.read().strip()
+
+def submit(input, settings={}, address=f'localhost:{DEFAULT_PORT}', timeout=None, token=None):
+
+    """
+    Submits a job to the service at address (a Unix socket file, or host:port) and returns the reply dict,
+    with the output 'type', the 'output' file or shared memory name, 'n_particle', 'total_charge' [C]
+    and the run 'time' [s].  For sharded output, 'shards' lists the shard files, which are also the 'output'
+    unless it is openPMD.  Input can be an input dict, a YAML string or a file name, which is read
+    by the service.  The token defaults to $DISTGEN_SERVE_TOKEN, or the default token file of the port.
+    Raises a RuntimeError if the job failed.
+    """
+
+    body = json.dumps({'input':input, 'settings':settings}, cls=NpEncoder)
+
+    headers = {'Content-Type':'application/json'}
+    token = token or _token(address)
+    if(token):
+        headers['Authorization'] = f'Bearer {token}'
+
+    connection = _connect(address, timeout=timeout)
+    try:
+        connection.request('POST', '/run', body=body, headers=headers)
+        response = connection.getresponse()
+        result = json.loads(response.read())
+    finally:
+        connection.close()
+
+    if(response.status!=200):
+        raise RuntimeError(f'distgen job failed: {result.get("error")}')
+
+    return result
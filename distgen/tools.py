@@ -1,18 +1,25 @@
 from pint import Quantity
 from .physical_constants import unit_registry 
+from .physical_constants import setup_matplotlib
 
 import time
 import numpy as np
-import scipy.integrate 
 import scipy.special
-import matplotlib.image as mpimg
-from pdf2image import convert_from_path
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader    # libyaml accelerated loader
+except ImportError:
+    from yaml import SafeLoader
+
 import json
 from hashlib import blake2b
 import datetime
+import glob
 import os
+import warnings
+import threading
+from collections import OrderedDict
 
 # HELPER FUNCTIONS:
 
@@ -44,6 +51,15 @@ def vprint(out_str,verbose,indent_number,new_line):
         else:
             print(total_indent+out_str,end="")
 
+def pyplot():
+    """
+    Imports matplotlib.pyplot on first use, with pint unit support enabled. 
+    Plotting functions should call this rather than importing pyplot at module level.
+    """
+    setup_matplotlib()
+    from matplotlib import pyplot as plt
+    return plt
+
 def is_floatable(value):
 
     """Check if an object can be cast to a float, return true if so, false if not"""
@@ -100,19 +116,26 @@ class StopWatch():
 #--------------------------------------------------------------
 # Statistical operations:
 #--------------------------------------------------------------
-def mean(x, weights=None):
-    """ Wraps numpy.mean"""
+def mean(x, weights=None, chunk_size=1048576):
+    """ Wraps numpy.mean, always accumulating in float64. Weighted means are summed in chunks of chunk_size """
     if(weights is None):
-        return np.mean(x)
+        return np.mean(x, dtype=np.float64)
     else:
-        return np.sum(x*weights)
+        total = np.sum(x[:chunk_size]*weights[:chunk_size], dtype=np.float64)
+        for start in range(chunk_size, len(x), chunk_size):
+            total += np.sum(x[start:start+chunk_size]*weights[start:start+chunk_size], dtype=np.float64)
+        return total
 
-def std(x, weights=None):
-    """Wraps numpy.std"""
+def std(x, weights=None, chunk_size=1048576):
+    """Wraps numpy.std, always accumulating in float64. Weighted variances are summed in chunks of chunk_size"""
     if(weights is None):
-        return np.std(x)
+        return np.std(x, dtype=np.float64)
     else:
-        return np.sqrt(np.sum( weights*(x-mean(x,weights))**2 ) )
+        avg = mean(x, weights, chunk_size)
+        total = np.sum( weights[:chunk_size]*(x[:chunk_size]-avg)**2, dtype=np.float64 )
+        for start in range(chunk_size, len(x), chunk_size):
+            total += np.sum( weights[start:start+chunk_size]*(x[start:start+chunk_size]-avg)**2, dtype=np.float64 )
+        return np.sqrt(total)
    
  
 #--------------------------------------------------------------
@@ -131,6 +154,7 @@ def cumtrapz(f, x):
     """
     Numerically integrates f(x) using trapezoid method cummulatively
     """
+    import scipy.integrate
     return scipy.integrate.cumtrapz(f, x, initial=0)
 
 
@@ -203,6 +227,97 @@ def radcumint(f, r):
     return (rcint, rs)
 
 
+@unit_registry.wraps('=A*B', ('=B', '=A'))
+def simpson(f, x):
+    """
+    Numerically integrates f(x) using Simpson's rule.  The grid x must have an odd number of points,
+    with every other point at the center of its panel, as returned by tabulate_pdf.
+    """
+    h = x[2::2] - x[:-2:2]
+    return np.sum( h*(f[:-2:2] + 4*f[1::2] + f[2::2]) )/6
+
+
+def tabulate_pdf(f, a, b, tol=5e-8, n_initial=65, max_points=200001):
+    """
+    Adaptively tabulates the normalized PDF and CDF of the (unnormalized) function f(x) on [a, b].
+    Starting from n_initial uniform points, intervals are bisected until the error of linearly 
+    interpolating the CDF (and so its inverse) between table points, and the local Simpson integration
+    error estimate, are both below tol, where tol is relative to the total probability.  Only the new 
+    points are evaluated at each step.  If the table would exceed max_points first, refinement stops 
+    with a warning.  The returned grid contains every evaluated point, so that each 
+    pair of intervals is a Simpson panel (see simpson), and the CDF is integrated at the same order.
+    Returns the grid, the normalized PDF and the CDF on the grid.
+    """
+    units = a.units
+    x = np.linspace(a.magnitude, b.to(units).magnitude, n_initial)
+
+    fx = f(unit_registry.Quantity(x, units))
+    funits = fx.units
+    fx = np.asarray(fx.magnitude, dtype=float)
+
+    xm = centers(x)
+    fm = np.asarray(f(unit_registry.Quantity(xm, units)).to(funits).magnitude, dtype=float)
+
+    while(True):
+
+        h = np.diff(x)
+        total = np.sum(h*(fx[:-1] + 4*fm + fx[1:]))/6
+
+        if(not total>0):
+            raise ValueError('Normalization of PDF was <= 0')
+
+        # For a linear pdf the CDF deviates from its linear interpolant by h|dp|/8 at the center of an interval,
+        # applied to both halves of each panel.  The trapezoid and Simpson estimates of a panel differ by h|p0+p1-2pm|/3.
+        interpolation_error = h*np.maximum(np.abs(fm-fx[:-1]), np.abs(fx[1:]-fm))/16
+        integration_error = h*np.abs(fx[:-1] + fx[1:] - 2*fm)/3
+
+        refine = np.flatnonzero(np.maximum(interpolation_error, integration_error) > tol*total)
+
+        if(len(refine)==0):
+            break
+
+        if(2*(len(x)+len(refine))-1 > max_points):
+            error = np.max(np.maximum(interpolation_error, integration_error))/total
+            warnings.warn(f'tabulate_pdf: stopped at {2*len(x)-1} points (max_points = {max_points}) with {len(refine)} intervals '
+                          f'above tol = {tol:G}, the largest error is {error:.3G}.')
+            break
+
+        # Split each flagged panel at its center, the new panels need their own centers
+        xl = 0.5*(x[refine] + xm[refine])
+        xr = 0.5*(xm[refine] + x[refine+1])
+        fq = np.asarray(f(unit_registry.Quantity(np.concatenate((xl, xr)), units)).to(funits).magnitude, dtype=float)
+
+        x = np.insert(x, refine+1, xm[refine])
+        fx = np.insert(fx, refine+1, fm[refine])
+
+        shifted = refine + np.arange(len(refine))   # Positions of the left halves after insertion
+        xm = np.insert(xm, refine+1, xr)
+        fm = np.insert(fm, refine+1, fq[len(refine):])
+        xm[shifted] = xl
+        fm[shifted] = fq[:len(refine)]
+
+    h = np.diff(x)
+
+    xs = np.empty(2*len(x)-1)
+    xs[::2] = x
+    xs[1::2] = xm
+
+    ps = np.empty(len(xs))
+    ps[::2] = fx
+    ps[1::2] = fm
+
+    # Integrate each panel, and each left half panel, with the quadratic through the three points
+    Cs = np.zeros(len(xs))
+    Cs[2::2] = np.cumsum( h*(fx[:-1] + 4*fm + fx[1:])/6 )
+    Cs[1::2] = Cs[:-1:2] + h*(5*fx[:-1] + 8*fm - fx[1:])/24
+
+    total = Cs[-1]
+
+    return (unit_registry.Quantity(xs, units), 
+            unit_registry.Quantity(ps/total, 1/units), 
+            unit_registry.Quantity(Cs/total, 'dimensionless'))
+
+
 #--------------------------------------------------------------
 # Interpolation routines
 #--------------------------------------------------------------
@@ -214,6 +329,65 @@ def interp(x, xp, fp):
     return np.interp(x, xp, fp)
 
 
+@unit_registry.wraps(None, ('', None))
+def guide_table(cdf, n=None):
+    """
+    Returns the guide table of a tabulated cdf: for each of n equal probability bins [k/n, (k+1)/n),
+    the index of the last table point with cdf <= k/n.  Defaults to one bin per table point.
+    """
+    if(n is None):
+        n = len(cdf)
+    return np.searchsorted(cdf, np.arange(n)/n, side='right') - 1
+
+
+@unit_registry.wraps('=B', ('', '', '=B', None))
+def guide_interp(x, xp, fp, guide):
+    """
+    1d interpolation of [xp,f(xp)] @ x for increasing xp in [0,1], typically a cdf, using its guide table.
+    Each x starts from the table index of its guide bin and steps forward a few points, the rare
+    remaining values (in bins containing many table points) are found by binary search.
+    Agrees with interp up to rounding.
+    """
+    x = np.asarray(x)
+    shape = x.shape
+    x = x.reshape(-1)
+
+    n_guide, n_table = len(guide), len(xp)
+    max_steps, chunk_size = 4, 65536
+
+    fs = np.empty(x.shape)
+
+    for start in range(0, len(x), chunk_size):
+
+        ps = x[start:start+chunk_size].astype(np.float64)
+
+        inds = guide[np.clip((ps*n_guide).astype(np.intp), 0, n_guide-1)]
+        np.clip(inds, 0, n_table-2, out=inds)
+
+        # Move each index to the last table point with xp <= p
+        active = np.flatnonzero( (xp[inds+1]<=ps) & (inds<n_table-2) )
+
+        for step in range(max_steps):
+            if(len(active)==0):
+                break
+            inds[active] += 1
+            active = active[ (xp[inds[active]+1]<=ps[active]) & (inds[active]<n_table-2) ]
+
+        if(len(active)>0):
+            inds[active] = np.minimum(np.searchsorted(xp, ps[active], side='right')-1, n_table-2)
+
+        # Linear interpolation on the interval, with the left end point for vanishing intervals
+        x1 = xp[inds]
+        dx = xp[inds+1]-x1
+        ts = np.divide(ps-x1, dx, out=np.zeros(ps.shape), where=dx>0)
+        np.clip(ts, 0, 1, out=ts)
+
+        f1 = fp[inds]
+        fs[start:start+chunk_size] = f1 + ts*(fp[inds+1]-f1)
+
+    return fs.reshape(shape)
+
+
 @unit_registry.wraps('=A', ('=A', '=A', None))
 def linspace(x1, x2, N):
     """
@@ -293,17 +467,18 @@ def radial_histogram(r, weights=None, nbins=1000):
 #--------------------------------------------------------------
 # Special Scipy functions
 #--------------------------------------------------------------
+# Results are wrapped with Quantity, as multiplying an array by a unit checks each of its elements in python
 @unit_registry.check('[]')
 def erf(x):
-    return scipy.special.erf(x.magnitude)*unit_registry('dimensionless')
+    return unit_registry.Quantity(scipy.special.erf(x.magnitude), 'dimensionless')
 
 @unit_registry.check('[]')
 def erfinv(x):
-    return scipy.special.erfinv(x.magnitude)*unit_registry('dimensionless')
+    return unit_registry.Quantity(scipy.special.erfinv(x.magnitude), 'dimensionless')
 
 @unit_registry.check('[]')
 def gamma(x):
-    return scipy.special.gamma(x.magnitude)*unit_registry('dimensionless')
+    return unit_registry.Quantity(scipy.special.gamma(x.magnitude), 'dimensionless')
 
 
 # Misc
@@ -311,16 +486,60 @@ def zeros(shape, units):
     """ Wraps numpy.zeros for use with units """
     return np.zeros(shape)*units
 
+def affine(x, scale, shift, out=None, chunk_size=1048576):
+    """
+    Computes scale*x + shift for the 1d array x and scalars scale and shift, in float64 precision. 
+    Lower precision arrays are processed in chunks, so at most chunk_size float64 temporaries exist.
+    The result is written into out, which may be x itself for an in place update.
+    """
+    if(out is None):
+        out = np.empty_like(x)
+
+    if(x.dtype==np.float64):
+        np.multiply(x, scale, out=out)
+        np.add(out, shift, out=out)
+    else:
+        for start in range(0, len(x), chunk_size):
+            chunk = x[start:start+chunk_size].astype(np.float64)
+            chunk *= scale
+            chunk += shift
+            out[start:start+chunk_size] = chunk
+
+    return out
+
+def storage_zeros(shape, dtype=np.float64, directory=None):
+    """
+    Returns an array of zeros, or with directory, an np.memmap of zeros backed by an anonymous temporary
+    file in the scratch directory, for arrays larger than memory.  The file is removed with the array.
+    """
+    if(directory is None):
+        return np.zeros(shape, dtype=dtype)
+
+    import tempfile
+    with tempfile.TemporaryFile(dir=full_path(directory)) as fid:
+        return np.memmap(fid, dtype=dtype, mode='w+', shape=shape)
+
+def astype(x, dtype):
+    """ Casts the magnitude of quantity x to dtype, without copying if it already has that type """
+    return unit_registry.Quantity(np.asarray(x.magnitude).astype(dtype, copy=False), x.units)
+
 
 def get_vars(varstr):
-    """Gets 2d variable labels from a single string"""
-    variables = ['x', 'y', 'z', 'px', 'py', 'pz', 't']
+    """Gets the variable labels from a single string of concatenated labels, e.g. 'xy' or 'xpxypy'"""
+    variables = ['px', 'py', 'pz', 'x', 'y', 'z', 't']
+
+    labels = []
+    while(len(varstr)>0):
+        for var in variables:
+            if(varstr.startswith(var)):
+                labels.append(var)
+                varstr = varstr[len(var):]
+                break
+        else:
+            return None
 
-    #all_2d_vars = {}
-    for var1 in variables:
-        for var2 in variables:
-            if(varstr == f'{var1}{var2}'):
-                return [var1,var2]
+    if(len(labels)>1):
+        return labels
 
 #--------------------------------------------------------------
 # File reading
@@ -345,15 +564,41 @@ def read_2d_file(filename):
     delta_y = float(header2[1])*unit_registry(get_unit_str(header2[3]))
     avg_y = float(header2[2])*unit_registry(get_unit_str(header2[3]))
 
-    Pxy = np.loadtxt(filename,skiprows=2)*unit_registry("1/"+str(avg_x.units)+"/"+str(avg_y.units))
+    Pxy = load_cached_array(filename, lambda f: np.loadtxt(f,skiprows=2))*unit_registry("1/"+str(avg_x.units)+"/"+str(avg_y.units))
 
     xs = avg_x + linspace(-delta_x/2.0,+delta_x/2.0,Pxy.shape[1])
     ys = avg_y + linspace(-delta_y/2.0,+delta_y/2.0,Pxy.shape[0])
 
     return (xs, ys, Pxy, xstr, ystr)
 
+def read_histogram_h5(filename, dataset, variables):
+
+    """ 
+    Reads an N-D histogram from dataset in an HDF5 file.  The bin edges of each variable 
+    are read from datasets {var}_edges next to it, with a 'units' attribute, if present.
+    """
+
+    from h5py import File
+
+    edges = {}
+
+    with File(filename, 'r') as h5:
+
+        hist = h5[dataset][()]
+        group = h5[dataset].parent
+
+        for var in variables:
+            if(f'{var}_edges' in group):
+                units = group[f'{var}_edges'].attrs.get('units', '')
+                if(isinstance(units, bytes)):
+                    units = units.decode()
+                edges[var] = group[f'{var}_edges'][()]*unit_registry(units)
+
+    return (hist, edges)
+
 def read_image_file(filename, rgb_weights = [0.2989, 0.5870, 0.1140]):
 
+    import matplotlib.image as mpimg
     img = mpimg.imread(filename)
     
     if(len(img.shape)>3):
@@ -369,8 +614,132 @@ def read_image_file(filename, rgb_weights = [0.2989, 0.5870, 0.1140]):
 
     return greyscale
 
+def threshold_image(Pxy, threshold=0, invert=False):
+    """
+    Optionally inverts the 2d array Pxy, then zeros all values below threshold*max(Pxy).
+    Returns a new array, Pxy is not modified.
+    """
+    if(invert):
+        Pxy = Pxy.max() - Pxy
+    else:
+        Pxy = np.array(Pxy)
+
+    Pxy[Pxy < threshold*Pxy.max()] = 0
+    return Pxy
+
+#--------------------------------------------------------------
+# Caching
+#--------------------------------------------------------------
+class LRUCache():
+
+    """ Thread safe dict like cache holding the maxsize most recently used entries """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if(key not in self._data):
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if(value is self):
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while(len(self._data)>self.maxsize):
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+#--------------------------------------------------------------
+# Binary caching of parsed input files
+#--------------------------------------------------------------
+def get_cache_dir():
+    """
+    Returns the directory of the .npy sidecars: $DISTGEN_CACHE_DIR if it is set, otherwise the 
+    distgen directory of the user cache ($XDG_CACHE_HOME, defaulting to ~/.cache)
+    """
+    if('DISTGEN_CACHE_DIR' in os.environ):
+        return os.environ['DISTGEN_CACHE_DIR']
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'distgen')
+
+def get_cache_filename(filename, options=None):
+    """
+    Returns the .npy sidecar file name used to cache the parsed contents of filename, in the cache directory.  
+    The name is keyed by the source path and any preprocessing options, followed by a key of the source 
+    modification time and size, so that the sidecars superseded by an edit of the source can be found.
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+
+    source = blake2b(json.dumps([filename, options], sort_keys=True, cls=NpEncoder).encode(), digest_size=8)
+    version = blake2b(json.dumps([stat.st_mtime_ns, stat.st_size]).encode(), digest_size=8)
+
+    return os.path.join(get_cache_dir(), f'.{os.path.basename(filename)}.{source.hexdigest()}.{version.hexdigest()}.npy')
+
+def load_cached_array(filename, loader, options=None):
+    """
+    Returns the array loader(filename), caching it in a binary .npy sidecar file (see get_cache_filename).
+    Later loads of the same unmodified file with the same options memory map the sidecar (read only)
+    instead of parsing the source again.  Writing a sidecar removes those of earlier versions of the source.  
+    If the sidecar can not be written, the array is returned uncached.
+    """
+    cache_file = get_cache_filename(filename, options)
+
+    if(os.path.exists(cache_file)):
+        try:
+            return np.load(cache_file, mmap_mode='r')
+        except (OSError, ValueError):
+            pass   # Unreadable sidecar, parse the source again
+
+    data = np.asarray(loader(filename))
+
+    # Write to a temporary file and rename, so concurrent runs never see a partial sidecar
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp_file, 'wb') as fid:
+            np.save(fid, data)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        if(os.path.exists(tmp_file)):
+            os.remove(tmp_file)
+        return data
+
+    # Sidecars of the same source and options with another modification time or size are stale
+    source = cache_file.rsplit('.', 2)[0]
+    for stale in glob.glob(glob.escape(source)+'.*.npy'):
+        if(stale!=cache_file):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+    return data
+
 #read_pdf_file requires pdf2image python extension
 def read_pdf_file(filename):
+
+    from pdf2image import convert_from_path
+
     #To be able to make and reference files outside /distgen/, config_file_path is created to /distgen/examples/
     config_file_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'examples')
 
@@ -400,9 +769,28 @@ def read_pdf_file(filename):
     # return total number of pages.
     return q
 
+def load_yaml(stream):
+    """
+    Safely loads YAML (or JSON) from a string or file handle, 
+    using the C accelerated loader when libyaml is available
+    """
+    return yaml.load(stream, Loader=SafeLoader)
+
 #--------------------------------------------------------------
 # Nested Dict Functions
 #--------------------------------------------------------------
+def copy_nested(dd):
+    """
+    Copies the dict and list structure of a nested dict, sharing the leaf values.
+    Much cheaper than copy.deepcopy when the leaves are pint quantities.
+    """
+    if(isinstance(dd, dict)):
+        return {k:copy_nested(v) for k, v in dd.items()}
+    elif(isinstance(dd, list)):
+        return [copy_nested(v) for v in dd]
+    else:
+        return dd
+
 def flatten_dict(dd, sep=':', prefix=''):
     """
     Flattens a nested dict into a single dict, with keys concatenated with sep.
@@ -1,11 +1,17 @@
 from .physical_constants import unit_registry
 from .tools import dict_to_quantity
-from .tools import vprint, mean
+from .tools import vprint, mean, std, astype, affine
+from .beam import Beam
 import numpy as np
+import ast
 
 
 ALLOWED_VARIABLES = ['x','y','z','t','r','theta','px','py','pz','pr','ptheta','xp','yp']
 
+COORDINATES = ['x', 'y', 'z', 't', 'px', 'py', 'pz']
+
+TRANSFORM_CHUNK_SIZE = 1048576
+
 def get_variables(varstr):
 
     if(varstr):
@@ -26,6 +32,63 @@ def get_origin(beam,varstr,origin):
 
     return o
 
+def in_place(beam, func, chunk_size=TRANSFORM_CHUNK_SIZE):
+
+    """
+    Calls func(chunk) for each chunk of chunk_size particles, with chunk a Beam of float64 copies (or views) 
+    of their coordinates.  The coordinates func sets, directly or through r, theta, ptheta, xp, ..., are 
+    written back in place, so the beam keeps its storage (e.g. memmap), precision and units, and at most
+    a few chunks of temporaries exist.  Statistics of the beam must be computed by the caller, beforehand.
+    """
+
+    coordinates = {var:beam[var] for var in COORDINATES}
+    N = len(beam['w'])
+
+    for start in range(0, N, chunk_size):
+
+        s = slice(start, min(start+chunk_size, N))
+        values = {var:astype(x[s], np.float64) for var, x in coordinates.items()}
+
+        chunk = Beam(total_charge=beam.q, n_particle=s.stop-s.start)
+        for var, value in values.items():
+            chunk[var] = value
+        chunk['w'] = beam['w'][s]
+
+        func(chunk)
+
+        for var, x in coordinates.items():
+            if(chunk[var] is not values[var]):
+                if(not x.magnitude.flags.writeable):
+                    x = coordinates[var] = unit_registry.Quantity(np.array(x.magnitude), x.units)
+                    beam[var] = x
+                x.magnitude[s] = chunk[var].to(x.units).magnitude
+
+    return beam
+
+def plane_moments(beam, var, chunk_size=TRANSFORM_CHUNK_SIZE):
+
+    """ 
+    Returns the weighted averages and second central moments (avg_x, avg_p, <x^2>, <p^2>, <xp>) of the coordinate var
+    and its angle p = var+'p', as magnitudes in the units of var and dimensionless.  The moments are summed in chunks 
+    of chunk_size, so no full size temporaries are made.
+    """
+
+    x, px, pz, w = beam[var], beam['p'+var], beam['pz'], beam['w'].magnitude
+    angle = lambda s: (px[s]/pz[s].to(px.units)).magnitude
+    chunks = [slice(start, start+chunk_size) for start in range(0, len(w), chunk_size)]
+
+    x0 = mean(x, beam['w']).magnitude
+    p0 = sum(np.sum(angle(s)*w[s], dtype=np.float64) for s in chunks)
+
+    x2, p2, xp = 0, 0, 0
+    for s in chunks:
+        dx, dp = x.magnitude[s]-x0, angle(s)-p0
+        x2 += np.sum(w[s]*dx**2, dtype=np.float64)
+        p2 += np.sum(w[s]*dp**2, dtype=np.float64)
+        xp += np.sum(w[s]*dx*dp, dtype=np.float64)
+
+    return x0, p0, x2, p2, xp
+
 def check_inputs(params, required_params, optional_params, n_variables, name):
 
     assert 'variables' in params, 'All transforms colon separated "variables" string specifying which coordinates to transform.'
@@ -55,9 +118,11 @@ def translate(beam, **params):
     var = params['variables']
     delta = params['delta'] 
     vprint(f'Translating {var} by {delta:g~P}.', params['verbose'], 2, True)
-    beam[var] = delta + beam[var]
-    
-    return beam
+
+    def translate_chunk(chunk):
+        chunk[var] = delta + chunk[var]
+
+    return in_place(beam, translate_chunk)
 
 
 def set_avg(beam, **params):
@@ -65,10 +130,13 @@ def set_avg(beam, **params):
     var = params['variables']
     check_inputs(params, ['avg_'+var], [], 1, 'set_avg(beam, **kwargs)')  
     new_avg = params['avg_'+var] 
-    beam[var] = new_avg + (beam[var]-beam[var].mean())
+    old_avg = mean(beam[var], beam['w'])
     vprint(f'Setting avg_{var} -> {new_avg:G~P}.', params['verbose'], 2, True)
 
-    return beam
+    def set_avg_chunk(chunk):
+        chunk[var] = new_avg + (chunk[var]-old_avg)
+
+    return in_place(beam, set_avg_chunk)
 
 def scale(beam, **params):
 
@@ -81,14 +149,16 @@ def scale(beam, **params):
         scale = float(scale)*unit_registry('dimensionless')
 
     if(fix_average):
-        avg = beam[var].mean()
-        beam[var] = avg + scale*(beam[var]-avg)
+        avg = mean(beam[var], beam['w'])
         vprint(f'Scaling {var} by {scale:G~P} holding avg_{var} = {avg:G~P} constant.', params['verbose'], 2, True)
     else:
-        beam[var] = scale*beam[var]
+        avg = 0*beam[var].units
         vprint(f'Scaling {var} by {scale:G~P}.', params['verbose'], 2, True)
 
-    return beam
+    def scale_chunk(chunk):
+        chunk[var] = avg + scale*(chunk[var]-avg)
+
+    return in_place(beam, scale_chunk)
 
 def set_std(beam, **params):
 
@@ -96,7 +166,7 @@ def set_std(beam, **params):
     check_inputs(params, ['sigma_'+var], [], 1, 'set_std(beam, **kwargs)')  
     new_std = params['sigma_'+var]
     vprint(f'Setting sigma_{var} -> {new_std:G~P}', params['verbose'], 2, True)
-    old_std = beam[var].std()
+    old_std = std(beam[var], beam['w'])
     if(old_std.magnitude>0):
         beam = scale(beam, **{'variables':var,'scale':new_std/old_std, 'fix_average':True})
 
@@ -116,9 +186,25 @@ def set_avg_and_std(beam, **params):
 
     var = params['variables']
     check_inputs(params, ['sigma_'+var, 'avg_'+var], [], 1, 'set_avg_and_std(beam, **kwargs)') 
-    beam = set_std(beam, **{'variables':var, 'sigma_'+var:params['sigma_'+var]})
-    beam = set_avg(beam, **{'variables':var, 'avg_'+var:params['avg_'+var]})
-    vprint(f'Setting avg_{var} -> {beam.avg(var):G~P} and sigma_{var} -> {beam.std(var):G~P}', params['verbose'], 2, True)
+
+    x = beam[var]
+    new_avg = params['avg_'+var].to(x.units).magnitude
+    new_std = params['sigma_'+var].to(x.units).magnitude
+
+    old_avg = mean(x, beam['w']).magnitude
+    old_std = std(x, beam['w']).magnitude
+
+    # Scale about the average and shift to the new average in a single pass: x -> a*x + b
+    scale = new_std/old_std if(old_std>0) else 1.0
+    shift = new_avg - scale*old_avg
+
+    if(x.magnitude.flags.writeable):
+        affine(x.magnitude, scale, shift, out=x.magnitude)
+    else:
+        beam[var] = unit_registry.Quantity(affine(x.magnitude, scale, shift), x.units)
+
+    if(params['verbose']):
+        vprint(f'Setting avg_{var} -> {beam.avg(var):G~P} and sigma_{var} -> {beam.std(var):G~P}', True, 2, True)
 
     return beam
 
@@ -142,8 +228,8 @@ def rotate2d(beam, **params): #variables, angle, origin=None):
     v2 = beam[var2]
 
     if(origin=='centroid'):
-        o1 = v1.mean()
-        o2 = v2.mean()
+        o1 = mean(v1, beam['w'])
+        o2 = mean(v2, beam['w'])
         vprint(f'Rotating {var1}-{var2} by {angle.to("deg"):G~P} around {var1} and {var2} centroid.', params['verbose'], 2, True) 
 
     elif(origin is None):
@@ -156,10 +242,12 @@ def rotate2d(beam, **params): #variables, angle, origin=None):
         o2 = origin[1]
         vprint(f'Rotating {var1}-{var2} by {angle.to("deg"):G~P} around {var1} = {o1:G~P} and {var2} = {o2:G~P}.', params['verbose'], 2, True) 
 
-    beam[var1] =  o1 + C*(v1-o1) - S*(v2-o2)
-    beam[var2] =  o2 + S*(v1-o1) + C*(v2-o2)
+    def rotate2d_chunk(chunk):
+        v1, v2 = chunk[var1], chunk[var2]
+        chunk[var1] =  o1 + C*(v1-o1) - S*(v2-o2)
+        chunk[var2] =  o2 + S*(v1-o1) + C*(v2-o2)
 
-    return beam
+    return in_place(beam, rotate2d_chunk)
 
 
 def shear(beam, **params):
@@ -187,13 +275,10 @@ def shear(beam, **params):
         o1 = origin[0]
         #o2 = origin[1]
 
-    v1 = beam[var1]
-    v2 = beam[var2]
-
-    beam[var2] = v2 + shear_coefficient*(v1-o1)
+    def shear_chunk(chunk):
+        chunk[var2] = chunk[var2] + shear_coefficient*(chunk[var1]-o1)
 
-    
-    return beam
+    return in_place(beam, shear_chunk)
 
 
 def polynomial(beam, **params):#variables, polynomial_coefficients, origin=None, zero_dependent_var=False):
@@ -205,23 +290,27 @@ def polynomial(beam, **params):#variables, polynomial_coefficients, origin=None,
     zero_dependent_var = params['zero_dependent_var']
     origin = params['origin']
 
-    v1 = beam[variables[0]]
-
-    if(zero_dependent_var):
-        v2 = np.zeros(beam[variables[1]].shape)*unit_registry(beam[variables[1]].units)
-    else:
-        v2 = beam[variables[1]]
-   
     origin = get_origin(beam, variables[0], origin)
 
     vprint(f'Applying polynomial p({variables[0]} -> {variables[1]}) around {variables[0]} = {origin:G~P}, with coefficients:', params['verbose'], 2, True) 
-
     for n, coefficient in enumerate(coefficients):
         vprint(f'c{n} = {coefficient.to_reduced_units():G~P},', params['verbose'], 3, True)
-        v2 = v2 + coefficient*np.power(v1-origin,n)
 
-    beam[variables[1]] = v2
-    return beam
+    def polynomial_chunk(chunk):
+
+        v1 = chunk[variables[0]]
+
+        if(zero_dependent_var):
+            v2 = np.zeros(v1.shape)*chunk[variables[1]].units
+        else:
+            v2 = chunk[variables[1]]
+
+        for n, coefficient in enumerate(coefficients):
+            v2 = v2 + coefficient*np.power(v1-origin,n)
+
+        chunk[variables[1]] = v2
+
+    return in_place(beam, polynomial_chunk)
 
 def cosine(beam, **params):#variables, amplitude, phase, omega, zero_dependent_var=False):
 
@@ -237,29 +326,33 @@ def cosine(beam, **params):#variables, amplitude, phase, omega, zero_dependent_v
 
     variables = get_variables(variables)
 
-    v1 = beam[variables[0]]
+    def cosine_chunk(chunk):
 
-    units = beam[variables[1]].units
+        v1 = chunk[variables[0]]
 
-    if(zero_dependent_var):
-        v2 = np.zeros(beam[variables[1]].shape)*unit_registry( str(units)  )
-    else:
-        v2 = beam[variables[1]]
+        if(zero_dependent_var):
+            v2 = np.zeros(v1.shape)*chunk[variables[1]].units
+        else:
+            v2 = chunk[variables[1]]
 
-    beam[variables[1]] = v2 + amplitude*np.cos( omega*v1 + phase )
-    return beam
+        chunk[variables[1]] = v2 + amplitude*np.cos( omega*v1 + phase )
+
+    return in_place(beam, cosine_chunk)
 
 
-def matrix2d(beam, variables, m11, m12, m21, m22):
+def matrix2d(beam, **params):
 
-   variables = get_variables(variables)
-   v1 = beam[variables[0]]
-   v2 = beam[variables[1]]
+    check_inputs(params, ['m11', 'm12', 'm21', 'm22'], [], 2, 'matrix2d(beam, **kwargs)')
+    variables = get_variables(params['variables'])
+    m11, m12, m21, m22 = params['m11'], params['m12'], params['m21'], params['m22']
 
-   beam[variables[0]] = m11*v1 + m12*v2
-   beam[variables[1]] = m21*v1 + m22*v2
+    def matrix2d_chunk(chunk):
+        v1 = chunk[variables[0]]
+        v2 = chunk[variables[1]]
+        chunk[variables[0]] = m11*v1 + m12*v2
+        chunk[variables[1]] = m21*v1 + m22*v2
 
-   return beam
+    return in_place(beam, matrix2d_chunk)
 
 
 def magnetize(beam, **params):
@@ -285,10 +378,19 @@ def set_twiss(beam, **params): #plane, beta, alpha, eps):
 
     check_inputs(params, [], ['beta','alpha','emittance'], 1, 'set_twiss(beam, **kwargs)') 
 
-    xstr = params['variables']
-    beta0, alpha0, eps0 = beam.twiss(xstr)
-
     plane = params['variables']
+    if(plane not in ['x','y']):
+        raise ValueError('set_twiss -> unsupported twiss plane: '+plane)
+
+    xstr = plane
+    pstr = xstr+'p'
+    units = beam[xstr].units
+
+    # The initial twiss parameters, as Beam.twiss, from moments summed in chunks
+    x0, p0, x2, p2, xp = plane_moments(beam, xstr)
+    eps0 = np.sqrt(x2*p2 - xp**2)*units
+    beta0 = x2*units**2/eps0
+    alpha0 = -xp*units/eps0
 
     if('beta' in params):
         beta = params['beta']
@@ -307,36 +409,251 @@ def set_twiss(beam, **params): #plane, beta, alpha, eps):
 
     vprint(f'Setting beta_{plane} -> {beta:G~P}, alpha_{plane} -> {alpha:G~P}, and emittance_{plane} -> {eps:G~P}.', params['verbose'], 2, True) 
 
-    if(plane not in ['x','y']):
-        raise ValueError('set_twiss -> unsupported twiss plane: '+plane)
-
-    xstr = plane
-    pstr = xstr+'p'
-
-    x0 = beam[xstr]
-    p0 = beam[pstr]
-
-    avg_x0 = x0.mean()
-    beam[xstr]=beam[xstr]-avg_x0
-
-    avg_p0 = p0.mean()
-    beam[pstr]=beam[pstr]-avg_p0
+    avg_x0 = unit_registry.Quantity(x0, units)
+    avg_p0 = unit_registry.Quantity(p0, 'dimensionless')
 
     assert beta0>0, f'Error in set_twiss: initial beta = {beta0} was <=0, the initial distribution must have finite size to use this transform.'
     assert eps0>0, f'Error in set_twiss: initial emit = {eps0} was <=0, the initial distribution must have finite size to use this transform.'
     assert beta>0, f'Error in set_twiss: final beta = {beta} was <=0, the final distribution must have finite size to use this transform.'
 
     m11 = (np.sqrt(beta*eps/beta0/eps0)).to_base_units()
-    m12 = (0*unit_registry(str(beam[xstr].units)+'/'+str(beam[pstr].units))).to_base_units()
+    m12 = (0*units).to_base_units()
     m21 = (( (alpha0-alpha)/np.sqrt(beta*beta0) )*np.sqrt(eps/eps0)).to_base_units()
     m22 = (np.sqrt(beta0/beta)*np.sqrt(eps/eps0)).to_base_units()
 
-    beam = matrix2d(beam, xstr+':'+pstr, m11, m12, m21, m22)
-    beam[xstr] = avg_x0 + beam[xstr]
-    beam[pstr] = avg_p0 + beam[pstr]
+    # The matrix is applied about the centroid, in a single pass
+    def set_twiss_chunk(chunk):
+        dx = chunk[xstr] - avg_x0
+        dp = chunk[pstr] - avg_p0
+        chunk[xstr] = avg_x0 + m11*dx + m12*dp
+        chunk[pstr] = avg_p0 + m21*dx + m22*dp
+
+    return in_place(beam, set_twiss_chunk)
+
+# Expression transforms:
+
+EXPRESSION_COORDINATES = ['x', 'y', 'z', 't', 'px', 'py', 'pz']
+
+# Functions of dimensionless arguments, and those that keep the units of their (first) argument
+EXPRESSION_FUNCTIONS = {'sin':np.sin, 'cos':np.cos, 'tan':np.tan, 'arcsin':np.arcsin, 'arccos':np.arccos, 'arctan':np.arctan,
+                        'sinh':np.sinh, 'cosh':np.cosh, 'tanh':np.tanh, 'exp':np.exp, 'log':np.log, 'log10':np.log10}
+EXPRESSION_UNIT_FUNCTIONS = {'abs':np.abs, 'sqrt':np.sqrt, 'hypot':np.hypot, 'arctan2':np.arctan2}
+
+EXPRESSION_OPERATORS = {ast.Add:np.add, ast.Sub:np.subtract, ast.Mult:np.multiply, ast.Div:np.divide, ast.Pow:np.power}
+
+# Constant exponents with a fast ufunc, as np.power with a scalar exponent does not use them
+EXPRESSION_POWERS = {1:np.positive, 2:np.square, 0.5:np.sqrt, -1:np.reciprocal}
+
+class ExpressionPlan():
+
+    """
+    Vectorized evaluation plan of an expression of the beam coordinates, e.g. 'pz + A*sin(k*z) + B*x**2', 
+    parsed with ast.  Only arithmetic, numbers, the functions above, pi, the coordinates (in units) and the 
+    constants (quantities) are allowed.  The units are checked once, when the plan is made: subexpressions
+    of constants are folded, and the unit conversions are folded into scale factors.  The plan is a list of 
+    numpy ufunc steps, each writing into one of a set of reused chunk sized registers.
+    """
+
+    def __init__(self, source, units, constants={}):
+
+        self.source = source
+        self.units = units
+        self.constants = {**constants, 'pi':np.pi*unit_registry('dimensionless')}
+
+        self.steps = []
+        self.n_register = 0
+        self._free = []
+
+        tree = ast.parse(source.strip(), mode='eval')
+        self.result = self._compile(tree.body)
+
+        # The result is always left in a register, so that coordinates can be overwritten once every plan is evaluated
+        if(self.result[0]!='register'):
+            one = 1*unit_registry('dimensionless')
+            self.result = self._apply(np.multiply, [self.result, ('constant', one, one.units)], self.result[2])
+
+    def _register(self):
+        if(self._free):
+            return self._free.pop()
+        self.n_register += 1
+        return self.n_register-1
+
+    def _apply(self, ufunc, operands, units):
+        """ Adds the step ufunc(*operands), returning its ('register', index, units) """
+        for operand in operands:
+            if(operand[0]=='register'):
+                self._free.append(operand[1])
+        out = self._register()
+        self.steps.append((ufunc, [(kind, value) for kind, value, _ in operands], out))
+        return ('register', out, units)
+
+    def _scale(self, operand, units):
+        """ Converts operand to units, which must have the same dimensions """
+        factor = unit_registry.Quantity(1, operand[-1]).to(units).magnitude
+        if(operand[0]=='constant'):
+            return ('constant', operand[1].to(units), units)
+        if(factor==1):
+            return operand[:2] + (units,)
+
+        # Fold the factor into the constant of a product computing the operand
+        if(operand[0]=='register'):
+            ufunc, args, out = [step for step in self.steps if step[2]==operand[1]][-1]
+            if(ufunc is np.multiply and args[-1][0]=='constant'):
+                args[-1] = ('constant', args[-1][1]*factor)
+                return operand[:2] + (units,)
+            if(ufunc is np.multiply and args[0][0]=='constant'):
+                args[0] = ('constant', args[0][1]*factor)
+                return operand[:2] + (units,)
+
+        return self._apply(np.multiply, [operand, ('constant', factor*unit_registry('dimensionless'), units)], units)
+
+    def _dimensionless(self, operand):
+        return self._scale(operand, unit_registry('dimensionless').units)
+
+    def _compile(self, node):
+
+        """ Compiles node, returning ('constant', quantity, units), ('coordinate', name, units) or ('register', index, units) """
+
+        if(isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool)):
+            value = node.value*unit_registry('dimensionless')
+            return ('constant', value, value.units)
+
+        elif(isinstance(node, ast.Name)):
+            if(node.id in self.units):
+                return ('coordinate', node.id, self.units[node.id])
+            assert node.id in self.constants, f'expression: unknown name "{node.id}" in "{self.source}".'
+            value = self.constants[node.id]
+            if(not isinstance(value, unit_registry.Quantity)):
+                value = float(value)*unit_registry('dimensionless')
+            return ('constant', value, value.units)
+
+        elif(isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd))):
+            operand = self._compile(node.operand)
+            if(isinstance(node.op, ast.UAdd)):
+                return operand
+            if(operand[0]=='constant'):
+                return ('constant', -operand[1], operand[2])
+            return self._apply(np.negative, [operand], operand[2])
+
+        elif(isinstance(node, ast.BinOp) and type(node.op) in EXPRESSION_OPERATORS):
+
+            left, right = self._compile(node.left), self._compile(node.right)
+            ufunc = EXPRESSION_OPERATORS[type(node.op)]
+
+            if(left[0]=='constant' and right[0]=='constant'):
+                value = ufunc(left[1], right[1])
+                return ('constant', value, value.units)
+
+            if(isinstance(node.op, (ast.Add, ast.Sub))):
+                units = left[2] if(left[0]!='constant') else right[2]      # Coordinate units are kept where possible
+                return self._apply(ufunc, [self._scale(left, units), self._scale(right, units)], units)
+
+            elif(isinstance(node.op, ast.Mult)):
+                return self._apply(ufunc, [left, right], left[2]*right[2])
+
+            elif(isinstance(node.op, ast.Div)):
+                return self._apply(ufunc, [left, right], left[2]/right[2])
+
+            # Powers of quantities with units need a constant exponent
+            exponent = self._dimensionless(right)
+            if(exponent[0]=='constant' and exponent[1].magnitude in EXPRESSION_POWERS):
+                return self._apply(EXPRESSION_POWERS[exponent[1].magnitude], [left], left[2]**exponent[1].magnitude)
+            if(exponent[0]=='constant'):
+                return self._apply(ufunc, [left, exponent], left[2]**exponent[1].magnitude)
+            return self._apply(ufunc, [self._dimensionless(left), exponent], exponent[2])
+
+        elif(isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords):
+
+            name = node.func.id
+            assert name in EXPRESSION_FUNCTIONS or name in EXPRESSION_UNIT_FUNCTIONS, f'expression: unknown function "{name}" in "{self.source}".'
+
+            args = [self._compile(arg) for arg in node.args]
+            n_arg = 2 if name in ['hypot', 'arctan2'] else 1
+            assert len(args)==n_arg, f'expression: {name} takes {n_arg} argument(s).'
+
+            if(name in EXPRESSION_FUNCTIONS):
+                args = [self._dimensionless(arg) for arg in args]
+                units = unit_registry('dimensionless').units
+            elif(name=='sqrt'):
+                units = args[0][2]**0.5
+            elif(name=='arctan2'):
+                args = [args[0], self._scale(args[1], args[0][2])]
+                units = unit_registry('dimensionless').units
+            else:
+                args = [args[0]] + [self._scale(arg, args[0][2]) for arg in args[1:]]
+                units = args[0][2]
+
+            ufunc = {**EXPRESSION_FUNCTIONS, **EXPRESSION_UNIT_FUNCTIONS}[name]
+            if(all(arg[0]=='constant' for arg in args)):
+                value = unit_registry.Quantity(ufunc(*[arg[1].magnitude for arg in args]), units)
+                return ('constant', value, value.units)
+            return self._apply(ufunc, args, units)
+
+        raise ValueError(f'expression: unsupported syntax {type(node).__name__} in "{self.source}".')
+
+    def evaluate(self, coordinates, chunk, registers):
+        """
+        Evaluates the plan for the particles in chunk (a slice) of the dict of coordinate arrays (magnitudes 
+        in self.units), using registers, a list of at least n_register float64 arrays of the chunk size.  
+        Returns the register holding the result and its units.
+        """
+        n = chunk.stop-chunk.start
+        for ufunc, operands, out in self.steps:
+            args = [registers[value][:n] if kind=='register' else coordinates[value][chunk] if kind=='coordinate' else value.magnitude 
+                    for kind, value in operands]
+            ufunc(*args, out=registers[out][:n])
+        return registers[self.result[1]][:n], self.result[2]
+
+
+def expression(beam, **params):
+
+    """
+    Sets coordinates to expressions of the beam coordinates and constants, e.g. 
+        {'type':'expression', 'pz':'pz + A*sin(k*z) + B*x**2', 'A':1*keV/c, 'k':1/mm, 'B':0.1*keV/c/mm**2}.
+    All expressions are evaluated from the coordinates before the transform, in place, one chunk of 
+    chunk_size particles at a time, with reused temporaries.
+    """
+
+    chunk_size = int(params.get('chunk_size', 1048576))
+    verbose = params.get('verbose', False)
+
+    sources = {var:params[var] for var in EXPRESSION_COORDINATES if var in params}
+    constants = {p:v for p, v in params.items() if p not in sources and p not in ['type', 'variables', 'verbose', 'chunk_size']}
+    assert sources, f'expression: at least one coordinate ({", ".join(EXPRESSION_COORDINATES)}) must be set.'
+
+    for name in constants:
+        assert name.isidentifier() and name not in EXPRESSION_FUNCTIONS and name not in EXPRESSION_UNIT_FUNCTIONS, f'expression: invalid constant name "{name}".'
+
+    units = {var:beam[var].units for var in EXPRESSION_COORDINATES}
+    coordinates = {var:beam[var].magnitude for var in EXPRESSION_COORDINATES}
+    plans = {var:ExpressionPlan(str(source), units, constants) for var, source in sources.items()}
+
+    for var, plan in plans.items():
+        assert unit_registry.Quantity(1, plan.result[2]).check(units[var].dimensionality), f'expression: {var} = {plan.source} has units of {plan.result[2]:~P}, not {units[var]:~P}.'
+        vprint(f'Setting {var} -> {plan.source}.', verbose, 2, True)
+
+    N = len(coordinates['x'])
+    registers = {var:[np.empty(min(chunk_size, N)) for _ in range(plan.n_register)] for var, plan in plans.items()}
+
+    for start in range(0, N, chunk_size):
+        chunk = slice(start, min(start+chunk_size, N))
+        results = {var:plan.evaluate(coordinates, chunk, registers[var]) for var, plan in plans.items()}
+        for var, (result, result_units) in results.items():
+            np.multiply(result, unit_registry.Quantity(1, result_units).to(units[var]).magnitude, out=coordinates[var][chunk])
 
     return beam
 
+# The transform types, by name
+TRANSFORMS = {'translate':translate, 'set_avg':set_avg, 'scale':scale, 'set_std':set_std, 'set_stdxy':set_stdxy, 
+              'set_avg_and_std':set_avg_and_std, 'rotate2d':rotate2d, 'shear':shear, 'polynomial':polynomial, 
+              'cosine':cosine, 'matrix2d':matrix2d, 'magnetize':magnetize, 'set_twiss':set_twiss, 'expression':expression}
+
+def get_transform(transfunc):
+    """ Returns the function of the transform type transfunc """
+    if(transfunc not in TRANSFORMS):
+        raise ValueError(f'Transform type "{transfunc}" is not supported, must be one of: {", ".join(TRANSFORMS)}.')
+    return TRANSFORMS[transfunc]
+
 def transform(beam, T):
 
     desc = T['type']
@@ -351,7 +668,6 @@ def transform(beam, T):
     #print(variables)
     T['variables']=varstr
 
-    transform_fun = globals()[transfunc]
-    return transform_fun(beam, **T)
+    return get_transform(transfunc)(beam, **T)
 
 
@@ -1,11 +1,11 @@
-from .tools import vprint, StopWatch, mean
+from .tools import vprint, StopWatch, mean, std
 from .physical_constants import  *
 
 import numpy as np
 import subprocess
 import os
+import json
 from collections import OrderedDict as odict
-from h5py import File
 
 def get_species_charge(species):
 
@@ -16,12 +16,110 @@ def get_species_charge(species):
     else:
         raise ValueError(f'get_species_charge: Species "{species}" is not supported.')
 
+# Units the text writers convert the beam coordinates to, in place
+GPT_UNITS = {'x':'m', 'y':'m', 'z':'m', 'px':'GB', 'py':'GB', 'pz':'GB', 't':'s'}
+ASTRA_UNITS = {'x':'m', 'y':'m', 'z':'m', 'px':'eV/c', 'py':'eV/c', 'pz':'eV/c', 't':'ns'}
+
+def get_writer(output_format):
+
+    """ Returns the writer function of the output format """
+
+    file_writer = {'gpt':write_gpt, 'astra':write_astra, 'openPMD':write_openPMD, 'shm':write_shm}
+
+    if(output_format not in file_writer):
+        raise ValueError(f'Output type "{output_format}" is not supported, must be one of: {", ".join(file_writer)}.')
+
+    return file_writer[output_format]
+
+def check_output(output):
+
+    """ 
+    Checks that the output params (type, file, shards, pattern) can be written before any beam is generated:
+    the writer exists, with its dependencies, and the output directory of the file exists 
+    """
+
+    get_writer(output['type'])
+
+    if(output['type']=='openPMD'):
+        import importlib.util
+        assert importlib.util.find_spec('h5py') is not None, 'openPMD output requires h5py.'
+
+    if('file' not in output):
+        return
+
+    files = shard_files(output['file'], output['shards'], output.get('pattern')) if('shards' in output) else [output['file']]
+    if(output['type']!='shm'):
+        for file in files:
+            directory = os.path.dirname(os.path.abspath(file))
+            assert os.path.isdir(directory), f'Output directory "{directory}" does not exist.'
+
 def writer(output_format,beam,outfile,verbose=0,params=None):
 
     """ Returns a simulaiton code specific writer function """
 
-    file_writer = {'gpt':write_gpt, 'astra':write_astra, 'openPMD':write_openPMD}
-    file_writer[output_format](beam, outfile, verbose, params)
+    shards = params['output'].get('shards', 1) if(params is not None and 'output' in params) else 1
+    if(shards>1):
+        write_shards(output_format, beam, outfile, shards, pattern=params['output'].get('pattern'), verbose=verbose)
+    else:
+        get_writer(output_format)(beam, outfile, verbose, params)
+
+def shard_files(outfile, n_shard, pattern=None):
+
+    """ 
+    Returns the file names of the n_shard shards of outfile, from the format string pattern with fields 
+    root, ext (from os.path.splitext(outfile)) and shard, defaulting to '{root}.{shard}{ext}'
+    """
+
+    if(pattern is None):
+        pattern = '{root}.{shard}{ext}'
+
+    root, ext = os.path.splitext(outfile)
+    files = [pattern.format(root=root, ext=ext, shard=shard) for shard in range(n_shard)]
+    assert len(set(files))==n_shard, f'Shard file pattern "{pattern}" does not give a unique file per shard.'
+
+    return files
+
+def write_shards(output_format, beam, outfile, n_shard, pattern=None, verbose=0, files=None):
+
+    """
+    Writes the beam as n_shard files, one per contiguous range of the particles (see Beam.split), 
+    named files, defaulting to shard_files, in parallel threads.  For openPMD output, outfile is written 
+    with HDF5 virtual datasets presenting the shards as a single particle group.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    file_writer = get_writer(output_format)
+
+    watch = StopWatch()
+    watch.start()
+
+    if(files is None):
+        files = shard_files(outfile, n_shard, pattern)
+    assert len(files)==n_shard, f'write_shards: {len(files)} file names given for {n_shard} shards.'
+    vprint(f'Printing {beam["n_particle"]} particles to {n_shard} shards "{files[0]}", ..., "{files[-1]}": ', verbose>0, 0, False)
+
+    # The text writers convert the beam to their units in place, which must happen before it is split into views
+    writer_units = {'gpt':GPT_UNITS, 'astra':ASTRA_UNITS}.get(output_format, {})
+    for var, unit in writer_units.items():
+        beam[var].ito(unit)
+
+    shards = beam.split(n_shard)
+
+    # Astra shards are relative to the reference particle of the whole beam, which is written (with the probes) 
+    # only in the first shard, so the shard files concatenate to the single file
+    if(output_format=='astra'):
+        reference = astra_reference(beam)
+        file_writer = lambda shard, file: write_astra(shard, file, reference=reference, header=file==files[0])
+
+    with ThreadPoolExecutor(max_workers=min(n_shard, os.cpu_count() or 1)) as executor:
+        list(executor.map(lambda shard_file: file_writer(*shard_file), zip(shards, files)))
+
+    if(output_format=='openPMD'):
+        write_openpmd_vds(beam, outfile, files)
+
+    watch.stop() 
+    vprint(f'done. Time ellapsed: {watch.print()}.', verbose>0, 0, True)
 
 def asci2gdf(gdf_file, txt_file, asci2gdf_bin, remove_txt_file=True):
 
@@ -39,19 +137,18 @@ def asci2gdf(gdf_file, txt_file, asci2gdf_bin, remove_txt_file=True):
     return result
     
 
-def write_gpt(beam,outfile,verbose=0,params=None,asci2gdf_bin=None):  
+def write_gpt(beam,outfile,verbose=0,params=None,asci2gdf_bin=None,chunk_size=1048576):  
 
 
-        """ Writes particles to file in GPT format """
+        """ Writes particles to file in GPT format, formatting chunk_size particles at a time """
 
         watch = StopWatch()
 
         # Format particles
-        gpt_units={"x":"m", "y":"m", "z":"m","px":"GB","py":"GB","pz":"GB","t":"s"}
+        gpt_units = GPT_UNITS
 
         qspecies = get_species_charge(beam.species)
         qspecies.ito("coulomb")
-        qs = np.full((beam['n_particle'],),1.0)*qspecies
         qbunch = beam.q.to("coulomb")
 
         watch.start()
@@ -59,7 +156,6 @@ def write_gpt(beam,outfile,verbose=0,params=None,asci2gdf_bin=None):
         assert beam.species == 'electron' # TODO: add more species
 
         nspecies = np.abs(qbunch.magnitude/qspecies.magnitude)
-        nmacro = nspecies*np.abs(beam["w"])    #np.full((beam.n,),1)*np.abs( (beam.q.to("coulomb")).magnitude/beam.n/qspecies.magnitude)
 
         vprint(f'Printing {(beam["n_particle"])} particles to "{outfile}": ',verbose>0, 0, False)
         
@@ -70,15 +166,6 @@ def write_gpt(beam,outfile,verbose=0,params=None,asci2gdf_bin=None):
         headers = odict( {'x':'x', 'y':'y', 'z':'z', 'px':'GBx',  'py':'GBy', 'pz':'GBz', 't':'t', 'q':'q', 'nmacro':'nmacro'} )
         header = '   '.join(headers.values())
 
-        data = np.zeros( (len(beam["x"]),len(headers)) )
-        for index, var in enumerate(headers):
-            if(var=="q"):
-                data[:,index]=qs.magnitude
-            elif(var=="nmacro"):
-                data[:,index]=nmacro.magnitude
-            else:
-                data[:,index] = beam[var].magnitude
-
         if(".txt"==outfile[-4:]):
         	gdffile = outfile[:-4]+".gdf"
         elif('.gdf'==outfile[-4:]):
@@ -87,7 +174,21 @@ def write_gpt(beam,outfile,verbose=0,params=None,asci2gdf_bin=None):
         else:
                 gdffile = outfile+".gdf"
 
-        np.savetxt(outfile ,data, header=header ,comments='')
+        # The rows are formatted in chunks, bounding the memory of the text columns 
+        n_particle = len(beam["x"])
+        with open(outfile, 'w') as fid:
+            for start in range(0, n_particle, chunk_size):
+                chunk = slice(start, min(start+chunk_size, n_particle))
+                data = np.zeros( (chunk.stop-chunk.start,len(headers)) )
+                for index, var in enumerate(headers):
+                    if(var=="q"):
+                        data[:,index]=qspecies.magnitude
+                    elif(var=="nmacro"):
+                        data[:,index]=nspecies*np.abs(beam["w"].magnitude[chunk])    
+                    else:
+                        data[:,index] = beam[var].magnitude[chunk]
+
+                np.savetxt(fid, data, header=header if(start==0) else '', comments='')
    
         if(asci2gdf_bin):
             gdfwatch = StopWatch()
@@ -111,18 +212,43 @@ def write_gpt(beam,outfile,verbose=0,params=None,asci2gdf_bin=None):
         vprint(f'done. Time ellapsed: {watch.print()}.', verbose>0 and not asci2gdf_bin, 0, True)
 
 
+def astra_reference(beam):
+
+    """ 
+    Returns the Astra reference particle, the weighted centroid of the beam with no charge, and the weighted 
+    rms of each coordinate, as dicts of magnitudes in ASTRA_UNITS, and the average macro charge [nC].  
+    The last two set the probe particles.
+    """
+
+    ref_particle = {'q':0}
+    sigma = {}
+    for k in ['x', 'y', 'z', 'px', 'py', 'pz', 't']:
+        ref_particle[k] = mean(beam[k], beam['w']).to(ASTRA_UNITS[k]).magnitude
+        sigma[k] = std(beam[k], beam['w']).to(ASTRA_UNITS[k]).magnitude
+
+    q_macro = beam.q.to('nC').magnitude / beam['n_particle']
+
+    return ref_particle, sigma, q_macro
+
 def write_astra(beam,
                 outfile,
                 verbose=False,
                 params=None,
                 species='electron',
-                probe=True):
+                probe=True,
+                reference=None,
+                header=True,
+                chunk_size=1048576):
     """
-    Writes Astra style particles from a beam.
+    Writes Astra style particles from a beam, with the charge of each particle from its weight.
     
     For now, the species must be electrons. 
     
     If probe, the six standard probe particles will be written. 
+
+    The z, pz and t of the particles are relative to the reference particle (see astra_reference), 
+    computed from the beam unless given.  Without header, the reference and probe particles are not 
+    written, e.g. for all but the first shard of a beam.  The particles are formatted chunk_size at a time.
     """
     watch = StopWatch()
     watch.start()
@@ -131,45 +257,31 @@ def write_astra(beam,
 
     assert species == 'electron' # TODO: add more species
     
-    # number of lines in file
-    size = beam['n_particle'] + 1 # Allow one for reference particle
-    i_start = 1 # Start for data particles
-    if probe:
+    # number of lines before the particles
+    i_start = 0 # Start for data particles
+    if header:
+        i_start += 1 # Allow one for reference particle
+    if header and probe:
         # Add six probe particles, according to the manual
-        size += 6
         i_start += 6
     
-    # macro charge for each particle
-    q_macro = beam.q.to('nC').magnitude / beam['n_particle']
-    
-    qs = np.full((beam['n_particle'],), 1.0)*q_macro*unit_registry("nanocoulomb")
-
     # Astra units and types
-    units = ['m', 'm', 'm', 'eV/c', 'eV/c', 'eV/c', 'ns', 'nC']
     names = ['x', 'y', 'z', 'px', 'py', 'pz', 't', 'q', 'index', 'status']
-    types = 8*[np.float] + 2*[np.int8]
+    types = 8*[np.float64] + 2*[np.int8]
+    dtype = np.dtype(list(zip(names, types)))
+    fmt = ' '.join(8*['%20.12e']+2*['%4i'])
+
     # Convert to these units in place
-    for i in range(8):
-        name = names[i]
-        if(name=="q"):
-            qs.ito(units[i])
-        else:
-            beam[name].ito(units[i])
+    for name in names[:7]:
+        beam[name].ito(ASTRA_UNITS[name])
     
     # Reference particle
-    ref_particle = {'q':0}
-    sigma = {}
-    for k in ['x', 'y', 'z', 'px', 'py', 'pz', 't']:
-        ref_particle[k] = np.mean(beam[k]).magnitude
-        sigma[k] =  np.std(beam[k]).magnitude
+    if(reference is None):
+        reference = astra_reference(beam)
+    ref_particle, sigma, q_macro = reference
         
-    # Make structured array
-    dtype = np.dtype(list(zip(names, types)))
-    data = np.zeros(size, dtype=dtype)
-    for k in ['x', 'y', 'z', 'px', 'py', 'pz', 't']:
-        data[k][i_start:] = beam[k].magnitude
-    
-    # Set these to be the same
+    # Structured array of the reference and probe particles
+    data = np.zeros(i_start, dtype=dtype)
     data['q'] = q_macro    
     data['index'] = 1    # electron
     data['status'] = -1  # Particle at cathode
@@ -179,11 +291,12 @@ def write_astra(beam,
         data[k] -= ref_particle[k]
         
     # Put ref particle in first position
-    for k in ref_particle:
-        data[k][0] = ref_particle[k]
+    if header:
+        for k in ref_particle:
+            data[k][0] = ref_particle[k]
     
     # Optional: probes, according to the manual
-    if probe:
+    if header and probe:
         data[1]['x'] = 0.5*sigma['x'];data[1]['t'] =  0.5*sigma['t']
         data[2]['y'] = 0.5*sigma['y'];data[2]['t'] = -0.5*sigma['t']
         data[3]['x'] = 1.0*sigma['x'];data[3]['t'] =  sigma['t']
@@ -193,8 +306,25 @@ def write_astra(beam,
         data[1:7]['status'] = 3
         data[1:7]['pz'] = 0 #? This is what the Astra Generator does
     
-    # Save in the 'high_res = T' format
-    np.savetxt(outfile, data, fmt = ' '.join(8*['%20.12e']+2*['%4i']))
+    # Save in the 'high_res = T' format, the particles chunk_size at a time, bounding the memory of the rows and their text
+    n_particle = len(beam['x'])
+    q_total = beam.q.to('nC').magnitude
+    with open(outfile, 'w') as fid:
+
+        np.savetxt(fid, data, fmt=fmt)
+
+        for start in range(0, n_particle, chunk_size):
+            chunk = slice(start, min(start+chunk_size, n_particle))
+            data = np.zeros(chunk.stop-chunk.start, dtype=dtype)
+            for k in ['x', 'y', 'z', 'px', 'py', 'pz', 't']:
+                data[k] = beam[k].magnitude[chunk]
+            for k in ['z', 'pz', 't']:
+                data[k] -= ref_particle[k]
+            data['q'] = q_total*beam['w'].magnitude[chunk]   # macro charge for each particle
+            data['index'] = 1
+            data['status'] = -1
+            np.savetxt(fid, data, fmt=fmt)
+
     watch.stop() 
     vprint(f'done. Time ellapsed: {watch.print()}.', verbose>0, 0, True)
 
@@ -206,9 +336,11 @@ def fstr(s):
 
 def write_openPMD(beam,outfile,verbose=0, params=None):
 
+    from h5py import File
+
     with File(outfile, 'w') as h5:
 
-        if(params):
+        if(params and 'name' in params):
             name = params["name"]
         else:
             name = None
@@ -224,6 +356,55 @@ def write_openPMD(beam,outfile,verbose=0, params=None):
         vprint(f'done. Time ellapsed: {watch.print()}.', verbose>0, 0, True)
     
     
+def write_openpmd_vds(beam, outfile, files, name='/data/0/particles/'):
+
+    """
+    Writes the openPMD file outfile with the particle group name made of HDF5 virtual datasets, 
+    each concatenating the corresponding datasets of the openPMD shard files (in order), so 
+    the full beam can be read without a merged copy.  The shards are referenced relative to outfile.
+    """
+
+    from h5py import File, VirtualLayout, VirtualSource
+
+    root = os.path.dirname(os.path.abspath(outfile))
+    sources = [os.path.relpath(os.path.abspath(file), root) for file in files]
+
+    with File(files[0], 'r') as h5:
+        template = h5[name]
+        datasets = []
+        template.visititems(lambda key, obj: datasets.append(key) if(hasattr(obj, 'shape')) else None)
+        attrs = {key:dict(template[key].attrs) for key in datasets + [key for key in template.keys() if key not in datasets]}
+        group_attrs = dict(template.attrs)
+        dtypes = {key:template[key].dtype for key in datasets}
+
+    counts = []
+    for file in files:
+        with File(file, 'r') as h5:
+            counts.append(h5[name][datasets[0]].shape[0])
+
+    q_total = abs(beam.q.to('C').magnitude)
+    group_attrs.update({'numParticles':sum(counts), 'chargeLive':q_total, 'totalCharge':q_total})
+
+    with File(outfile, 'w') as h5:
+
+        opmd_init(h5)
+        g = h5.create_group(name)
+        g.attrs.update(group_attrs)
+
+        for key in datasets:
+
+            layout = VirtualLayout(shape=(sum(counts),), dtype=dtypes[key])
+            start = 0
+            for source, count in zip(sources, counts):
+                layout[start:start+count] = VirtualSource(source, name+key, shape=(count,))
+                start += count
+
+            g.create_virtual_dataset(key, layout)
+
+        for key, key_attrs in attrs.items():
+            g.require_group(key) if(key not in g) else None
+            g[key].attrs.update(key_attrs)
+
 def opmd_init(h5):
     """
     Root attribute initialization.
@@ -242,6 +423,114 @@ def opmd_init(h5):
     h5.create_group('/data/')
 
 
+# Shared memory layout: a null padded JSON header, followed by the float64 columns, one row each
+SHM_HEADER_SIZE = 4096
+SHM_COLUMNS = {'x':'m', 'y':'m', 'z':'m', 'px':'eV/c', 'py':'eV/c', 'pz':'eV/c', 't':'s', 'weight':'C'}
+
+def _untrack_shm(shm):
+    """
+    Stops the resource tracker from destroying the shared memory block shm when this process exits,
+    so the block can be handed off to another process
+    """
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(shm._name, 'shared_memory')
+
+def write_shm(beam, outfile, verbose=0, params=None):
+
+    """
+    Writes the beam data (see beam_data) into the named shared memory block outfile, for a tracking 
+    process on the same node to attach to with read_shm.  The columns are converted to standard units
+    directly in the block.  An existing block with the same name is replaced.  The block persists after 
+    this process exits, until a reader unlinks it.
+    """
+
+    from multiprocessing.shared_memory import SharedMemory
+
+    watch = StopWatch()
+    watch.start()
+    vprint(f'Printing {beam["n_particle"]} particles to shared memory "{outfile}": ', verbose>0, 0, False)
+
+    n_particle = len(beam['w'])
+    q_total = beam.q.to('C').magnitude
+
+    header = {'n_particle':n_particle, 'species':beam.species, 'total_charge':abs(q_total), 
+              'columns':list(SHM_COLUMNS.keys()), 'units':list(SHM_COLUMNS.values()), 
+              'dtype':'float64', 'offset':SHM_HEADER_SIZE}
+    header = json.dumps(header).encode()
+    assert len(header)<=SHM_HEADER_SIZE, 'write_shm: header too long.'
+
+    size = SHM_HEADER_SIZE + len(SHM_COLUMNS)*n_particle*8
+
+    try:
+        shm = SharedMemory(name=outfile, create=True, size=size)
+    except FileExistsError:
+        old = SharedMemory(name=outfile)
+        old.close()
+        old.unlink()
+        shm = SharedMemory(name=outfile, create=True, size=size)
+
+    _untrack_shm(shm)
+
+    shm.buf[:len(header)] = header
+    shm.buf[len(header):SHM_HEADER_SIZE] = bytes(SHM_HEADER_SIZE-len(header))
+
+    data = np.ndarray((len(SHM_COLUMNS), n_particle), dtype=np.float64, buffer=shm.buf, offset=SHM_HEADER_SIZE)
+    for ii, (name, unit) in enumerate(SHM_COLUMNS.items()):
+        if(name=='weight'):
+            np.multiply(beam['w'].magnitude, abs(q_total), out=data[ii])    # Weight should be macrocharge in C
+        else:
+            np.multiply(beam[name].magnitude, unit_registry.Quantity(1, beam[name].units).to(unit).magnitude, out=data[ii])
+
+    del data
+    shm.close()
+
+    watch.stop() 
+    vprint(f'done. Time ellapsed: {watch.print()}.', verbose>0, 0, True)
+
+def read_shm(name, unlink=False):
+
+    """
+    Attaches to a beam written by write_shm to the shared memory block name.  Returns the beam data dict,
+    as from beam_data, with the coordinate and weight arrays being read only views of the block, and the
+    SharedMemory object, which must be kept alive while the arrays are used and closed after.  With unlink,
+    the block is destroyed once all processes have closed it.
+    """
+
+    from multiprocessing.shared_memory import SharedMemory
+
+    shm = SharedMemory(name=name)
+
+    if(unlink):
+        shm.unlink()
+    else:
+        _untrack_shm(shm)
+
+    header = json.loads(bytes(shm.buf[:SHM_HEADER_SIZE]).rstrip(b'\x00'))
+    n_particle = header['n_particle']
+
+    columns = np.ndarray((len(header['columns']), n_particle), dtype=header['dtype'], buffer=shm.buf, offset=header['offset'])
+    columns.flags.writeable = False
+
+    data = {'n_particle':n_particle,
+            'species':header['species'],
+            'status':np.full(n_particle, 1)}   # Status == 1 means live
+    
+    for name, column in zip(header['columns'], columns):
+        data[name] = column
+
+    return data, shm
+
+
+def write_column_h5(g, name, x, units, scale=1, chunk_size=1048576):
+    """
+    Writes the quantity x in units, times scale, to the new dataset g[name], converting it in chunks, 
+    so that no full size temporary is made for large (e.g. memory mapped) beams
+    """
+    factor = scale*unit_registry.Quantity(1, x.units).to(units).magnitude
+    dset = g.create_dataset(name, shape=x.shape, dtype=x.magnitude.dtype)
+    for start in range(0, len(x), chunk_size):
+        dset[start:start+chunk_size] = x.magnitude[start:start+chunk_size]*factor
+
 def write_openpmd_h5(beam, h5, name=None, verbose=0):
     """
     Write particle data at a screen in openPMD BeamPhysics format
@@ -266,29 +555,29 @@ def write_openpmd_h5(beam, h5, name=None, verbose=0):
     g.attrs['totalCharge'] = abs(q_total)
 
     # Position
-    g['position/x']=beam['x'].to('m').magnitude # in meters
-    g['position/y']=beam['y'].to('m').magnitude
-    g['position/z']=beam['z'].to('m').magnitude
+    write_column_h5(g, 'position/x', beam['x'], 'm') # in meters
+    write_column_h5(g, 'position/y', beam['y'], 'm')
+    write_column_h5(g, 'position/z', beam['z'], 'm')
     for component in ['position/x', 'position/y', 'position/z', 'position']: # Add units to all components
         g[component].attrs['unitSI'] = 1.0
         g[component].attrs['unitDimension']=(1., 0., 0., 0., 0., 0., 0.) # m
     
     # momenta
-    g['momentum/x']=beam['px'].to('eV/c').magnitude #  m*c*gamma*beta_x in eV/c
-    g['momentum/y']=beam['py'].to('eV/c').magnitude
-    g['momentum/z']=beam['pz'].to('eV/c').magnitude
+    write_column_h5(g, 'momentum/x', beam['px'], 'eV/c') #  m*c*gamma*beta_x in eV/c
+    write_column_h5(g, 'momentum/y', beam['py'], 'eV/c')
+    write_column_h5(g, 'momentum/z', beam['pz'], 'eV/c')
     for component in ['momentum/x', 'momentum/y', 'momentum/z', 'momentum']: 
         g[component].attrs['unitSI']= 5.34428594864784788094e-28 # eV/c in J/(m/s) =  kg*m / s
         g[component].attrs['unitDimension']=(1., 1., -1., 0., 0., 0., 0.) # kg*m / s
        
     # Time
-    g['time'] = beam['t'].to('s').magnitude
+    write_column_h5(g, 'time', beam['t'], 's')
     g['time'].attrs['unitSI'] = 1.0 # s
     g['time'].attrs['unitDimension'] = (0., 0., 1., 0., 0., 0., 0.) # s
         
     # Weights
     #g['weight'] = beam['q'].to('C').magnitude
-    g['weight'] = beam["w"].magnitude * abs(q_total) # should be a charge
+    write_column_h5(g, 'weight', beam['w'], 'dimensionless', scale=abs(q_total)) # should be a charge
     g['weight'].attrs['unitSI'] = 1.0
     g['weight'].attrs['unitDimension']=(0., 0., 1, 1., 0., 0., 0.) # Amp*s = Coulomb
     
@@ -17,5 +17,6 @@ setup(
     long_description_content_type='text/markdown',
     install_requires=requirements,
     include_package_data=True,
+    entry_points={'console_scripts':['distgen=distgen.__main__:main']},
     python_requires='>=3.6'
 )
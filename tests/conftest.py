@@ -0,0 +1,19 @@
+import os
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+@pytest.fixture
+def gaussian_input():
+    """ Input file of the Gaussian example beam """
+    return os.path.join(ROOT, 'examples', 'data', 'gaussian.in.yaml')
+
+
+@pytest.fixture
+def subprocess_env():
+    """ Environment of a fresh interpreter, importing distgen from this tree """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from distgen import Generator
+from distgen.beam import weighted_moments
+
+VARIABLES = ['x', 'px', 'y', 'py', 'z', 'pz', 't']
+
+
+def moments(beam):
+    return weighted_moments([beam[var].magnitude for var in VARIABLES], beam['w'].magnitude)
+
+def gaussian_beam(input_file, chirp=False):
+    gen = Generator(input_file)
+    gen['n_particle'] = 20000
+    if(chirp):
+        # pz is set by z alone: a singular z, pz covariance
+        gen.input['pz_dist'] = {'type':'g', 'avg_pz':{'value':1, 'units':'MeV/c'}, 'sigma_pz':{'value':0, 'units':'keV/c'}}
+        gen.input['transforms'] = {'chirp':{'type':'polynomial z:pz', 'coefficients':[{'value':0, 'units':'eV/c'}, {'value':1, 'units':'keV/c/mm'}]}}
+    return gen.beam()
+
+
+@pytest.mark.parametrize('chirp', [False, True])
+@pytest.mark.parametrize('method', ['stratified', 'halton'])
+@pytest.mark.parametrize('reweight', [False, True])
+def test_downsample_keeps_the_covariance(chirp, method, reweight, gaussian_input):
+
+    beam = gaussian_beam(gaussian_input, chirp)
+    sample = beam.downsample(500, method=method, reweight=reweight, seed=1)
+
+    avg, cov = moments(beam)
+    sample_avg, sample_cov = moments(sample)
+
+    assert len(sample['x']) == 500
+    sigma = np.sqrt(np.diag(cov))
+    assert np.all(np.abs(sample_avg-avg) <= 1e-12*(sigma + np.abs(avg)))
+    assert np.all(np.abs(sample_cov-cov) <= 1e-12*np.outer(sigma, sigma))
+
+def test_downsample_needs_more_particles_than_coordinates_with_spread(gaussian_input):
+    with pytest.raises(AssertionError, match='number of coordinates with spread'):
+        gaussian_beam(gaussian_input).downsample(5)
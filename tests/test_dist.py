@@ -0,0 +1,51 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from distgen.dist import Tukey, TukeyRad
+from distgen.physical_constants import unit_registry
+from distgen.tools import tabulate_pdf
+
+
+def integral(ys, xs):
+    """ Trapezoidal integral of the quantities ys over xs, as a float """
+    return unit_registry.Quantity(np.trapz(ys.magnitude, xs.magnitude), ys.units*xs.units).to('dimensionless').magnitude
+
+
+@pytest.mark.parametrize('ratio', [0.25, 0.5, 1.0])
+@pytest.mark.parametrize('length', ['2 mm', '1 m', '300 um'])
+def test_tukey_rad_pdf_is_normalized(ratio, length):
+
+    L = unit_registry(length)
+    dist = TukeyRad(ratio=ratio*unit_registry('dimensionless'), length=L)
+
+    rs = np.linspace(0, 1.2*L.magnitude, 200001)*L.units
+    pdf = dist.pdf(rs)
+
+    assert integral(pdf, rs) == pytest.approx(1, rel=1e-6)
+
+@pytest.mark.parametrize('ratio', [0.25, 0.5, 1.0])
+def test_tukey_pdf_is_normalized(ratio):
+
+    L = 2*unit_registry('mm')
+    dist = Tukey('x', ratio=ratio*unit_registry('dimensionless'), length=L)
+
+    xs = np.linspace(-L.magnitude, L.magnitude, 200001)*L.units
+    pdf = dist.pdf(xs)
+
+    assert integral(pdf, xs) == pytest.approx(1, rel=1e-6)
+
+def narrow_peak(x):
+    return unit_registry.Quantity(np.exp(-0.5*(x.magnitude/1e-3)**2), 'dimensionless')
+
+def test_tabulate_pdf_warns_when_it_stops_above_tolerance():
+
+    a, b = -1*unit_registry('mm'), 1*unit_registry('mm')
+
+    with pytest.warns(UserWarning, match='tabulate_pdf: stopped at'):
+        tabulate_pdf(narrow_peak, 1000*a, 1000*b, max_points=257)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        tabulate_pdf(narrow_peak, 5*a, 5*b)
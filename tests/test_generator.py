@@ -0,0 +1,15 @@
+import pytest
+
+from distgen import Generator
+
+
+@pytest.mark.parametrize('train, message', [({'n_bunch':2, 'spacing':3}, 'spacing must have units'),
+                                            ({'n_bunch':2, 'spacing':{'value':3, 'units':'ns'}, 'jitter':1}, 'jitter must have the units'),
+                                            ({'n_bunch':2, 'spacing':{'value':3, 'units':'ns'}, 'charge':[1, 2]}, 'charge must have units')])
+def test_train_parameters_without_units_are_rejected(train, message, gaussian_input):
+
+    gen = Generator(gaussian_input)
+    gen.input['train'] = train
+
+    with pytest.raises(AssertionError, match=message):
+        gen.configure()
@@ -0,0 +1,21 @@
+import json
+import subprocess
+import sys
+
+DEFERRED_MODULES = ['matplotlib', 'pdf2image', 'h5py', 'pmd_beamphysics', 'scipy.integrate']
+
+SCRIPT = """
+import json, sys
+import distgen.generator
+print(json.dumps([m for m in %r if m in sys.modules]))
+""" % DEFERRED_MODULES
+
+
+def import_generator(env):
+    """ Imports distgen.generator in a fresh interpreter, returning the deferred modules it loaded """
+    result = subprocess.run([sys.executable, '-c', SCRIPT], env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def test_generator_import_defers_heavy_modules(subprocess_env):
+    assert import_generator(subprocess_env) == []
@@ -0,0 +1,58 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from distgen import Generator
+from distgen.generator import SAMPLE_CHUNK_SIZE
+
+
+def beam_nbytes(beam):
+    """ Bytes held by the coordinates and weights of the beam """
+    return sum(beam[var].magnitude.nbytes for var in ['x', 'y', 'z', 't', 'px', 'py', 'pz', 'w'])
+
+
+def test_beam_peak_memory_is_bounded_by_the_coordinate_block(gaussian_input):
+
+    # Two sampling chunks, so the chunk temporaries are half the beam size
+    gen = Generator(gaussian_input)
+    gen['n_particle'] = 2*SAMPLE_CHUNK_SIZE
+    gen.configure()
+
+    tracemalloc.start()
+    try:
+        beam = gen.beam()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert len(beam['x']) == 2*SAMPLE_CHUNK_SIZE
+    assert np.isfinite(beam['x'].magnitude).all()
+    assert peak <= 1.5*beam_nbytes(beam)
+
+
+TRANSFORMS = {'rotate':{'type':'rotate2d x:y', 'angle':{'value':30, 'units':'deg'}},
+              'twiss':{'type':'set_twiss x', 'beta':{'value':2, 'units':'m'}, 'alpha':{'value':0.5, 'units':''}, 
+                       'emittance':{'value':1, 'units':'nm'}}}
+
+@pytest.mark.parametrize('storage, stages', [('memory', {'transforms':TRANSFORMS}), 
+                                             ('memmap', {'transforms':TRANSFORMS}), 
+                                             ('memmap', {'match_covariance':True})])
+def test_planned_peak_memory_matches_the_beam(storage, stages, gaussian_input):
+
+    gen = Generator(gaussian_input)
+    gen['n_particle'] = 2*SAMPLE_CHUNK_SIZE
+    gen.input['storage'] = storage
+    gen.input['pz_dist'] = {'type':'g', 'avg_pz':{'value':1, 'units':'MeV/c'}, 'sigma_pz':{'value':1, 'units':'keV/c'}}
+    gen.input.update(stages)
+
+    planned = gen.plan(calibrate=False)['memory']['peak']
+
+    tracemalloc.start()
+    try:
+        gen.beam()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert planned == pytest.approx(peak, rel=0.05)
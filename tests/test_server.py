@@ -0,0 +1,125 @@
+import os
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import time
+from multiprocessing.shared_memory import SharedMemory
+
+import pytest
+
+from distgen.server import submit, token_filename
+from distgen.writers import _untrack_shm
+
+INPUT = {'n_particle':100, 'random_type':'hammersley', 'total_charge':{'value':10, 'units':'pC'},
+         'start':{'type':'cathode', 'MTE':{'value':150, 'units':'meV'}},
+         'r_dist':{'type':'ru', 'max_r':{'value':1, 'units':'mm'}},
+         't_dist':{'type':'g', 'sigma_t':{'value':2, 'units':'ps'}},
+         'output':{'type':'gpt'}}
+
+
+def wait_for(path, timeout=60):
+    """ Waits for the file path to be created by the service """
+    start = time.time()
+    while(not os.path.exists(path)):
+        assert time.time()-start<timeout, f'Service did not create {path}'
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch, subprocess_env):
+    """ Starts distgen serve with the given arguments, writing to tmp_path/output, and stops it after the test """
+
+    monkeypatch.setenv('DISTGEN_CACHE_DIR', str(tmp_path/'cache'))
+    monkeypatch.delenv('DISTGEN_SERVE_TOKEN', raising=False)
+    subprocess_env['DISTGEN_CACHE_DIR'] = os.environ['DISTGEN_CACHE_DIR']
+    subprocess_env.pop('DISTGEN_SERVE_TOKEN', None)
+
+    output_dir = tmp_path/'output'
+    output_dir.mkdir()
+
+    processes = []
+    def start(*args):
+        processes.append(subprocess.Popen([sys.executable, '-m', 'distgen', 'serve', '--workers', '1',
+                                           '--output-dir', str(output_dir), *args], env=subprocess_env))
+        return output_dir
+
+    yield start
+
+    for process in processes:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def test_socket_is_private_and_outputs_are_confined(service, tmp_path):
+
+    address = str(tmp_path/'distgen.sock')
+    output_dir = service('--socket', address)
+    wait_for(address)
+
+    assert stat.S_IMODE(os.stat(address).st_mode) == 0o600
+
+    result = submit(INPUT, settings={'output:file':'beam.txt'}, address=address, timeout=60)
+    assert result['output'] == str(output_dir.resolve()/'beam.txt')
+    assert os.path.exists(result['output'])
+
+    for outfile in ['../beam.txt', str(tmp_path/'beam.txt')]:
+        with pytest.raises(RuntimeError, match='outside of the output directory'):
+            submit(INPUT, settings={'output:file':outfile}, address=address, timeout=60)
+    assert not os.path.exists(tmp_path/'beam.txt')
+
+    # Shard files named by the output pattern are confined too
+    with pytest.raises(RuntimeError, match='outside of the output directory'):
+        submit(INPUT, settings={'output:file':'beam.txt', 'output:shards':2, 'output:pattern':str(tmp_path/'escaped_{shard}.txt')},
+               address=address, timeout=60)
+    assert not any(name.startswith('escaped') for name in os.listdir(tmp_path))
+
+    result = submit(INPUT, settings={'output:file':'sharded.txt', 'output:shards':2, 'output:pattern':'sharded_{shard}.txt'},
+                    address=address, timeout=60)
+    assert result['shards'] == result['output'] == [str(output_dir.resolve()/f'sharded_{shard}.txt') for shard in range(2)]
+    assert all(os.path.exists(file) for file in result['shards'])
+
+
+def test_http_requires_the_token(service):
+
+    port = free_port()
+    service('--port', str(port))
+    token_file = token_filename(port)
+    wait_for(token_file)
+
+    assert stat.S_IMODE(os.stat(token_file).st_mode) == 0o600
+
+    with pytest.raises(RuntimeError, match='token'):
+        submit(INPUT, settings={'output:file':'beam.txt'}, address=f'localhost:{port}', timeout=60, token='wrong')
+
+    # The client reads the token file by default
+    result = submit(INPUT, settings={'output:file':'beam.txt'}, address=f'localhost:{port}', timeout=60)
+    assert os.path.exists(result['output'])
+
+
+def test_unread_shm_blocks_are_unlinked(service, tmp_path):
+
+    address = str(tmp_path/'distgen.sock')
+    service('--socket', address, '--shm-ttl', '1')
+    wait_for(address)
+
+    result = submit(INPUT, address=address, timeout=60)
+    assert result['type'] == 'shm'
+
+    start = time.time()
+    while(True):
+        try:
+            shm = SharedMemory(name=result['output'])
+        except FileNotFoundError:
+            break
+        _untrack_shm(shm)
+        shm.close()
+        assert time.time()-start<30, 'The service did not unlink the shared memory block'
+        time.sleep(0.1)
@@ -0,0 +1,50 @@
+import json
+import os
+import subprocess
+import sys
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pytest
+
+from distgen import Generator
+from distgen.beam import beam_data
+from distgen.writers import write_shm, SHM_COLUMNS
+
+# Attaches to the block as a co-located tracker would, unlinking it once read
+READER = """
+import json, sys
+from distgen.writers import read_shm
+data, shm = read_shm(sys.argv[1], unlink=True)
+print(json.dumps({key:value.tolist() if hasattr(value, 'tolist') else value for key, value in data.items()}))
+del data
+shm.close()
+"""
+
+
+def test_shm_beam_is_read_back_by_another_process(gaussian_input, subprocess_env):
+
+    gen = Generator(gaussian_input)
+    gen['n_particle'] = 1000
+    beam = gen.beam()
+
+    name = f'distgen_test_{os.getpid()}'
+    write_shm(beam, name)
+
+    try:
+        result = subprocess.run([sys.executable, '-c', READER, name], env=subprocess_env, capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError:
+        SharedMemory(name=name).unlink()
+        raise
+
+    read = json.loads(result.stdout)
+    expected = beam_data(beam)
+
+    assert read['n_particle'] == expected['n_particle'] == 1000
+    assert read['species'] == expected['species']
+    for column in SHM_COLUMNS:
+        np.testing.assert_array_equal(read[column], expected[column])
+
+    # The reader unlinked the block
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=name)
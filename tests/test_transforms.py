@@ -0,0 +1,31 @@
+import pytest
+
+from distgen import Generator
+from distgen.transforms import TRANSFORMS
+
+
+@pytest.mark.parametrize('transform_type', ['in_place x', 'check_inputs x', 'get_origin x', 'transform x', 'undefined x'])
+def test_only_registered_transforms_are_accepted(transform_type, gaussian_input):
+
+    gen = Generator(gaussian_input)
+    gen.input['transforms'] = {'t':{'type':transform_type}}
+
+    with pytest.raises(AssertionError, match='is not supported'):
+        gen.configure()
+
+def test_matrix2d_is_a_registered_transform(gaussian_input):
+
+    assert 'matrix2d' in TRANSFORMS
+
+    gen = Generator(gaussian_input)
+    gen['n_particle'] = 1000
+    plain = gen.beam()
+
+    gen = Generator(gaussian_input)
+    gen['n_particle'] = 1000
+    gen.input['transforms'] = {'m':{'type':'matrix2d x:px', 'm11':2, 'm12':{'value':0, 'units':'mm/(eV/c)'},
+                                    'm21':{'value':0, 'units':'eV/c/mm'}, 'm22':0.5}}
+    beam = gen.beam()
+
+    assert (beam.std('x')/plain.std('x')).magnitude == pytest.approx(2)
+    assert (beam.std('px')/plain.std('px')).magnitude == pytest.approx(0.5)